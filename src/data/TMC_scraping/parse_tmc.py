@@ -5,11 +5,13 @@ import re
 from dateutil.parser import parse
 from .. import util
 from .. import geocoding_util
+import numpy as np
 import rtree
 import json
 import os
 import argparse
 import sys
+from multiprocessing import Pool
 from ..record import Record
 
 
@@ -145,103 +147,102 @@ def add_direction(direction_locations, direction, col, previous, count):
     return direction_locations
 
 
-def get_conflict_count(dir_locations, sheet, row, sheet2):
+# Pairs of turns that conflict, as (from, to) directions
+CONFLICT_SETS = [
+    # Left turn from south conflicts with straight from north
+    (('south', 'left'), ('north', 'thru')),
+    # Right turn from south conflicts with straight from west
+    (('south', 'right'), ('west', 'thru')),
+    # Left turn from west conflicts with straight from east
+    (('west', 'left'), ('east', 'thru')),
+    # Right turn from west conflicts with straight from north
+    (('west', 'right'), ('north', 'thru')),
+    # Left turn from north conflicts with straight from south
+    (('north', 'left'), ('south', 'thru')),
+    # Right turn from north conflicts with straight from east
+    (('north', 'right'), ('east', 'thru')),
+    # Left turn from east conflicts with straight from west
+    (('east', 'left'), ('west', 'thru')),
+    # Right turn from east conflicts with straight from south
+    (('east', 'right'), ('south', 'thru')),
+]
+
+# Where the parse results for each file are kept, so only new
+# or changed files need to be parsed again
+PARSED_FILE = 'tmc_parsed.json'
+
+
+def read_sheet(workbook, sheet_name):
+    """
+    Read a worksheet in one pass
+    Args:
+        workbook - xlrd workbook
+        sheet_name
+    Returns:
+        cells - list of the rows of cell values, for reading labels
+        counts - float array of the cells, nan where a cell isn't a number
+    """
+    sheet = workbook.sheet_by_name(sheet_name)
+    cells = [sheet.row_values(r) for r in range(sheet.nrows)]
+    if not cells:
+        return cells, np.empty((0, sheet.ncols))
+
+    types = np.array([sheet.row_types(r) for r in range(sheet.nrows)])
+    numbers = (types == xlrd.XL_CELL_NUMBER) | (types == xlrd.XL_CELL_DATE)
+    counts = np.where(
+        numbers, np.array(cells, dtype=object), np.nan).astype(float)
+    return cells, counts
+
+
+def fit_counts(counts, shape):
+    """
+    Crop an array of counts to a shape, or pad it with nan
+    Args:
+        counts - float array
+        shape - (rows, columns)
+    Returns:
+        float array of the given shape
+    """
+    fitted = np.full(shape, np.nan)
+    nrows = min(shape[0], counts.shape[0])
+    ncols = min(shape[1], counts.shape[1])
+    fitted[:nrows, :ncols] = counts[:nrows, :ncols]
+    return fitted
 
-    # Conflicts (count each conflict over 15 minutes)
+
+def get_conflict_count(dir_locations, counts, row, totals):
+    """
+    Count conflicting turns: for each pair of conflicting turns,
+    the smaller of the two counts in each 15 minute period
+    Args:
+        dir_locations - dict of direction to the column of each turn
+        counts - array of counts, nan where there isn't one
+        row - the row with the turn labels
+        totals - boolean array of which rows are totals
+    Returns:
+        number of conflicts
+    """
     conflicts = 0
-    conflict_sets = [{
-        # Left turn from south conflicts with straight from north
-        'from1': 'south',
-        'to1': 'left',
-        'from2': 'north',
-        'to2': 'thru'
-    }, {
-        # Right turn from south conflicts with straight from west
-        'from1': 'south',
-        'to1': 'right',
-        'from2': 'west',
-        'to2': 'thru'
-    }, {
-        # Left turn from west conflicts with straight from east
-        'from1': 'west',
-        'to1': 'left',
-        'from2': 'east',
-        'to2': 'thru'
-    }, {
-        # Right turn from west conflicts with straight from north
-        'from1': 'west',
-        'to1': 'right',
-        'from2': 'north',
-        'to2': 'thru'
-    }, {
-        # Left turn from north conflicts with straight from south
-        'from1': 'north',
-        'to1': 'left',
-        'from2': 'south',
-        'to2': 'thru'
-    }, {
-        # Right turn from north conflicts with straight from east
-        'from1': 'north',
-        'to1': 'right',
-        'from2': 'east',
-        'to2': 'thru'
-    }, {
-        # Left turn from east conflicts with straight from west
-        'from1': 'east',
-        'to1': 'left',
-        'from2': 'west',
-        'to2': 'thru'
-    }, {
-        # Right turn from east conflicts with straight from south
-        'from1': 'east',
-        'to1': 'right',
-        'from2': 'south',
-        'to2': 'thru'
-    }]
-
-    for conflict in conflict_sets:
-        if conflict['from1'] in list(dir_locations.keys()) \
-           and conflict['to1'] in list(dir_locations[
-               conflict['from1']]['to'].keys()) \
-           and conflict['from2'] in list(dir_locations.keys()) \
-           and conflict['to2'] in list(dir_locations[
-               conflict['from2']]['to'].keys()):
-            for index in range(row+1, sheet.nrows):
-                conflict_count1 = sheet.cell_value(
-                    index,
-                    dir_locations[
-                        conflict['from1']]['to'][conflict['to1']])
-                if sheet2:
-                    conflict_count1 += sheet2.cell_value(
-                        index,
-                        dir_locations[
-                            conflict['from1']]['to'][conflict['to1']])
-                conflict_count2 = sheet.cell_value(
-                    index,
-                    dir_locations[
-                        conflict['from2']]['to'][conflict['to2']])
-                if sheet2:
-                    conflict_count2 += sheet2.cell_value(
-                        index,
-                        dir_locations[
-                            conflict['from2']]['to'][conflict['to2']])
-                rowlabel = sheet.cell_value(index, 0)
-                if 'tot' not in str(rowlabel).lower() and \
-                   type(conflict_count1) == float and \
-                   type(conflict_count2) == float:
-
-                    conflicts += min(conflict_count1, conflict_count2)
-    return conflicts
+    for (from1, to1), (from2, to2) in CONFLICT_SETS:
+        if from1 in dir_locations and to1 in dir_locations[from1]['to'] \
+           and from2 in dir_locations and to2 in dir_locations[from2]['to']:
+            count1 = counts[row + 1:, dir_locations[from1]['to'][to1]]
+            count2 = counts[row + 1:, dir_locations[from2]['to'][to2]]
+            valid = ~totals[row + 1:] & ~np.isnan(count1) & ~np.isnan(count2)
+            conflicts += np.minimum(count1[valid], count2[valid]).sum()
+    return float(conflicts)
 
 
 def parse_15_min_format(workbook, sheet_name, format, sheet_name2=None):
 
-    sheet_index = workbook.sheet_names().index(sheet_name)
-    sheet = workbook.sheet_by_index(sheet_index)
-    sheet2 = None
+    cells, counts = read_sheet(workbook, sheet_name)
+    # The second sheet's counts are added to the first's; the labels
+    # are read from the first sheet, so its shape is kept, and cells
+    # the second sheet doesn't have aren't counted
     if sheet_name2:
-        sheet_index2 = workbook.sheet_names().index(sheet_name2)
-        sheet2 = workbook.sheet_by_index(sheet_index2)
+        counts = counts + fit_counts(
+            read_sheet(workbook, sheet_name2)[1], counts.shape)
+    nrows, ncols = counts.shape
 
     if format == 1:
         row = 8
@@ -268,57 +269,25 @@ def parse_15_min_format(workbook, sheet_name, format, sheet_name2=None):
     curr_count = 0
 
     # Can't be a full 11-12 hour count if it's this small
-    if sheet.nrows < 25:
+    if nrows < 25:
         return
-    while col < sheet.ncols:
-        if north in sheet.cell_value(row, col).lower():
-            if 'north' in list(dir_locations.keys()):
-                return
-            dir_locations = add_direction(
-                dir_locations,
-                'north',
-                col,
-                current,
-                curr_count
-            )
-            current = 'north'
-            curr_count = 0
-        elif south in sheet.cell_value(row, col).lower():
-            if 'south' in list(dir_locations.keys()):
-                return
-            dir_locations = add_direction(
-                dir_locations,
-                'south',
-                col,
-                current,
-                curr_count
-            )
-            current = 'south'
-            curr_count = 0
-        elif east in sheet.cell_value(row, col).lower():
-            if 'east' in list(dir_locations.keys()):
-                return
-            dir_locations = add_direction(
-                dir_locations,
-                'east',
-                col,
-                current,
-                curr_count
-            )
-            current = 'east'
-            curr_count = 0
-        elif west in sheet.cell_value(row, col).lower():
-            if 'west' in list(dir_locations.keys()):
-                return
-            dir_locations = add_direction(
-                dir_locations,
-                'west',
-                col,
-                current,
-                curr_count
-            )
-            current = 'west'
-            curr_count = 0
+    while col < ncols:
+        label = cells[row][col].lower()
+        for name, direction in ((north, 'north'), (south, 'south'),
+                                (east, 'east'), (west, 'west')):
+            if name in label:
+                if direction in dir_locations:
+                    return
+                dir_locations = add_direction(
+                    dir_locations,
+                    direction,
+                    col,
+                    current,
+                    curr_count
+                )
+                current = direction
+                curr_count = 0
+                break
         col += 1
         curr_count += 1
 
@@ -333,46 +302,41 @@ def parse_15_min_format(workbook, sheet_name, format, sheet_name2=None):
         row += 1
     elif format == 2:
         row += 3
+
+    # Ignore totals
+    totals = np.array(['tot' in str(r[0]).lower() for r in cells])
     total_count = 0
     left_count = 0
     right_count = 0
+    quarter_hours = 0
     for direction in list(dir_locations.keys()):
         indices = dir_locations[direction]['indices']
         dir_locations[direction]['to'] = {}
 
         # hack because at least one of the tmcs has a bad header for the total
         if format == 2:
-            end = min(indices[1] - 1, sheet.ncols)
+            end = min(indices[1] - 1, ncols)
         else:
-            end = min(indices[1], sheet.ncols)
+            end = min(indices[1], ncols)
         for col in range(indices[0], end):
-            if thru in sheet.cell_value(row, col).lower() \
-               and 'tot' not in sheet.cell_value(row, col).lower():
+            label = cells[row][col].lower()
+            if thru in label and 'tot' not in label:
                 dir_locations[direction]['to']['thru'] = col
-            elif right in sheet.cell_value(row, col).lower():
+            elif right in label:
                 dir_locations[direction]['to']['right'] = col
-            elif left in sheet.cell_value(row, col).lower():
+            elif left in label:
                 dir_locations[direction]['to']['left'] = col
-            elif 'u-tr' in sheet.cell_value(row, col).lower():
+            elif 'u-tr' in label:
                 dir_locations[direction]['to']['u-tr'] = col
 
         for dir, col_index in dir_locations[direction]['to'].items():
-            col_sum = 0
-            row_start = row + 1
-
-            quarter_hours = 0
-            for r in range(row_start, sheet.nrows):
-                rowlabel = sheet.cell_value(r, 0)
-                # Only look at the first 11 hours for normalization
-                # And ignore totals
-                if quarter_hours < 44 \
-                   and 'tot' not in str(rowlabel).lower() and \
-                   type(sheet.cell_value(r, col_index)) == float:
-                    quarter_hours += 1
-                    col_sum += sheet.cell_value(r, col_index)
-                    if sheet2:
-                        col_sum += sheet2.cell_value(r, col_index)
-                        
+            # Only look at the first 11 hours for normalization
+            column = counts[row + 1:, col_index]
+            valid = ~totals[row + 1:] & ~np.isnan(column)
+            valid &= np.cumsum(valid) <= 44
+            quarter_hours = int(valid.sum())
+            col_sum = column[valid].sum()
+
             total_count += col_sum
 
             # counts of left turns and counts of right turns
@@ -382,12 +346,147 @@ def parse_15_min_format(workbook, sheet_name, format, sheet_name2=None):
             elif dir == 'left':
                 left_count += col_sum
 
-    conflicts = get_conflict_count(dir_locations, sheet, row, sheet2)
+    conflicts = get_conflict_count(dir_locations, counts, row, totals)
 
-    return [total_count, left_count, right_count, conflicts, quarter_hours]
+    return [float(total_count), float(left_count), float(right_count),
+            conflicts, quarter_hours]
 
 
-def parse_conflicts():
+def parse_file(file_path):
+    """
+    Parse the counts out of a TMC workbook, using whichever
+    format its sheets are in
+    Args:
+        file_path
+    Returns:
+        list of total, left, right and conflict counts and the number
+        of 15 minute periods, or None if the file can't be parsed
+    """
+    # Only load the sheets that are used
+    workbook = xlrd.open_workbook(file_path, on_demand=True)
+    sheet_names = workbook.sheet_names()
+
+    result = None
+    if [x for x in sheet_names if re.match('Cars.*Trucks', x)]:
+        sheet_name = [x for x in sheet_names
+                      if re.match('Cars.*Trucks', x)][0]
+        result = parse_15_min_format(workbook, sheet_name, 1)
+    elif [x for x in sheet_names if re.match('15.*Motors A', x)]:
+        # skip this one
+        pass
+    elif [x for x in sheet_names if re.match('15.*ll Motors', x)]:
+        sheet_name = [x for x in sheet_names
+                      if re.match('15.*ll Motors', x)][0]
+        result = parse_15_min_format(workbook, sheet_name, 2)
+    elif 'Cars' in sheet_names and (
+            'Heavy Vehicles' in sheet_names
+            or 'Trucks' in sheet_names):
+        hv = 'Heavy Vehicles'
+        if 'Trucks' in sheet_names:
+            hv = 'Trucks'
+        result = parse_15_min_format(workbook, 'Cars', 1,
+                                     sheet_name2=hv)
+    elif '15-min. Cars' in sheet_names \
+         and [x for x in sheet_names if re.match(
+             '15-min*Heavy Vehicle', x)]:
+        hv = [x for x in sheet_names if re.match(
+            '15-min*Heavy Vehicle', x)][0]
+        result = parse_15_min_format(workbook, '15-min. Cars', 1,
+                                     sheet_name2=hv)
+    elif 'Cars & Peds' in sheet_names \
+         and 'Trucks & Bikes' in sheet_names:
+        result = parse_15_min_format(workbook, 'Cars & Peds', 1,
+                                     sheet_name2='Trucks & Bikes')
+    workbook.release_resources()
+    return result
+
+
+def file_stamp(file_path):
+    """
+    Size and modification time of a file, to tell if it's changed
+    """
+    stat = os.stat(file_path)
+    return [stat.st_size, stat.st_mtime]
+
+
+def parse_files(filenames, parsed, processes=None):
+    """
+    Parse the TMC files that are new or have changed since they
+    were last parsed, in parallel
+    Args:
+        filenames - TMC files to parse
+        parsed - dict of filename to the file's size and modification
+            time when it was parsed and the results; updated in place.
+            Files that were skipped last time are parsed
+        processes - number of processes, None for all the cpus
+    Returns:
+        dict of filename to results
+    """
+    stamps = {filename: file_stamp(path.join(TMC_FP, filename))
+              for filename in filenames}
+    changed = [filename for filename in filenames
+               if filename not in parsed
+               or parsed[filename].get('skipped')
+               or parsed[filename]['stamp'] != stamps[filename]]
+    print("parsing {} new or changed TMC files, {} unchanged".format(
+        len(changed), len(filenames) - len(changed)))
+
+    file_paths = [path.join(TMC_FP, filename) for filename in changed]
+    if processes == 1 or len(changed) < 2:
+        results = [parse_file(file_path) for file_path in file_paths]
+    else:
+        with Pool(processes) as pool:
+            results = pool.map(parse_file, file_paths)
+
+    for filename, result in zip(changed, results):
+        parsed[filename] = {'stamp': stamps[filename], 'result': result}
+    return {filename: parsed[filename]['result'] for filename in filenames}
+
+
+def skip_files(filenames, parsed):
+    """
+    Record files that aren't parsed (e.g. because they can't be
+    geocoded), so they don't count as new or changed next time
+    Args:
+        filenames - TMC files that weren't parsed
+        parsed - dict of filename to the file's size and modification
+            time and the results; updated in place
+    """
+    for filename in filenames:
+        parsed[filename] = {
+            'stamp': file_stamp(path.join(TMC_FP, filename)),
+            'result': None,
+            'skipped': True,
+        }
+
+
+def geocode_files(filenames, cached):
+    """
+    Geocode the intersection in each TMC filename, before any
+    of the files are parsed
+    Args:
+        filenames
+        cached - dict of geocoded addresses, which new results are added to
+    Returns:
+        dict of filename to address, latitude and longitude, for the
+        files that could be geocoded
+    """
+    locations = {}
+    for filename in filenames:
+        # Pull out what we can from the filename itself
+        orig_address, address, latitude, longitude, status = \
+            find_address_from_filename(filename, cached)
+        # If you can't geocode the address then there's not much point
+        # in parsing it because you won't be able to snap it to a segment
+        if latitude:
+            if orig_address:
+                cached[orig_address] = [
+                    address, latitude, longitude, status]
+            locations[filename] = (address, latitude, longitude)
+    return locations
+
+
+def parse_conflicts(processes=None):
     count = 0
 
     print('getting normalization factors')
@@ -400,95 +499,78 @@ def parse_conflicts():
         print('reading geocoded cache file')
         cached = geocoding_util.read_geocode_cache(filename=geocoded_file)
 
-    summary = []
-    for filename in listdir(TMC_FP):
-        if filename.endswith('.XLS'):
-
-            # Pull out what we can from the filename itself
-            orig_address, address, latitude, longitude, status = \
-                find_address_from_filename(filename, cached)
-            # If you can't geocode the address then there's not much point
-            # in parsing it because you won't be able to snap it to a segment
-            if latitude:
-
-                if orig_address:
-                    cached[orig_address] = [
-                        address, latitude, longitude, status]
-                date = str(find_date(filename))
-                hours = num_hours(filename)
-                file_path = path.join(TMC_FP, filename)
-                workbook = xlrd.open_workbook(file_path)
-                sheet_names = workbook.sheet_names()
-
-                # total, left, right, conflicts
-                counts = [0, 0, 0, 0]
-                result = None
-                
-                if [x for x in sheet_names if re.match('Cars.*Trucks', x)]:
-                    sheet_name = [x for x in sheet_names
-                                  if re.match('Cars.*Trucks', x)][0]
-                    result = parse_15_min_format(workbook, sheet_name, 1)
-                elif [x for x in sheet_names if re.match('15.*Motors A', x)]:
-                    # skip this one
-                    pass
-                elif [x for x in sheet_names if re.match('15.*ll Motors', x)]:
-                    sheet_name = [x for x in sheet_names
-                                  if re.match('15.*ll Motors', x)][0]
-                    result = parse_15_min_format(workbook, sheet_name, 2)
-                elif 'Cars' in sheet_names and (
-                        'Heavy Vehicles' in sheet_names
-                        or 'Trucks' in sheet_names):
-                    hv = 'Heavy Vehicles'
-                    if 'Trucks' in sheet_names:
-                        hv = 'Trucks'
-                    result = parse_15_min_format(workbook, 'Cars', 1,
-                                                 sheet_name2=hv)
-                elif '15-min. Cars' in sheet_names \
-                     and [x for x in sheet_names if re.match(
-                         '15-min*Heavy Vehicle', x)]:
-                    hv = [x for x in sheet_names if re.match(
-                        '15-min*Heavy Vehicle', x)][0]
-                    result = parse_15_min_format(workbook, '15-min. Cars', 1,
-                                                 sheet_name2=hv)
-                elif 'Cars & Peds' in sheet_names \
-                     and 'Trucks & Bikes' in sheet_names:
-                    result = parse_15_min_format(workbook, 'Cars & Peds', 1,
-                                                 sheet_name2='Trucks & Bikes')
-
-                if result:
-                    count += 1
-                    counts = result
-                    print(filename)
-                    print(hours)
-                    print(counts)
-
-                    normalized = ''
-                    total = result[0]
-                    if hours == 11:
-                        normalized = int(round(total/n_11))
-                    else:
-                        normalized = int(round(total/n_12))
-                    value = {
-                        'Filename': filename,
-                        'Address': address,
-                        'Latitude': latitude,
-                        'Longitude': longitude,
-                        'Date': date,
-                        'Hours': hours,
-                        'Total': int(total),
-                        'Normalized': normalized,
-                        'Left': int(result[1]),
-                        'Right': int(result[2]),
-                        'Conflict': int(result[3])
-                    }
-                    summary.append(value)
+    filenames = [x for x in listdir(TMC_FP) if x.endswith('.XLS')]
+    locations = geocode_files(filenames, cached)
 
     # Write out the cached file
     geocoding_util.write_geocode_cache(cached, filename=geocoded_file)
 
+    # Results from the last time the files were parsed
+    parsed_file = os.path.join(PROCESSED_DATA_FP, PARSED_FILE)
+    parsed = {}
+    if path_exists(parsed_file):
+        with open(parsed_file) as f:
+            parsed = json.load(f)
+    results = parse_files(
+        [x for x in filenames if x in locations], parsed, processes)
+    skip_files([x for x in filenames if x not in locations], parsed)
+    with open(parsed_file, 'w') as f:
+        json.dump(parsed, f)
+
+    summary = []
+    for filename in filenames:
+        result = results.get(filename)
+        if result:
+            address, latitude, longitude = locations[filename]
+            date = str(find_date(filename))
+            hours = num_hours(filename)
+
+            count += 1
+            print(filename)
+            print(hours)
+            print(result)
+
+            normalized = ''
+            total = result[0]
+            if hours == 11:
+                normalized = int(round(total/n_11))
+            else:
+                normalized = int(round(total/n_12))
+            value = {
+                'Filename': filename,
+                'Address': address,
+                'Latitude': latitude,
+                'Longitude': longitude,
+                'Date': date,
+                'Hours': hours,
+                'Total': int(total),
+                'Normalized': normalized,
+                'Left': int(result[1]),
+                'Right': int(result[2]),
+                'Conflict': int(result[3])
+            }
+            summary.append(value)
+
     print("parsed " + str(count) + " TMC files")
     return summary
 
+
+def tmc_files_changed():
+    """
+    Whether any TMC files have been added or changed since they
+    were last parsed
+    """
+    parsed_file = os.path.join(PROCESSED_DATA_FP, PARSED_FILE)
+    if not path_exists(parsed_file):
+        return True
+    with open(parsed_file) as f:
+        parsed = json.load(f)
+    return any(
+        filename not in parsed
+        or parsed[filename]['stamp'] != file_stamp(path.join(TMC_FP, filename))
+        for filename in listdir(TMC_FP) if filename.endswith('.XLS'))
+
+
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
@@ -499,6 +581,9 @@ if __name__ == '__main__':
     # Can force update
     parser.add_argument('--forceupdate', action='store_true',
                         help='Whether force update the maps')
+    parser.add_argument("-p", "--processes", type=int,
+                        help="Number of processes to parse files " +
+                        "with, defaults to the number of cpus")
 
     args = parser.parse_args()
     if args.datadir:
@@ -521,10 +606,11 @@ if __name__ == '__main__':
 
     print('Parsing turning movement counts...')
     summary_file = os.path.join(PROCESSED_DATA_FP, 'tmc_summary.json')
-    if not path_exists(summary_file) or args.forceupdate:
+    if not path_exists(summary_file) or args.forceupdate \
+       or tmc_files_changed():
         print('Parsing tmc files...')
 
-        summary = parse_conflicts()
+        summary = parse_conflicts(args.processes)
         address_records = snap_inter_and_non_inter(summary)
 
         items = json.load(
@@ -1,9 +1,10 @@
 import argparse
 from . import util
-from shapely.ops import unary_union
 from shapely.geometry import Point
+import numpy as np
 import rtree
 import os
+from multiprocessing import Pool
 from .segment import Segment
 
 BASE_DIR = os.path.dirname(
@@ -14,6 +15,17 @@ BASE_DIR = os.path.dirname(
 PROCESSED_DATA_FP = None
 MAP_FP = None
 
+# Buffer sizes, in meters, to try matching segments at, smallest first
+BUFFERS = [5, 10, 20]
+
+# A buffer is a polygon approximating the area within the buffer
+# distance of a line, so a point a little closer than that distance can
+# still be outside it.  Points further than this fraction of the buffer
+# size from the edge are classified by distance; the rest are checked
+# against the buffer polygon
+INSIDE_RATIO = .98
+OUTSIDE_RATIO = 1.001
+
 
 def add_match_features(line, features):
     """
@@ -36,7 +48,139 @@ def add_match_features(line, features):
             line['properties'][feat] = 0
 
 
-def get_mapping(lines, features):
+def get_parts(geometry):
+    """
+    Get the coordinates of each part of a line
+    Args:
+        geometry - a LineString or MultiLineString
+    Returns:
+        list of arrays of shape (number of points, 2)
+    """
+    parts = geometry.geoms if hasattr(geometry, 'geoms') else [geometry]
+    coords = [np.asarray(part.coords) for part in parts]
+    return [part[:, :2] for part in coords if len(part)]
+
+
+def get_segments(parts):
+    """
+    Get the start and end points of each straight piece of a line
+    Args:
+        parts - the coordinates of each part of the line, from get_parts
+    Returns:
+        two arrays of shape (number of pieces, 2)
+    """
+    if not parts:
+        return np.empty((0, 2)), np.empty((0, 2))
+    starts = np.concatenate([part[:-1] for part in parts])
+    ends = np.concatenate([part[1:] for part in parts])
+    # A line with only one point still has a distance to other points
+    if not len(starts):
+        starts = ends = parts[0][:1]
+    return starts, ends
+
+
+def get_vertices(parts):
+    if not parts:
+        return np.empty((0, 2))
+    return np.concatenate(parts)
+
+
+def max_distance(points, starts, ends):
+    """
+    The distance of the furthest of a set of points from a line
+    Args:
+        points - array of shape (number of points, 2)
+        starts, ends - the pieces of the line, from get_segments
+    Returns:
+        float, 0 if there are no points
+    """
+    if not len(points):
+        return 0.
+    if not len(starts):
+        return np.inf
+    direction = ends - starts
+    length = (direction ** 2).sum(axis=1)
+    offset = points[:, np.newaxis, :] - starts[np.newaxis, :, :]
+    # Position of the closest point along each piece, from 0 to 1
+    position = np.clip((offset * direction).sum(axis=2) / np.where(
+        length > 0, length, 1), 0, 1)
+    closest = offset - position[:, :, np.newaxis] * direction
+    return np.sqrt((closest ** 2).sum(axis=2)).min(axis=1).max()
+
+
+def get_distances(line):
+    """
+    Distances between a line and each of its candidates
+    Args:
+        line - tuple of the line and its candidates' geometries
+    Returns:
+        two lists, the furthest any vertex of each candidate is from
+        the line, and the furthest any vertex of the line is from
+        each candidate
+    """
+    geometry, candidates = line
+    parts = get_parts(geometry)
+    vertices = get_vertices(parts)
+    starts, ends = get_segments(parts)
+
+    candidate_distances = []
+    line_distances = []
+    for candidate in candidates:
+        candidate_parts = get_parts(candidate)
+        candidate_distances.append(max_distance(
+            get_vertices(candidate_parts), starts, ends))
+        line_distances.append(max_distance(
+            vertices, *get_segments(candidate_parts)))
+    return candidate_distances, line_distances
+
+
+def add_distances(lines, processes=1):
+    """
+    Compute the distances used for matching every line to
+    its candidates, in parallel if processes > 1
+    Args:
+        lines - the lines, from get_candidates
+        processes - number of processes to use, None for all the cpus
+    Returns:
+        None, adds candidate_distances and line_distances to each line
+    """
+    args = [(line['line'], [c[0] for c in line['candidates']])
+            for line in lines]
+    if processes == 1:
+        distances = map(get_distances, args)
+    else:
+        with Pool(processes) as pool:
+            distances = pool.map(get_distances, args, chunksize=100)
+    for line, (candidate_distances, line_distances) in zip(
+            lines, distances):
+        line['candidate_distances'] = candidate_distances
+        line['line_distances'] = line_distances
+
+
+def within_buffer(coords, geometry, distance, buff, buffers):
+    """
+    Whether a set of points is within a buffer around a geometry
+    Args:
+        coords - the points
+        geometry - the geometry
+        distance - the furthest any of the points is from the geometry
+        buff - buffer size
+        buffers - dict of the geometry's buffers by size,
+            so each buffer is only made once
+    Returns:
+        boolean
+    """
+    if distance < buff * INSIDE_RATIO:
+        return True
+    if distance > buff * OUTSIDE_RATIO:
+        return False
+    # Close to the edge of the buffer, so check against the polygon
+    if buff not in buffers:
+        buffers[buff] = geometry.buffer(buff)
+    return all(Point(coord).within(buffers[buff]) for coord in coords)
+
+
+def get_mapping(lines, features, processes=1):
     """
     Attempts to map one or more segments of the second map to the first map
     Args:
@@ -44,71 +188,77 @@ def get_mapping(lines, features):
             the properties, the candidate overlapping lines from the new map,
             and nearby segments on the original map because we may want to
             combine two for the purposes of mapping
+        features - the features to add from the new map
+        processes - number of processes to compute distances with,
+            None for all the cpus
     """
     print(len(lines))
     result_counts = [0, 0]
-    buff = 5
+
+    # Distances between each line and its candidates are computed once,
+    # up front, then checked against each buffer size
+    add_distances(lines, processes)
+    line_buffers = [{} for _ in lines]
 
     # keep track of which new segments matched at which size buffer
     buff_match = {}
 
     new_id = 0
-    while buff <= 20:
+    for buff in BUFFERS:
         print("Looking at buffer " + str(buff))
-        for i in range(len(lines)):
+        for i, line in enumerate(lines):
             util.track(i, 1000, len(lines))
-            if 'matches' in list(lines[i].keys()):
+            if 'matches' in line:
                 continue
 
             matched_candidates = []
 
-            for j, candidate in enumerate(lines[i]['candidates']):
-                if 'id' not in list(lines[i]['candidates'][j][1].keys()):
-                    lines[i]['candidates'][j][1]['id'] = new_id
+            for j, candidate in enumerate(line['candidates']):
+                if 'id' not in candidate[1]:
+                    candidate[1]['id'] = new_id
                     new_id += 1
-                match = True
 
-                for coord in candidate[0].coords:
-                    if not Point(coord).within(lines[i]['line'].buffer(buff)):
-                        match = False
-                if match:
+                if within_buffer(candidate[0].coords, line['line'],
+                                 line['candidate_distances'][j], buff,
+                                 line_buffers[i]):
                     matched_candidates.append((candidate, buff))
 
-                    if lines[i]['candidates'][j][1]['id'] \
-                       not in list(buff_match.keys()):
-                        buff_match[lines[i]['candidates'][j][1]['id']] = buff
+                    if candidate[1]['id'] not in buff_match:
+                        buff_match[candidate[1]['id']] = buff
 
             if matched_candidates:
-                lines[i]['matches'] = matched_candidates
+                line['matches'] = matched_candidates
+
+    # Subset matches are recorded in buff_match at the next size up
+    buff = BUFFERS[-1] * 2
 
-        buff *= 2
-    
     # Now go through the lines that still aren't matched
     # this time, see if they are a subset of any of their candidates
-    for i in range(len(lines)):
+    for line in lines:
         matched_candidates = []
-        if 'matches' in list(lines[i].keys()):
+        if 'matches' in line:
             continue
-        for j, candidate in enumerate(lines[i]['candidates']):
-            if 'id' not in list(lines[i]['candidates'][j][1].keys()):
-                lines[i]['candidates'][j][1]['id'] = new_id
+        for j, candidate in enumerate(line['candidates']):
+            if 'id' not in candidate[1]:
+                candidate[1]['id'] = new_id
                 new_id += 1
 
-            match = True
-            for coord in lines[i]['line'].coords:
-                if not Point(coord).within(candidate[0].buffer(20)):
-                    match = False
-            if match:
-                matched_candidates.append((candidate, 20))
-                if lines[i]['candidates'][j][1]['id'] not in list(buff_match.keys()):
-                    buff_match[lines[i]['candidates'][j][1]['id']] = buff
+            if within_buffer(line['line'].coords, candidate[0],
+                             line['line_distances'][j], BUFFERS[-1], {}):
+                matched_candidates.append((candidate, BUFFERS[-1]))
+                if candidate[1]['id'] not in buff_match:
+                    buff_match[candidate[1]['id']] = buff
         if matched_candidates:
-            lines[i]['matches'] = matched_candidates
+            line['matches'] = matched_candidates
+
+    for line in lines:
+        del line['candidate_distances']
+        del line['line_distances']
 
     # Remove matches that matched better on a different segment
     # But only if there's a match for that segment already
     for i in range(len(lines)):
-        if 'matches' in list(lines[i].keys()):
+        if 'matches' in lines[i]:
             matches = lines[i]['matches']
             new_matches = []
             for (m, buff) in matches:
@@ -123,7 +273,7 @@ def get_mapping(lines, features):
     orig = []
     matched = []
     for i, line in enumerate(lines):
-        if 'matches' in list(line.keys()) and line['matches']:
+        if 'matches' in line and line['matches']:
             result_counts[0] += 1
             
             orig.append((line['line'], line['properties']))
@@ -146,6 +296,33 @@ def get_mapping(lines, features):
     print('Found matches for ' + str(percent_matched) + '% of segments')
 
 
+def get_overlap(line_buffer, buffer, best_overlap=0):
+    """
+    How much two buffers overlap: the larger buffer's area as a fraction
+    of the area of their union
+    Args:
+        line_buffer, buffer - tuples of a buffer, its area and its bounds
+        best_overlap - skip working out the overlap if it can't be
+            more than this
+    Returns:
+        overlap from 0 to 1, or None if it can't be more than best_overlap
+    """
+    line_buffer, line_area, (minx1, miny1, maxx1, maxy1) = line_buffer
+    buffer, buffer_area, (minx2, miny2, maxx2, maxy2) = buffer
+    larger = max(line_area, buffer_area)
+
+    # The buffers can't overlap by more than their bounding boxes do
+    max_shared = min(
+        line_area, buffer_area,
+        max(min(maxx1, maxx2) - max(minx1, minx2), 0)
+        * max(min(maxy1, maxy2) - max(miny1, miny2), 0))
+    if larger <= best_overlap * (line_area + buffer_area - max_shared):
+        return None
+
+    shared = line_buffer.intersection(buffer).area
+    return larger / (line_area + buffer_area - shared)
+
+
 def get_int_mapping(lines, buffered, buffered_index):
     """
     Gets the mappings between intersections
@@ -156,24 +333,43 @@ def get_int_mapping(lines, buffered, buffered_index):
     """
     print("Getting intersection mappings")
 
+    # Areas and bounds of the other map's buffers, which are compared
+    # to every line they're near
+    buffers = {}
+
     line_results = []
     # Go through each line from the osm map
     for i, line in enumerate(lines):
         util.track(i, 1000, len(lines))
-        line_buffer = line.geometry.buffer(10)
+
+        # If the new buffered intersection intersects the old one, it's
+        # a candidate. Any buffer that intersects the line overlaps the
+        # line's bounds, so there's no need to buffer the line first
+        candidates = [
+            idx for idx in buffered_index.intersection(line.geometry.bounds)
+            if buffered[idx][0].intersects(line.geometry)]
 
         best_match = {}
         best_overlap = 0
-        for idx in buffered_index.intersection(line_buffer.bounds):
-            buffer = buffered[idx][0]
-            # If the new buffered intersection intersects the old one
-            # figure out how much overlap, and take the best one
-            if buffer.intersects(line.geometry):
-                total_area = unary_union([line_buffer, buffer]).area
-                overlap = max(
-                    line_buffer.area/total_area, buffer.area/total_area)
-                
-                if overlap > best_overlap and overlap > .20:
+        # Two buffers always overlap by at least half, so a lone
+        # candidate is the best match without working out the overlap
+        if len(candidates) == 1:
+            best_match = buffered[candidates[0]][2]
+
+        elif candidates:
+            line_buffer = line.geometry.buffer(10)
+            line_buffer = (line_buffer, line_buffer.area, line_buffer.bounds)
+
+            # Figure out how much overlap, and take the best one
+            for idx in candidates:
+                if idx not in buffers:
+                    buffer = buffered[idx][0]
+                    buffers[idx] = (buffer, buffer.area, buffer.bounds)
+                overlap = get_overlap(
+                    line_buffer, buffers[idx], best_overlap)
+
+                if overlap is not None and overlap > best_overlap \
+                   and overlap > .20:
                     best_overlap = overlap
                     best_match = buffered[idx][2]
 
@@ -275,6 +471,9 @@ if __name__ == '__main__':
     parser.add_argument("-features", "--features", nargs="+", default=[
         'AADT', 'SPEEDLIMIT', 'Struct_Cnd', 'Surface_Tp', 'F_F_Class'],
         help="List of segment features to include")
+    parser.add_argument("-p", "--processes", type=int,
+                        help="Number of processes to match segments " +
+                        "with, defaults to the number of cpus")
 
     args = parser.parse_args()
     
@@ -308,7 +507,7 @@ if __name__ == '__main__':
         new_buffered, new_index, osm_map_non_inter)
 
     print("Adding features: " + ','.join(feats))
-    get_mapping(non_ints_with_candidates, feats)
+    get_mapping(non_ints_with_candidates, feats, args.processes)
 
     non_inters = [Segment(x['line'], x['properties'])
                   for x in non_ints_with_candidates]
@@ -1,5 +1,6 @@
 import argparse
 from . import util
+from . import instrument
 import os
 import json
 import geojson
@@ -72,7 +73,8 @@ def get_features(waze_info, properties, num_snapshots):
     return properties
 
 
-def add_alerts(items, road_segments):
+@instrument.traced
+def add_alerts(items, road_segments, processes=1):
 
     roads, roads_index = util.index_segments(
         road_segments, geojson=True, segment=True)
@@ -82,7 +84,7 @@ def add_alerts(items, road_segments):
              if x['eventType'] == 'alert']
 
     util.find_nearest(
-        items, roads, roads_index, 30, type_record=True)
+        items, roads, roads_index, 30, type_record=True, processes=processes)
 
     # Turn records into a dict
     items_dict = defaultdict(dict)
@@ -102,13 +104,15 @@ def add_alerts(items, road_segments):
     return road_segments
 
 
-def map_segments(datadir, filename, forceupdate=False):
+def map_segments(datadir, filename, forceupdate=False, processes=1):
     """
     Map a set of waze segment info (jams) onto segments drawn from
     openstreetmap: the osm_elements.geojson file
     Args:
         datadir - directory where the city's data is found
         filename - the filename of the json aggregated waze file
+        processes - number of processes to snap alerts with,
+            None for all the cpus
     Returns:
         nothing - just updates osm_elements.geojson and writes
             a jams.geojson with the segments that have jams
@@ -132,7 +136,7 @@ def map_segments(datadir, filename, forceupdate=False):
     # Add jam and alert information
     road_segments, roads_with_jams = add_jams(
         items, road_segments, inters, num_snapshots)
-    road_segments = add_alerts(items, road_segments)
+    road_segments = add_alerts(items, road_segments, processes)
 
     # Convert into format that util.prepare_geojson is expecting
     geojson_roads = []
@@ -168,6 +172,7 @@ def map_segments(datadir, filename, forceupdate=False):
         geojson.dump(jam_results, outfile)
 
 
+@instrument.traced
 def add_jams(items, road_segments, inters, num_snapshots):
 
     # Only look at jams for now
@@ -219,6 +224,7 @@ def add_jams(items, road_segments, inters, num_snapshots):
                     # or very short overlaps
                     continue
                 waze_info[segment.properties['segment_id']].append(item)
+                instrument.count('jams_matched')
     # Add waze features
     roads_with_jams = []
 
@@ -237,6 +243,8 @@ def add_jams(items, road_segments, inters, num_snapshots):
                     },
                     'properties': properties
             })
+    instrument.count('jams', len(items))
+    instrument.count('segments_with_jams', len(roads_with_jams))
     return road_segments, roads_with_jams
 
 
@@ -267,9 +275,13 @@ if __name__ == '__main__':
                         help="data directory")
     parser.add_argument('--forceupdate', action='store_true',
                         help='Whether to force update of the waze data')
+    parser.add_argument("-p", "--processes", type=int, default=1,
+                        help="Number of processes to snap alerts " +
+                        "with, defaults to 1")
 
     args = parser.parse_args()
 
     infile = os.path.join(args.datadir, 'standardized', 'waze.json')
 #    make_map(infile, os.path.join(args.datadir, 'processed', 'maps'))
-    map_segments(args.datadir, infile, forceupdate=args.forceupdate)
+    map_segments(args.datadir, infile, forceupdate=args.forceupdate,
+                 processes=args.processes)
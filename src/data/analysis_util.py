@@ -57,7 +57,7 @@ def summary_concern_counts(crashes, concerns):
     total_concerns = 0
     for seg_id, d in concerns.items():
         total_concerns += d['count']
-        if d['count'] not in list(matching.keys()):
+        if d['count'] not in matching:
             matching[d['count']] = {
                 'inter': {'crash': 0, 'no_crash': 0},
                 'non_inter': {'crash': 0, 'no_crash': 0}
@@ -71,7 +71,7 @@ def summary_concern_counts(crashes, concerns):
             non_inter_total += d['count']
             non_inter_loc += 1
 
-        if seg_id in list(crashes.keys()):
+        if seg_id in crashes:
             matching[d['count']][key]['crash'] += 1
         else:
             matching[d['count']][key]['no_crash'] += 1
@@ -91,38 +91,38 @@ def summary_concern_counts(crashes, concerns):
 
 def concern_percentages(concern_summary):
 
+    # Running totals from the highest number of concerns down, so the
+    # counts for each number of concerns include every location with
+    # that many or more
+    counts = {
+        'total': 0,
+        'crashes': 0,
+        'inters_total': 0,
+        'inters_crashes': 0,
+        'non_inters_total': 0,
+        'non_inters_crashes': 0,
+    }
+    cumulative = {}
+    for key, value in sorted(
+            concern_summary, key=lambda x: x[0], reverse=True):
+        counts['total'] += value['inter']['crash'] \
+            + value['inter']['no_crash'] \
+            + value['non_inter']['crash'] \
+            + value['non_inter']['no_crash']
+        counts['crashes'] += value['inter']['crash'] \
+            + value['non_inter']['crash']
+        counts['inters_total'] += value['inter']['crash'] \
+            + value['inter']['no_crash']
+        # Count of intersections with a concern
+        counts['inters_crashes'] += value['inter']['crash']
+        counts['non_inters_total'] += value['non_inter']['crash'] \
+            + value['non_inter']['no_crash']
+        counts['non_inters_crashes'] += value['non_inter']['crash']
+        cumulative[key] = dict(counts)
+
     results = []
-    for key, value in concern_summary:
-        # Do the 1+,2+ stats as well as 1, 2
-        # Still need to break it out by int/non-int
-        counts = {
-            'total': value['inter']['crash'] + value['inter']['no_crash']
-            + value['non_inter']['crash'] + value['non_inter']['no_crash'],
-            'crashes': value['inter']['crash'] + value['non_inter']['crash'],
-            'inters_total': value['inter']['crash'] + value['inter']['no_crash'],
-            # Count of intersections with a concern
-            'inters_crashes': value['inter']['crash'],
-            'non_inters_total': value['non_inter']['crash']
-            + value['non_inter']['no_crash'],
-            'non_inters_crashes':  value['non_inter']['crash'],
-        }
-        # Add all the data for segments with more complaints
-        # than the current complaint we're on
-        for key2, value2 in concern_summary[key:len(concern_summary)]:
-
-            if key2 > key:
-                counts['total'] += value2['inter']['crash'] \
-                    + value2['inter']['no_crash'] \
-                    + value2['non_inter']['crash'] \
-                    + value2['non_inter']['no_crash']
-                counts['crashes'] += value2['inter']['crash'] \
-                    + value2['non_inter']['crash']
-                counts['inters_total'] += value2['inter']['crash'] \
-                    + value2['inter']['no_crash']
-                counts['inters_crashes'] += value2['inter']['crash']
-                counts['non_inters_total'] += value2['non_inter']['crash'] \
-                    + value2['non_inter']['no_crash']
-                counts['non_inters_crashes'] += value2['non_inter']['crash']
+    for key, _ in concern_summary:
+        counts = cumulative[key]
         total_percent_v0 = round(100 * float(counts['crashes'])
                                  / float(counts['total']))
         inter_percent_v0 = round(100 * float(counts['inters_crashes'])
@@ -156,8 +156,7 @@ def concern_counts_by_type(
     locations = {}
     for concern in concern_data:
 
-        if concern['near_id'] not in list(locations.keys()):
-            locations[concern['near_id']] = {}
+        seen = locations.setdefault(concern['near_id'], set())
 
         request = concern[category_field]
         # Clean up badly formatted request types
@@ -165,7 +164,7 @@ def concern_counts_by_type(
         if len(vals) > 1:
             request = vals[1]
 
-        if request not in list(requests.keys()):
+        if request not in requests:
             requests[request] = {
                 'crashes': 0,
                 'total': 0,
@@ -178,28 +177,26 @@ def concern_counts_by_type(
         # Only count this request if we haven't seen it in this location
         # before.  We might eventually want to count the number of certain
         # types of requests, but not doing that here
-        if request not in list(locations[concern['near_id']].keys()):
+        if request not in seen:
+            seen.add(request)
+            crash = str(concern['near_id']) in crashes
 
             # count totals
-            if str(concern['near_id']) in list(crashes.keys()):
+            if crash:
                 requests[request]['crashes'] += 1
             requests[request]['total'] += 1
 
             # count intersection totals
             if is_inter(concern['near_id']):
-                if str(concern['near_id']) in list(crashes.keys()):
+                if crash:
                     requests[request]['inter_crashes'] += 1
                 requests[request]['inter_total'] += 1
             # count non-intersection totals
             else:
-                if str(concern['near_id']) in list(crashes.keys()):
+                if crash:
                     requests[request]['non_inter_crashes'] += 1
                 requests[request]['non_inter_total'] += 1
 
-        if request not in list(locations[concern['near_id']].keys()):
-            locations[concern['near_id']][request] = 0
-        locations[concern['near_id']][request] += 1
-
     return requests
 
 
@@ -45,6 +45,20 @@ class Configuration(object):
                or config['map_geography'] != 'shapefile':
                 sys.exit('If boundary_shapefile is set, map_geography must be shapefile')
 
+        # Optional local .osm.pbf extract (in the raw maps directory)
+        # to build the road network from, instead of downloading it
+        if 'osm_extract' in config and config['osm_extract']:
+            self.osm_extract = config['osm_extract']
+        else:
+            self.osm_extract = None
+
+        # Optional number of crashes to snap to segments at a time,
+        # to limit memory use on large crash files
+        if 'crash_chunksize' in config and config['crash_chunksize']:
+            self.crash_chunksize = int(config['crash_chunksize'])
+        else:
+            self.crash_chunksize = None
+
         self.default_features, self.categorical_features, \
             self.continuous_features = self.get_feature_list(config)
 
@@ -11,6 +11,7 @@ import copy
 from shapely.ops import unary_union
 from collections import defaultdict
 from . import util
+from . import instrument
 import argparse
 import os
 import re
@@ -278,10 +279,11 @@ def find_non_ints(roads, int_buffers):
     return non_int_lines, inter_segments
 
 
+@instrument.traced
 def add_point_based_features(non_inters, inters, jsonfile,
                              feats_filename=None,
                              additional_feats_filename=None,
-                             forceupdate=False):
+                             forceupdate=False, processes=1):
     """
     Add any point-based set of features to existing segment data.
     If it isn't already attached to the segments
@@ -293,6 +295,8 @@ def add_point_based_features(non_inters, inters, jsonfile,
         addtiional_feats_filename (optional) - file for additional
             points-based data, in json format
         forceupdate - if True, re-snap points and write to file
+        processes - number of processes to snap points with,
+            None for all the cpus
     """
 
     if forceupdate or not os.path.exists(jsonfile):
@@ -307,7 +311,8 @@ def add_point_based_features(non_inters, inters, jsonfile,
             inters + non_inters, geojson=False, segment=True
         )
 
-        util.find_nearest(features, seg, segments_index, 20, type_record=True)
+        util.find_nearest(features, seg, segments_index, 20,
+                          type_record=True, processes=processes)
 
         # Dump to file
         print("output {} point-based features to {}".format(
@@ -318,6 +323,7 @@ def add_point_based_features(non_inters, inters, jsonfile,
     else:
         features = util.read_records(jsonfile, None)
         print("Read {} point-based features from file".format(len(features)))
+    instrument.count('points', len(features))
     matches = {}
 
     aggregation_values = defaultdict(dict)
@@ -464,6 +470,7 @@ def get_non_intersection_name(non_inter_segment, inters_by_id):
     return segment_street
 
 
+@instrument.traced
 def create_segments_from_json(roads_shp_path, mapfp):
     print(roads_shp_path)
     roads, inter_nodes = util.get_roads_and_inters(roads_shp_path)
@@ -546,6 +553,9 @@ def create_segments_from_json(roads_shp_path, mapfp):
         intersection.data = segment_data
         union_inter.append(intersection)
 
+    instrument.count('roads', len(roads))
+    instrument.count('intersections', len(union_inter))
+    instrument.count('non_intersections', len(non_int_w_ids))
     return non_int_w_ids, union_inter
 
 
@@ -589,6 +599,9 @@ if __name__ == '__main__':
                         "within the maps directory")
     parser.add_argument('--forceupdate', action='store_true',
                         help='Whether to force update the points-based data')
+    parser.add_argument("-p", "--processes", type=int, default=1,
+                        help="Number of processes to snap point-based " +
+                        "features with, defaults to 1")
 
     args = parser.parse_args()
     DATA_FP = args.datadir
@@ -624,7 +637,8 @@ if __name__ == '__main__':
             jsonfile,
             feats_filename=feats_file,
             additional_feats_filename=additional_feats_file,
-            forceupdate=args.forceupdate
+            forceupdate=args.forceupdate,
+            processes=args.processes
         )
     config = data.config.Configuration(args.config)
     
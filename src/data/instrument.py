@@ -0,0 +1,323 @@
+# Spans and counters, for seeing where the time goes in a pipeline run
+# A span times a stage, or a step within a stage, recording its wall and
+# cpu time, peak memory and any counters (records snapped, segments built,
+# etc.), and is written as a json line to the run's trace file when it ends.
+# The trace file, run id and enclosing span are passed on to stages run as
+# subprocesses in environment variables, so the spans from pipeline.py,
+# make_dataset.py and each stage all end up in the same file.
+# When no trace file is set (e.g. running a stage by itself, or in tests),
+# nothing is written.
+# Stages can also be run under a profiler (see profiling.py), by naming
+# them in start_profiling; this is passed on to subprocesses the same way.
+# Only uses the standard library, so any module can import it.
+
+import argparse
+import datetime
+import functools
+import json
+import os
+import subprocess
+import sys
+import time
+import uuid
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # Not available on windows, where memory and child cpu time
+    # aren't recorded
+    resource = None
+
+TRACE_FILE = 'CRASH_MODEL_TRACE'
+RUN_ID = 'CRASH_MODEL_RUN'
+PARENT_SPAN = 'CRASH_MODEL_SPAN'
+PROFILE_STAGES = 'CRASH_MODEL_PROFILE'
+PROFILE_DIR = 'CRASH_MODEL_PROFILE_DIR'
+PROFILE_SAMPLING = 'CRASH_MODEL_PROFILE_SAMPLING'
+
+# Spans open in this process, innermost last
+_spans = []
+
+
+class Span(object):
+    """
+    A named, timed step, with counters
+    """
+
+    def __init__(self, name, parent=None):
+        self.name = name
+        self.id = uuid.uuid4().hex[:12]
+        self.parent = parent
+        self.counters = {}
+        # Resource usage of a subprocess run in this span,
+        # recorded instead of this process's
+        self.child_usage = None
+
+    def count(self, name, value=1):
+        """
+        Add to one of the span's counters
+        """
+        self.counters[name] = self.counters.get(name, 0) + value
+
+
+def max_rss(usage):
+    """
+    Peak resident memory in MB from a resource usage
+    (ru_maxrss is in kilobytes on linux)
+    """
+    return round(usage.ru_maxrss / 1024.0, 1)
+
+
+def cpu_time(usage):
+    return usage.ru_utime + usage.ru_stime
+
+
+def write(record):
+    """
+    Add a record to the trace file, if there is one
+    Each record is written with a single append, so records from
+    stages running at the same time don't get mixed together
+    """
+    filename = os.environ.get(TRACE_FILE)
+    if not filename:
+        return
+    with open(filename, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+@contextmanager
+def span(name):
+    """
+    Time a step, e.g.
+        with instrument.span('snap_records') as s:
+            ...
+            s.count('records', len(records))
+    Spans opened inside this one (including in subprocesses
+    started with check_call) are recorded as its children
+    """
+    parent = _spans[-1].id if _spans else os.environ.get(PARENT_SPAN)
+    current = Span(name, parent)
+    _spans.append(current)
+
+    start = datetime.datetime.now()
+    wall = time.time()
+    usage = resource.getrusage(resource.RUSAGE_SELF) if resource else None
+    status = 'ok'
+    try:
+        yield current
+    except BaseException:
+        status = 'error'
+        raise
+    finally:
+        _spans.pop()
+        record = {
+            'run': os.environ.get(RUN_ID),
+            'id': current.id,
+            'parent': current.parent,
+            'name': name,
+            'pid': os.getpid(),
+            'start': start.isoformat(),
+            'wall': round(time.time() - wall, 3),
+            'cpu': None,
+            'max_rss_mb': None,
+            'counters': current.counters,
+            'status': status,
+        }
+        if current.child_usage:
+            record['cpu'] = round(cpu_time(current.child_usage), 3)
+            record['max_rss_mb'] = max_rss(current.child_usage)
+        elif usage:
+            end_usage = resource.getrusage(resource.RUSAGE_SELF)
+            record['cpu'] = round(cpu_time(end_usage) - cpu_time(usage), 3)
+            # Peak for the process so far, which includes this span
+            record['max_rss_mb'] = max_rss(end_usage)
+        write(record)
+
+
+def traced(func):
+    """
+    Decorator to record every call to a function as a span
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with span(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def count(name, value=1):
+    """
+    Add to a counter of the innermost open span, if there is one
+    """
+    if _spans:
+        _spans[-1].count(name, value)
+
+
+def stage_name(args):
+    """
+    Name a subprocess after the module it runs, e.g.
+    ['python', '-m', 'data.create_segments', ...] -> data.create_segments
+    """
+    if '-m' in args and args.index('-m') + 1 < len(args):
+        return args[args.index('-m') + 1]
+    return os.path.basename(args[0])
+
+
+def profile_args(args, span_id):
+    """
+    If the module a command runs is one of the stages being profiled,
+    run it under data.profiling instead, writing to the profiles
+    directory, e.g. profiles/create_segments-<span id>.prof
+    Stages are matched on the full or last part of the module name,
+    so data.create_segments can be given as create_segments
+    Args:
+        args - command to run
+        span_id - id of the stage's span, to tell apart the profiles
+            of a stage that's run more than once
+    Returns:
+        the command to run
+    """
+    stages = os.environ.get(PROFILE_STAGES)
+    if not stages or '-m' not in args:
+        return args
+    index = args.index('-m')
+    module = args[index + 1]
+    short_name = module.split('.')[-1]
+    if not set([module, short_name]) & set(stages.split(',')):
+        return args
+
+    prefix = os.path.join(
+        os.environ[PROFILE_DIR], '{}-{}'.format(short_name, span_id))
+    print("Profiling {} to {}".format(module, prefix))
+    profile = ['-m', 'data.profiling', '-o', prefix]
+    if os.environ.get(PROFILE_SAMPLING):
+        profile.append('--sampling')
+    return args[:index] + profile + args[index + 1:]
+
+
+def check_call(args, name=None):
+    """
+    Run a stage in a subprocess, like subprocess.check_call, in a span
+    that records the subprocess's cpu time and peak memory
+    Args:
+        args - command to run
+        name - name of the span, defaults to the module being run
+    """
+    with span(name or stage_name(args)) as current:
+        env = dict(os.environ)
+        env[PARENT_SPAN] = current.id
+        process = subprocess.Popen(profile_args(args, current.id), env=env)
+        if hasattr(os, 'wait4'):
+            _, status, current.child_usage = os.wait4(process.pid, 0)
+            process.returncode = os.WEXITSTATUS(status) \
+                if os.WIFEXITED(status) else -os.WTERMSIG(status)
+        else:
+            process.wait()
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, args)
+
+
+def start_run(datadir):
+    """
+    Start writing spans to a new trace file in the city's data directory,
+    unless this process is already part of a run, e.g. make_dataset.py
+    started by pipeline.py
+    Args:
+        datadir - the city's data directory
+    Returns:
+        the trace file
+    """
+    if os.environ.get(TRACE_FILE):
+        return os.environ[TRACE_FILE]
+
+    run_id = datetime.datetime.now().strftime('%Y%m%dT%H%M%S') + \
+        '-' + uuid.uuid4().hex[:6]
+    trace_dir = os.path.join(datadir, 'traces')
+    if not os.path.exists(trace_dir):
+        os.makedirs(trace_dir)
+
+    os.environ[RUN_ID] = run_id
+    os.environ[TRACE_FILE] = os.path.join(trace_dir, run_id + '.jsonl')
+    return os.environ[TRACE_FILE]
+
+
+def start_profiling(datadir, stages, sampling=False):
+    """
+    Profile the given stages when they're run with check_call, here or
+    in subprocesses, writing to the profiles directory in the city's
+    data directory
+    Args:
+        datadir - the city's data directory
+        stages - comma separated modules, e.g. create_segments,train_model
+        sampling - sample the stack instead of using cProfile
+    """
+    os.environ[PROFILE_STAGES] = stages
+    os.environ[PROFILE_DIR] = os.path.abspath(
+        os.path.join(datadir, 'profiles'))
+    if sampling:
+        os.environ[PROFILE_SAMPLING] = '1'
+
+
+def read_trace(filename):
+    """
+    Read the spans from a trace file
+    """
+    with open(filename) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def summarize(spans):
+    """
+    Order spans as a tree, each followed by the spans inside it
+    Args:
+        spans - list of span records
+    Returns:
+        list of (depth, span)
+    """
+    ids = set(x['id'] for x in spans)
+    children = {}
+    for record in sorted(spans, key=lambda x: x['start']):
+        parent = record['parent'] if record['parent'] in ids else None
+        children.setdefault(parent, []).append(record)
+
+    rows = []
+    stack = [(0, x) for x in reversed(children.get(None, []))]
+    while stack:
+        depth, record = stack.pop()
+        rows.append((depth, record))
+        stack.extend((depth + 1, x)
+                     for x in reversed(children.get(record['id'], [])))
+    return rows
+
+
+def print_summary(filename):
+    """
+    Print a table of the spans in a trace file
+    """
+    rows = summarize(read_trace(filename))
+    print("{:<50} {:>9} {:>9} {:>9}  {}".format(
+        'span', 'wall (s)', 'cpu (s)', 'peak MB', 'counters'))
+    for depth, record in rows:
+        name = '  ' * depth + record['name']
+        if record['status'] != 'ok':
+            name += ' (' + record['status'] + ')'
+        print("{:<50} {:>9} {:>9} {:>9}  {}".format(
+            name[:50],
+            '{:.2f}'.format(record['wall']),
+            '' if record['cpu'] is None else '{:.2f}'.format(record['cpu']),
+            '' if record['max_rss_mb'] is None else record['max_rss_mb'],
+            ', '.join('{}={}'.format(k, v)
+                      for k, v in sorted(record['counters'].items()))))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("trace", type=str,
+                        help="Trace file from a pipeline run, in the " +
+                        "traces directory of the city's data directory")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.trace):
+        sys.exit("No trace file found at {}".format(args.trace))
+    print_summary(args.trace)
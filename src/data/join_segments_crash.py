@@ -8,9 +8,11 @@
 
 import json
 from . import util
+from . import instrument
+from .record import Crash
 import os
 import argparse
-from shapely.geometry import Point
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 import data.config
@@ -27,9 +29,10 @@ RAW_DATA_FP = os.path.join(BASE_DIR, 'data/standardized')
 PROCESSED_DATA_FP = os.path.join(BASE_DIR, 'data/processed')
 
 
+@instrument.traced
 def snap_records(
         combined_seg, segments_index, infile,
-        startyear=None, endyear=None):
+        startyear=None, endyear=None, processes=1):
 
     print("reading crash data...")
     records = util.read_records(infile, 'crash', startyear, endyear)
@@ -37,10 +40,13 @@ def snap_records(
     # Find nearest crashes - 30 tolerance
     print("snapping crash records to segments")
     util.find_nearest(
-        records, combined_seg, segments_index, 30, type_record=True)
+        records, combined_seg, segments_index, 30, type_record=True,
+        processes=processes)
     record_num = len(records)
     records = [x for x in records if x.near_id]
     dropped_records = record_num - len(records)
+    instrument.count('crashes', record_num)
+    instrument.count('crashes_dropped', dropped_records)
     if dropped_records:
         print("Dropped {} crashes that don't map to a segment".format(dropped_records))
         print("{} crashes remain".format(len(records)))
@@ -52,6 +58,169 @@ def snap_records(
         json.dump([r.properties for r in records], f)
 
 
+@instrument.traced
+def snap_records_chunked(
+        combined_seg, segments_index, infile, chunksize,
+        startyear=None, endyear=None, processes=1):
+    """
+    Snap crashes to segments chunksize crashes at a time, so memory use
+    doesn't grow with the number of crashes
+    Each chunk is read from the standardized crash file, snapped and
+    written out before the next is read.  The output is the same json
+    list that snap_records writes, with one crash per line
+    Args:
+        combined_seg - segments
+        segments_index - spatial index of the segments
+        infile - standardized crash file
+        chunksize - number of crashes to snap at a time
+        startyear - optionally skip crashes before this date
+        endyear - optionally skip crashes after this date
+        processes - number of processes to snap each chunk with,
+            None for all the cpus
+    """
+    jsonfile = os.path.join(PROCESSED_DATA_FP, 'crash_joined.json')
+    print("snapping crash records to segments, {} at a time".format(
+        chunksize))
+    print("output crash data to " + jsonfile)
+
+    record_num = 0
+    snapped = 0
+    with open(jsonfile, 'w') as f:
+        f.write('[')
+        for chunk in util.chunks(util.iter_json_list(infile), chunksize):
+            records = util.filter_by_date(
+                [Crash(x) for x in chunk], startyear, endyear)
+            util.find_nearest(
+                records, combined_seg, segments_index, 30,
+                type_record=True, processes=processes)
+            records = [x for x in records if x.near_id]
+            if records:
+                f.write(',\n' if snapped else '\n')
+                f.write(',\n'.join(json.dumps(x.properties) for x in records))
+            record_num += len(chunk)
+            snapped += len(records)
+            print("snapped {} of {} crashes read".format(snapped, record_num))
+        f.write('\n]\n')
+
+    instrument.count('crashes', record_num)
+    instrument.count('crashes_dropped', record_num - snapped)
+    if record_num - snapped:
+        print("Dropped {} crashes that are out of the date range or "
+              "don't map to a segment".format(record_num - snapped))
+        print("{} crashes remain".format(snapped))
+
+
+def read_crash_table(crashes_json, split_columns=[]):
+    """
+    Get the columns of the crashes needed for the rollup
+    Args:
+        crashes_json - a list of standardized crashes
+        split_columns - a list of split columns
+    Returns:
+        dataframe with longitude, latitude, date and a boolean
+        column per split column
+    """
+    columns = ['longitude', 'latitude', 'date'] + split_columns
+    table = pd.DataFrame({
+        'longitude': [x['location']['longitude'] for x in crashes_json],
+        'latitude': [x['location']['latitude'] for x in crashes_json],
+        'date': [x['dateOccurred'] for x in crashes_json],
+    }, columns=columns[:3])
+    for column in split_columns:
+        table[column] = [column in x for x in crashes_json]
+    return table[columns]
+
+
+def read_crash_table_chunked(filename, split_columns=[], chunksize=10000):
+    """
+    Get the crash table from a file of crashes, chunksize crashes at
+    a time, so only the table's columns are kept in memory
+    Args:
+        filename - json file of a list of standardized crashes
+        split_columns - a list of split columns
+        chunksize - number of crashes to read at a time
+    Returns:
+        dataframe, as from read_crash_table
+    """
+    tables = [read_crash_table(chunk, split_columns) for chunk in
+              util.chunks(util.iter_json_list(filename), chunksize)]
+    if not tables:
+        return read_crash_table([], split_columns)
+    return pd.concat(tables, ignore_index=True)
+
+
+def join_dates(crashes):
+    """
+    Get the unique dates of the crashes at each location, sorted and
+    joined into a comma-separated string
+    Args:
+        crashes - dataframe with location and date columns
+    Returns:
+        series indexed by location
+    """
+    dates = crashes[['location', 'date']].drop_duplicates().sort_values(
+        ['location', 'date'])
+    location = dates['location'].values
+    if not len(location):
+        return pd.Series([], dtype=object)
+
+    # Split the sorted dates into one array per location,
+    # at the points where the location changes
+    starts = np.flatnonzero(np.r_[True, location[1:] != location[:-1]])
+    return pd.Series(
+        [','.join(x) for x in np.split(dates['date'].values, starts[1:])],
+        index=location[starts])
+
+
+def rollup_locations(crashes, locations):
+    """
+    Count the crashes and list their unique dates at each location
+    Args:
+        crashes - dataframe of crashes with location and date columns
+        locations - dataframe of longitude and latitude, indexed by location
+    Returns:
+        dataframe with longitude, latitude, total_crashes and crash_dates,
+        indexed by location, in the order the locations first appear
+    """
+    counts = crashes.groupby('location', sort=False).size()
+    rollup = locations.loc[counts.index, ['longitude', 'latitude']]
+    rollup['total_crashes'] = counts.values
+    rollup['crash_dates'] = join_dates(crashes)[counts.index].values
+    return rollup
+
+
+def rollup_table(crashes, split_columns=[]):
+    """
+    Roll up crashes by location, for all crashes and each split column
+    The crashes are grouped by location once, and each rollup is an
+    aggregation over that grouping.  The rollup of all crashes also
+    gets total_crashes_<column> and crash_dates_<column> for each
+    split column, so one file can be used for every split column
+    Args:
+        crashes - dataframe from read_crash_table
+        split_columns - a list of split columns
+    Returns:
+        dict of dataframes, keyed by 'all' and each split column, with
+        longitude, latitude, total_crashes and crash_dates columns
+    """
+    crashes = crashes.copy()
+    crashes['location'] = crashes.groupby(
+        ['longitude', 'latitude'], sort=False).ngroup()
+    locations = crashes.drop_duplicates('location').set_index('location')
+
+    rollups = {'all': rollup_locations(crashes, locations)}
+    for column in split_columns:
+        split = rollup_locations(crashes[crashes[column]], locations)
+        rollups['all']['total_crashes_' + column] = split[
+            'total_crashes'].reindex(rollups['all'].index, fill_value=0)
+        rollups['all']['crash_dates_' + column] = split[
+            'crash_dates'].reindex(rollups['all'].index).fillna('')
+        rollups[column] = split
+
+    return {crash_type: rollup.reset_index(drop=True)
+            for crash_type, rollup in rollups.items()}
+
+
 def make_crash_rollup(crashes_json, split_columns=[]):
     """
     Generates a GeoDataframe with the total number of crashes, number of bike,
@@ -69,51 +238,55 @@ def make_crash_rollup(crashes_json, split_columns=[]):
             - list of unique dates that crashes occurred
             - GeoJSON point features created from the latitude and longitude
     """
-
-    crash_locations = {
-        'all': {}
-    }
-    for column in split_columns:
-        crash_locations[column] = {}
-
-    # Make multiple crash rollup files
-    for crash in crashes_json:
-        loc = (crash['location']['longitude'], crash['location']['latitude'])
-
-        if loc not in crash_locations['all']:
-            crash_locations['all'][loc] = {
-                'coordinates': Point(loc),
-                'total_crashes': 0,
-                'crash_dates': [],
-            }
-        crash_locations['all'][loc]['total_crashes'] += 1
-        date = crash['dateOccurred']
-
-        crash_locations['all'][loc]['crash_dates'].append(date)
-        for column in split_columns:
-            if column in crash:
-                if loc not in crash_locations[column]:
-                    crash_locations[column][loc] = {
-                        'coordinates': Point(loc),
-                        'total_crashes': 0,
-                        'crash_dates': [],
-                    }
-                crash_locations[column][loc]['total_crashes'] += 1
-                crash_locations[column][loc]['crash_dates'].append(crash['dateOccurred'])
+    rollups = rollup_table(
+        read_crash_table(crashes_json, split_columns), split_columns)
 
     crashes_agg = {}
-    for crash_type in crash_locations.keys():
-        crashes_agg_gdf = gpd.GeoDataFrame(
-            pd.DataFrame.from_dict(crash_locations[crash_type], orient='index'),
-            geometry='coordinates'
-        )
-        crashes_agg_gdf.index = range(len(crashes_agg_gdf))
-        crashes_agg_gdf['crash_dates'] = crashes_agg_gdf['crash_dates'].apply(
-            lambda x: ",".join(sorted(set(x))))
-        crashes_agg[crash_type] = crashes_agg_gdf
-
+    for crash_type, rollup in rollups.items():
+        crashes_agg[crash_type] = gpd.GeoDataFrame({
+            'coordinates': gpd.points_from_xy(
+                rollup['longitude'], rollup['latitude']),
+            'total_crashes': rollup['total_crashes'].values,
+            'crash_dates': rollup['crash_dates'].values,
+        }, columns=['coordinates', 'total_crashes', 'crash_dates'],
+            geometry='coordinates')
     return crashes_agg
 
+
+def write_crash_rollups(rollups, outdir):
+    """
+    Write each crash rollup as geojson, to crashes_rollup.geojson for
+    all crashes and crashes_rollup_<column>.geojson for each split column
+    Args:
+        rollups - dict of dataframes from rollup_table
+        outdir - directory to write to
+    """
+    for crash_type, rollup in rollups.items():
+        filename = "crashes_rollup.geojson" if crash_type == 'all' \
+            else "crashes_rollup_" + crash_type + ".geojson"
+
+        columns = [x for x in rollup.columns
+                   if x not in ('longitude', 'latitude')]
+        properties = zip(*[rollup[x].tolist() for x in columns])
+        features = [{
+            'type': 'Feature',
+            'geometry': {'type': 'Point', 'coordinates': [x, y]},
+            'properties': dict(zip(columns, props)),
+        } for x, y, props in zip(
+            rollup['longitude'].tolist(),
+            rollup['latitude'].tolist(),
+            properties)]
+
+        # json.dumps, unlike json.dump, uses the faster c encoder
+        with open(os.path.join(outdir, filename), 'w') as f:
+            f.write(json.dumps({
+                'type': 'FeatureCollection',
+                'features': features
+            }))
+        print("wrote {} crash locations to {}".format(
+            len(features), filename))
+
+
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
@@ -125,6 +298,13 @@ if __name__ == '__main__':
                         help="Can limit data to crashes this year or later")
     parser.add_argument("-end", "--endyear", type=str,
                         help="Can limit data to crashes this year or earlier")
+    parser.add_argument("--chunksize", type=int,
+                        help="Snap this many crashes at a time, to limit " +
+                        "memory use, defaults to crash_chunksize in the " +
+                        "config file if set, otherwise all at once")
+    parser.add_argument("-p", "--processes", type=int, default=1,
+                        help="Number of processes to snap crashes " +
+                        "with, defaults to 1")
 
     args = parser.parse_args()
     config = data.config.Configuration(args.config)
@@ -135,35 +315,27 @@ if __name__ == '__main__':
         PROCESSED_DATA_FP = os.path.join(args.datadir, 'processed')
         MAP_FP = os.path.join(args.datadir, 'processed/maps')
 
+    chunksize = args.chunksize or config.crash_chunksize
     combined_seg, segments_index = util.read_segments(dirname=MAP_FP)
-    snap_records(
-        combined_seg, segments_index,
-        os.path.join(RAW_DATA_FP, 'crashes.json'),
-        startyear=args.startyear, endyear=args.endyear)
-
-    with open(os.path.join(PROCESSED_DATA_FP, 'crash_joined.json')) as crash_file:
-        data = json.load(crash_file)
-    crashes_agg_list = make_crash_rollup(data, config.split_columns)
-
-    crashes_agg_path = os.path.join(
-        args.datadir, "processed", "crashes_rollup.geojson")
-    if os.path.exists(crashes_agg_path):
-        os.remove(crashes_agg_path)
-
-    for split, crashes_agg_gdf in crashes_agg_list.items():
-        if split == 'all':
-            filename = os.path.join(
-                args.datadir,
-                "processed",
-                "crashes_rollup.geojson"
-            )
-        else:
-            filename = os.path.join(
-                args.datadir,
-                "processed",
-                "crashes_rollup_" + split + ".geojson"
-            )
-        crashes_agg_gdf.to_file(
-            filename,
-            driver="GeoJSON"
-        )
+    if chunksize:
+        snap_records_chunked(
+            combined_seg, segments_index,
+            os.path.join(RAW_DATA_FP, 'crashes.json'), chunksize,
+            startyear=args.startyear, endyear=args.endyear,
+            processes=args.processes)
+        crashes = read_crash_table_chunked(
+            os.path.join(PROCESSED_DATA_FP, 'crash_joined.json'),
+            config.split_columns, chunksize)
+    else:
+        snap_records(
+            combined_seg, segments_index,
+            os.path.join(RAW_DATA_FP, 'crashes.json'),
+            startyear=args.startyear, endyear=args.endyear,
+            processes=args.processes)
+
+        with open(os.path.join(
+                PROCESSED_DATA_FP, 'crash_joined.json')) as crash_file:
+            data = json.load(crash_file)
+        crashes = read_crash_table(data, config.split_columns)
+    rollups = rollup_table(crashes, config.split_columns)
+    write_crash_rollups(rollups, os.path.join(args.datadir, "processed"))
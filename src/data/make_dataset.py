@@ -1,8 +1,8 @@
 # -*- coding: utf-8 -*-
 import os
-import subprocess
 import argparse
 import data.config
+from data import instrument
 
 DATA_FP = os.path.dirname(
     os.path.dirname(
@@ -26,6 +26,20 @@ if __name__ == '__main__':
                         "in form YYYY-MM-DD")
     parser.add_argument('--forceupdate', action='store_true',
                         help='Whether to force update the maps')
+    parser.add_argument('--refetch', action='store_true',
+                        help='Download the map again, instead of ' +
+                        'using the cached copy')
+    parser.add_argument('--summary', action='store_true',
+                        help="Print a table of the time, memory and " +
+                        "counts for each stage at the end")
+    parser.add_argument('--profile', type=str,
+                        help="Comma-separated stages to run under a " +
+                        "profiler, e.g. create_segments,train_model. " +
+                        "Profiles are written to the profiles directory " +
+                        "in the city's data directory")
+    parser.add_argument('--sampling', action='store_true',
+                        help="With --profile, sample the stack instead " +
+                        "of using cProfile, which has less overhead")
 
     args = parser.parse_args()
 
@@ -36,6 +50,10 @@ if __name__ == '__main__':
     config = data.config.Configuration(config_file)
 
     DATA_FP = args.datadir
+    # Joins the pipeline's run, if started from pipeline.py
+    trace_file = instrument.start_run(DATA_FP)
+    if args.profile:
+        instrument.start_profiling(DATA_FP, args.profile, args.sampling)
 
     # This block handles any extra map info as we have in Boston
     extra_map = None
@@ -47,7 +65,7 @@ if __name__ == '__main__':
         extra_map = config.additional_map_features['extra_map']
 
     # Whether to regenerate maps from open street map
-    if args.forceupdate:
+    if args.forceupdate or args.refetch:
         recreate = True
 
     waze = False
@@ -58,7 +76,7 @@ if __name__ == '__main__':
     if recreate:
         print("Overwriting existing data...")
     # Get the maps out of open street map, both projections
-    subprocess.check_call([
+    instrument.check_call([
         'python',
         '-m',
         'data.osm_create_maps',
@@ -66,12 +84,13 @@ if __name__ == '__main__':
         config_file,
         '-d',
         DATA_FP,
-    ] + (['--forceupdate'] if recreate else []))
+    ] + (['--forceupdate'] if recreate else [])
+        + (['--refetch'] if args.refetch else []))
 
     # Add waze data if applicable
     if waze:
         print("Adding Waze features")
-        subprocess.check_call([
+        instrument.check_call([
             'python',
             '-m',
             'data.add_waze_data',
@@ -82,7 +101,7 @@ if __name__ == '__main__':
         print("No Waze data found, skipping...")
     
     # Create segments on the open street map data
-    subprocess.check_call([
+    instrument.check_call([
         'python',
         '-m',
         'data.create_segments',
@@ -96,7 +115,7 @@ if __name__ == '__main__':
         # Extract intersections from the new city file
         # Write to a subdirectory so files created from osm aren't overwritten
         # Eventually, directory of additional files should also be an argument
-        subprocess.check_call([
+        instrument.check_call([
             'python',
             '-m',
             'data.extract_intersections',
@@ -107,7 +126,7 @@ if __name__ == '__main__':
             outputdir
         ] + (['--forceupdate'] if recreate else []))
         # Create segments from the Boston data
-        subprocess.check_call([
+        instrument.check_call([
             'python',
             '-m',
             'data.create_segments',
@@ -124,7 +143,7 @@ if __name__ == '__main__':
 
         # Map the boston segments to the open street map segments
         # and add features
-        subprocess.check_call([
+        instrument.check_call([
             'python',
             '-m',
             'data.add_map',
@@ -132,7 +151,7 @@ if __name__ == '__main__':
             outputdir,
         ])
 
-    subprocess.check_call([
+    instrument.check_call([
         'python',
         '-m',
         'data.join_segments_crash',
@@ -145,14 +164,14 @@ if __name__ == '__main__':
         + (['-end', enddate] if enddate else [])
     )
 
-    subprocess.check_call([
+    instrument.check_call([
         'python',
         '-m',
         'data.propagate_volume',
         '-d',
         DATA_FP
     ] + (['--forceupdate'] if recreate else []))
-    subprocess.check_call([
+    instrument.check_call([
         'python',
         '-m',
         'data.TMC_scraping.parse_tmc',
@@ -162,7 +181,7 @@ if __name__ == '__main__':
 
     # Throw in make canonical dataset here too just to keep track
     # of standardized features
-    subprocess.check_call([
+    instrument.check_call([
         'python',
         '-m',
         'features.make_canon_dataset',
@@ -171,3 +190,6 @@ if __name__ == '__main__':
         '-c',
         config_file,
     ])
+
+    if args.summary:
+        instrument.print_summary(trace_file)
@@ -11,84 +11,281 @@ Inputs:
 
 Output:
     preds_viz.json
+
+With --shared, writes a single preds_viz.geojson for all split columns,
+with each segment's geometry once and a prediction and crash property
+per split column.  --simplify and --precision make the output smaller
+by simplifying and rounding the geometry.
 """
 
 import argparse
+import json
 import os
+import numpy as np
 import pandas as pd
 import geojson
 import sys
+from shapely.geometry import shape, mapping
 import data.config
+from data import instrument
 
+# Rough conversion from meters to degrees, for simplification tolerances
+# Fine for the small tolerances used here, at any latitude we map
+METERS_PER_DEGREE = 111320.0
 
-def combine_predictions_and_segments(predictions, segments):
+
+def read_segments(segments_file):
     """
-    Combine predictions data with certain properties of their related segment.
+    Load the geometry and display properties of every segment, once
+    Args:
+        segments_file - inter_and_non_int.geojson
+    Returns:
+        dataframe with one row per segment
     """
+    with open(segments_file) as f:
+        segments = json.load(f)['features']
+    return segments_to_frame(segments)
 
-    print("combining predictions with segments")
-    combined_preds = []
 
-    # turns segments into a dict for quick lookup
-    segments_dict = {str(segment["id"]): segment for segment in segments}
+def segments_to_frame(segments):
+    """
+    Turn a list of segment features into a dataframe keyed by
+    the segment id as a string
+    """
+    return pd.DataFrame({
+        'segment_key': [str(x["id"]) for x in segments],
+        'geometry': [x["geometry"] for x in segments],
+        'display_name': [x["properties"]["display_name"] for x in segments],
+        'center_x': [x["properties"]["center_x"] for x in segments],
+        'center_y': [x["properties"]["center_y"] for x in segments],
+    }, columns=[
+        'segment_key', 'geometry', 'display_name', 'center_x', 'center_y'])
 
-    for pred_data in predictions:
-        segment = segments_dict[str(pred_data["segment_id"])]
-        prop = {
-            "prediction": pred_data["prediction"],
-            "crash": pred_data["crash"],
-            "segment_id": pred_data["segment_id"]
-        }
-        # Eventually handle osm_speed vs SPEEDLIMIT as part
-        # of the configuration
-        if 'SPEEDLIMIT' in pred_data:
-            prop['SPEEDLIMIT'] = pred_data['SPEEDLIMIT']
-        elif 'osm_speed' not in pred_data:
-            prop['osm_speed'] = 0
-        else:
-            prop['osm_speed'] = pred_data['osm_speed']
 
-        prop["segment"] = {
-            "id": str(segment["id"]),
-            "display_name": segment["properties"]["display_name"],
-            "center_x": segment["properties"]["center_x"],
-            "center_y": segment["properties"]["center_y"]
+def round_coords(coords, precision):
+    """
+    Round nested coordinate lists, returning lists rather than tuples
+    """
+    if isinstance(coords[0], (list, tuple)):
+        return [round_coords(x, precision) for x in coords]
+    return [round(float(x), precision) for x in coords]
+
+
+def compact_geometry(geometry, tolerance=0, precision=None):
+    """
+    Simplify and round a geometry, to make the visualization files smaller
+    Args:
+        geometry - geojson geometry dict
+        tolerance - max distance, in meters, a simplified line can be
+            from the original.  0 leaves the geometry as is
+        precision - number of decimal places to keep in coordinates,
+            e.g. 6 is about 10cm.  None keeps full precision
+    Returns:
+        geojson geometry dict
+    """
+    if tolerance:
+        geometry = mapping(shape(geometry).simplify(
+            tolerance / METERS_PER_DEGREE))
+    if precision is not None:
+        geometry = {
+            'type': geometry['type'],
+            'coordinates': round_coords(geometry['coordinates'], precision)
         }
+    return geometry
 
-        combined_preds.append(geojson.Feature(
-            geometry=segment["geometry"],
-            properties=prop
-        ))
 
-    # Sort highest risk to lowest risk
-    combined_preds = sorted(
-        combined_preds,
-        key=lambda x: x['properties']['prediction'],
-        reverse=True
-    )
+def compact_segments(segments, tolerance=0, precision=None):
+    """
+    Simplify and round the geometry (and centers) of every segment.
+    This is done once per segment, before the segments are joined
+    to the predictions for each split column
+    Args:
+        segments - dataframe from segments_to_frame
+        tolerance - simplification tolerance in meters
+        precision - decimal places to keep
+    Returns:
+        dataframe
+    """
+    if not tolerance and precision is None:
+        return segments
+
+    segments = segments.copy()
+    segments['geometry'] = [
+        compact_geometry(x, tolerance, precision)
+        for x in segments['geometry']]
+    if precision is not None:
+        segments['center_x'] = segments['center_x'].round(precision)
+        segments['center_y'] = segments['center_y'].round(precision)
+    return segments
+
+
+def read_predictions(predictions_file):
+    """
+    Load a seg_with_predicted file into a dataframe
+    """
+    preds_data = pd.read_json(
+        predictions_file, orient="index", typ="series", dtype=False)
+    return predictions_to_frame(preds_data)
+
+
+def predictions_to_frame(predictions):
+    """
+    Pull out the prediction properties we display from a list
+    (or series) of predictions
+    Returns:
+        dataframe with prediction, crash, segment_id and speed columns
+    """
+    preds = pd.DataFrame(list(predictions))
+
+    columns = ["prediction", "crash", "segment_id"]
+    # Eventually handle osm_speed vs SPEEDLIMIT as part
+    # of the configuration
+    if 'SPEEDLIMIT' in preds.columns:
+        columns.append('SPEEDLIMIT')
+    else:
+        if 'osm_speed' not in preds.columns:
+            preds['osm_speed'] = 0
+        columns.append('osm_speed')
+
+    preds = preds[columns].copy()
+    preds['segment_key'] = preds['segment_id'].astype(str)
+    return preds
+
 
-    return combined_preds
+def merge_predictions(preds, segments):
+    """
+    Join predictions to their segments in a single merge
+    Args:
+        preds - dataframe from predictions_to_frame
+        segments - dataframe from segments_to_frame
+    Returns:
+        dataframe
+    """
+    combined = preds.merge(segments, on='segment_key', how='left')
+    missing = combined['geometry'].isnull()
+    if missing.any():
+        print("{} predictions without a segment, skipping".format(
+            missing.sum()))
+        combined = combined[~missing]
+    return combined
 
 
-def write_preds_as_geojson(preds, outfp):
+def make_features(combined, prop_columns):
+    """
+    Turn combined predictions and segments into geojson features,
+    sorted from highest risk to lowest risk
+    Args:
+        combined - dataframe from merge_predictions
+        prop_columns - prediction columns to include in the properties
+    Returns:
+        list of features
+    """
+    order = np.argsort(-combined['prediction'].values, kind='mergesort')
+    combined = combined.iloc[order]
+
+    # Plain python values (and None for missing values) so they
+    # can be written as json
+    props = combined[prop_columns].astype(object)
+    props = props.where(props.notnull(), None)
+    props = props.to_dict('records')
+
+    return [{
+        "type": "Feature",
+        "geometry": geometry,
+        "properties": dict(prop, segment={
+            "id": segment_key,
+            "display_name": display_name,
+            "center_x": center_x,
+            "center_y": center_y
+        })
+    } for prop, segment_key, geometry, display_name, center_x, center_y
+        in zip(
+            props,
+            combined['segment_key'],
+            combined['geometry'],
+            combined['display_name'],
+            combined['center_x'],
+            combined['center_y'])]
+
+
+def make_shared_features(combined, prop_columns):
+    """
+    Make one feature per segment from the predictions for every split
+    column, so the geometry is only written once
+    Each target's prediction and crash are in prediction_<target> and
+    crash_<target>, and prediction is the highest of them
+    Args:
+        combined - dataframe from merge_predictions, with a target column
+        prop_columns - prediction columns to include in the properties
+    Returns:
+        list of features
+    """
+    per_target = ['prediction', 'crash']
+    wide = combined.groupby(
+        ['segment_key', 'target'])[per_target].max().unstack('target')
+    wide.columns = ['{}_{}'.format(value, target)
+                    for value, target in wide.columns]
+    # Segments missing from a target's predictions leave gaps,
+    # so keep crash counts as integers that can be missing
+    for column in wide.columns:
+        if column.startswith('crash_'):
+            wide[column] = wide[column].astype('Int64')
+
+    shared = combined.drop_duplicates('segment_key').set_index(
+        'segment_key').drop(columns=per_target + ['target'])
+    shared = shared.join(wide)
+    shared['prediction'] = wide[[
+        x for x in wide.columns if x.startswith('prediction_')]].max(axis=1)
+    shared.reset_index(inplace=True)
+
+    prop_columns = [x for x in prop_columns if x not in per_target]
+    return make_features(
+        shared, ['prediction'] + prop_columns + list(wide.columns))
+
+
+def combine_predictions_and_segments(predictions, segments):
+    """
+    Combine predictions data with certain properties of their related segment.
+    """
+
+    print("combining predictions with segments")
+    preds = predictions_to_frame(predictions)
+    prop_columns = [x for x in preds.columns if x != 'segment_key']
+    combined = merge_predictions(preds, segments_to_frame(segments))
+
+    return make_features(combined, prop_columns)
+
+
+def write_preds_as_geojson(preds, outfp, compact=False):
     """
     Output the combined predictions & segments to a geojson file.
+    If compact, leave out the whitespace between items
     """
 
     preds_collection = geojson.FeatureCollection(preds)
     with open(outfp, "w") as outfile:
-        geojson.dump(preds_collection, outfile)
+        if compact:
+            geojson.dump(preds_collection, outfile, separators=(',', ':'))
+        else:
+            geojson.dump(preds_collection, outfile)
 
         print("wrote {} assembled predictions to file {}".format(
             len(preds), outfp))
 
 
-def write_all_preds(DATA_FP, config):
+@instrument.traced
+def write_all_preds(DATA_FP, config, tolerance=0, precision=None,
+                    shared=False):
     """
-    For each split column, read prediction file and write postprocessed file
+    Read the prediction file for each split column, join them all to
+    the segments at once, and write a postprocessed file per split column
     Args:
         DATA_FP - the data directory
         config - a configuration object
+        tolerance - simplification tolerance in meters, 0 to not simplify
+        precision - decimal places to keep in coordinates, None for all
+        shared - write a single preds_viz.geojson for all split columns,
+            instead of a file per split column
     """
     # confirm files exist & load data
     files = {}
@@ -97,6 +294,19 @@ def write_all_preds(DATA_FP, config):
     if not files:
         files["seg_with_predicted.json"] = None
 
+    segments_file = os.path.join(
+        DATA_FP, "processed", "maps", "inter_and_non_int.geojson")
+    if not os.path.exists(segments_file):
+        sys.exit("segment file not found at {}, exiting".format(segments_file))
+
+    # load the segments
+    print("loading segments: ", end="")
+    segments = read_segments(segments_file)
+    print("{} found".format(len(segments)))
+    segments = compact_segments(segments, tolerance, precision)
+    compact = bool(tolerance) or precision is not None
+
+    all_preds = []
     for filename, column in files.items():
         predictions_file = os.path.join(
             DATA_FP, "processed", filename)
@@ -106,31 +316,36 @@ def write_all_preds(DATA_FP, config):
 
         # load the predictions
         print("loading predictions: ", end="")
-        preds_data = pd.read_json(
-            predictions_file, orient="index", typ="series", dtype=False)
-        print("{} found".format(len(preds_data)))
-
-        segments_file = os.path.join(
-            DATA_FP, "processed", "maps", "inter_and_non_int.geojson")
-        if not os.path.exists(segments_file):
-            sys.exit("segment file not found at {}, exiting".format(segments_file))
-
-        # load the segments
-        print("loading segments: ", end="")
-        segs_features = pd.read_json(segments_file)
-        # TODO segments data standard should probably key each segment by its id
-        segs_data = segs_features["features"]
-        print("{} found".format(len(segs_data)))
-
-        # output the combined prediction + segment data for use
-        preds_viz = combine_predictions_and_segments(preds_data, segs_data)
+        preds = read_predictions(predictions_file)
+        print("{} found".format(len(preds)))
+
+        preds['target'] = column or ''
+        all_preds.append(preds)
+
+    all_preds = pd.concat(all_preds, ignore_index=True, sort=False)
+    instrument.count('predictions', len(all_preds))
+    instrument.count('segments', len(segments))
+    prop_columns = [x for x in all_preds.columns
+                    if x not in ('segment_key', 'target')]
+
+    # output the combined prediction + segment data for use
+    combined = merge_predictions(all_preds, segments)
+    if shared and config.split_columns:
+        write_preds_as_geojson(
+            make_shared_features(combined, prop_columns),
+            os.path.join(DATA_FP, "processed", "preds_viz.geojson"),
+            compact)
+        return
+
+    for column, target_preds in combined.groupby('target', sort=False):
+        preds_viz = make_features(target_preds, prop_columns)
         output_file = "preds_viz"
         if column:
             output_file += "_" + column
         output_file += ".geojson"
 
         write_preds_as_geojson(preds_viz, os.path.join(
-            DATA_FP, "processed", output_file))
+            DATA_FP, "processed", output_file), compact)
 
 
 if __name__ == "__main__":
@@ -141,7 +356,17 @@ if __name__ == "__main__":
     parser.add_argument("-c", "--config", type=str,
                         help="yml file for model config"
     )
+    parser.add_argument("--simplify", type=float, default=0,
+                        help="Simplify segment geometry, with this " +
+                        "tolerance in meters")
+    parser.add_argument("--precision", type=int,
+                        help="Decimal places to keep in coordinates, " +
+                        "e.g. 6 (about 10cm)")
+    parser.add_argument("--shared", action='store_true',
+                        help="Write one file for all split columns, " +
+                        "with a prediction property per split column")
 
     args = parser.parse_args()
     config = data.config.Configuration(args.config)
-    write_all_preds(args.datadir, config)
+    write_all_preds(args.datadir, config, args.simplify, args.precision,
+                    args.shared)
@@ -1,5 +1,7 @@
 import argparse
-import osmnx as ox
+import sys
+import glob
+import hashlib
 import fiona
 import shutil
 import os
@@ -8,16 +10,100 @@ import csv
 import geojson
 import json
 import requests
-import geopandas
+import numpy as np
+import pandas as pd
 from . import util
-from shapely.geometry import Polygon, LineString, LinearRing
+from shapely.geometry import Polygon, LineString, LinearRing, shape
 import data.config
 from .record import transformer_3857_to_4326
+# osmnx and geopandas are slow to import, and only needed to download or
+# simplify the map, so they're imported in the functions that do that
 
 
 MAP_FP = None
 STANDARDIZED_FP = None
 RAW_FP = None
+# Directory to cache downloaded graphs and nominatim responses in,
+# None to always download
+CACHE_FP = None
+
+# Tags that exclude a way from the drive network, the same as
+# osmnx's 'drive' network type filter
+DRIVE_EXCLUDE = {
+    'area': 'yes',
+    'highway': 'cycleway|footway|path|pedestrian|steps|track|corridor|' +
+               'elevator|escalator|proposed|construction|bridleway|' +
+               'abandoned|platform|raceway|service',
+    'motor_vehicle': 'no',
+    'motorcar': 'no',
+    'access': 'private',
+    'service': 'parking|parking_aisle|driveway|private|emergency_access',
+}
+
+# How far, in degrees, to read past the city's bounds, so roads crossing
+# the boundary keep their intersections outside it (about 500 meters)
+EXTRACT_BUFFER = 0.005
+
+
+def cache_key(params):
+    """
+    Make a cache file name from a dict of the parameters
+    that determine the contents of the file
+    """
+    return hashlib.sha1(
+        json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def files_hash(filenames):
+    """
+    Hash the contents of a list of files
+    """
+    sha1 = hashlib.sha1()
+    for filename in sorted(filenames):
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def write_cache_json(filename, contents):
+    if not os.path.exists(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    with open(filename, 'w') as f:
+        json.dump(contents, f)
+
+
+def graph_cache_params(config):
+    """
+    Everything the unsimplified graph for a city depends on
+    Args:
+        config object
+    Returns:
+        dict
+    """
+    params = {
+        'city': config.city,
+        'map_geography': config.map_geography,
+        'city_radius': config.city_radius,
+        'city_latitude': config.city_latitude,
+        'city_longitude': config.city_longitude,
+    }
+    if config.map_geography == 'shapefile':
+        # The shapefile and its .shx, .dbf etc
+        name = os.path.splitext(config.boundary_shapefile)[0]
+        params['boundary_shapefile'] = files_hash(glob.glob(
+            os.path.join(RAW_FP, 'maps', glob.escape(name) + '.*')))
+    elif config.map_geography != 'radius':
+        # The city polygon can be expanded to include the crashes
+        params['crashes'] = files_hash(
+            [os.path.join(STANDARDIZED_FP, 'crashes.json')])
+    if config.osm_extract:
+        extract = os.path.join(RAW_FP, 'maps', config.osm_extract)
+        params['osm_extract'] = [
+            config.osm_extract,
+            os.path.getsize(extract),
+            os.path.getmtime(extract)]
+    return params
 
 
 def find_osm_polygon(city):
@@ -40,8 +126,27 @@ def find_osm_polygon(city):
                      'dedupe': 0, 'polygon_geojson': 1, 'q': city}
     url = 'https://nominatim.openstreetmap.org/search'
 
-    response = requests.get(url, params=search_params)
-    for index, match in enumerate(response.json()):
+    cache_file = None
+    if CACHE_FP:
+        cache_file = os.path.join(
+            CACHE_FP, 'nominatim_' + cache_key(search_params) + '.json')
+    if cache_file and os.path.exists(cache_file):
+        print("Using cached nominatim response for {}".format(city))
+        with open(cache_file) as f:
+            matches = json.load(f)
+    else:
+        response = requests.get(url, params=search_params)
+        if response.ok:
+            matches = response.json()
+        else:
+            print("Nominatim search for {} failed with status {}".format(
+                city, response.status_code))
+            matches = []
+        # Don't cache errors or empty results, so they're retried next time
+        if cache_file and matches and isinstance(matches, list):
+            write_cache_json(cache_file, matches)
+
+    for index, match in enumerate(matches):
         # a match that can be used by graph_from_place needs to be a Polygon
         # or MultiPolygon
         if (match['geojson']['type'] in ['Polygon', 'MultiPolygon']):
@@ -137,7 +242,219 @@ def buffer_polygon(polygon, points):
     return polygon
 
 
+def is_drive_way(tags):
+    """
+    Whether a way with these tags is part of the drive network
+    Args:
+        tags - dict of osm tags
+    Returns:
+        boolean
+    """
+    if 'highway' not in tags:
+        return False
+    for key, exclude in DRIVE_EXCLUDE.items():
+        if key in tags and re.search(exclude, tags[key]):
+            return False
+    return True
+
+
+def longest_run(refs, nodes):
+    """
+    Get the longest run of consecutive nodes in a way that were read
+    from the extract.  Ways that leave the area we read and come back
+    are cut to the part with the most nodes, so we never join nodes
+    that weren't next to each other
+    Args:
+        refs - list of node ids in the way
+        nodes - dict of node ids that were read
+    Returns:
+        list of node ids
+    """
+    runs = [[]]
+    for ref in refs:
+        if ref in nodes:
+            runs[-1].append(ref)
+        elif runs[-1]:
+            runs.append([])
+    return max(runs, key=len)
+
+
+def read_osm_extract(filename, bounds):
+    """
+    Stream a .osm.pbf (or .osm) extract, keeping only the drive network
+    inside a bounding box.  Only nodes inside the box and ways in the
+    drive network are kept in memory, so this works on large (e.g. state)
+    extracts
+    Args:
+        filename - osm extract
+        bounds - (minx, miny, maxx, maxy) in 4326 projection
+    Returns:
+        a list of nodes and ways, in the same format as the overpass api
+    """
+    import osmnx as ox
+
+    try:
+        import osmium
+    except ImportError:
+        sys.exit("Reading osm extracts requires pyosmium " +
+                 "(pip install osmium)")
+
+    minx, miny, maxx, maxy = bounds
+    node_tags = ox.settings.useful_tags_node
+    path_tags = ox.settings.useful_tags_path
+
+    class ExtractHandler(osmium.SimpleHandler):
+        def __init__(self):
+            super(ExtractHandler, self).__init__()
+            self.nodes = {}
+            self.ways = []
+
+        def node(self, n):
+            lon, lat = n.location.lon, n.location.lat
+            if minx <= lon <= maxx and miny <= lat <= maxy:
+                self.nodes[n.id] = {
+                    'type': 'node',
+                    'id': n.id,
+                    'lon': lon,
+                    'lat': lat,
+                    'tags': {t.k: t.v for t in n.tags if t.k in node_tags},
+                }
+
+        def way(self, w):
+            tags = {t.k: t.v for t in w.tags}
+            if not is_drive_way(tags):
+                return
+            refs = longest_run([n.ref for n in w.nodes], self.nodes)
+            if len(refs) > 1:
+                self.ways.append({
+                    'type': 'way',
+                    'id': w.id,
+                    'nodes': refs,
+                    'tags': {k: v for k, v in tags.items() if k in path_tags},
+                })
+
+    handler = ExtractHandler()
+    handler.apply_file(filename)
+
+    # Only keep the nodes that are on the road network
+    used = set(ref for way in handler.ways for ref in way['nodes'])
+    elements = [node for node_id, node in handler.nodes.items()
+                if node_id in used]
+    print("Read {} nodes and {} ways from {}".format(
+        len(elements), len(handler.ways), filename))
+    return elements + handler.ways
+
+
+def graph_from_extract(filename, polygon=None, point=None, distance=None):
+    """
+    Build the unsimplified drive network from a local osm extract,
+    clipped to a polygon, or to the box around a point that
+    osmnx's graph_from_point uses
+    Args:
+        filename - osm extract
+        polygon - shapely polygon in 4326 projection
+        point - (lat, lng) tuple, if there's no polygon
+        distance - distance from the point in meters
+    Returns:
+        osmnx graph object
+    """
+    import osmnx as ox
+
+    if polygon is not None:
+        minx, miny, maxx, maxy = polygon.bounds
+    else:
+        north, south, east, west = ox.bbox_from_point(point, distance)
+        minx, miny, maxx, maxy = west, south, east, north
+
+    elements = read_osm_extract(filename, (
+        minx - EXTRACT_BUFFER, miny - EXTRACT_BUFFER,
+        maxx + EXTRACT_BUFFER, maxy + EXTRACT_BUFFER))
+    G = ox.create_graph([{'elements': elements}], retain_all=True)
+
+    if polygon is not None:
+        return ox.truncate_graph_polygon(G, polygon, retain_all=False)
+    return ox.truncate_graph_bbox(
+        G, maxy, miny, maxx, minx, retain_all=False)
+
+
+def get_graph_from_extract(config):
+    """
+    Build the graph for a city from the osm extract in the config
+    The city is clipped to the boundary shapefile if there is one,
+    otherwise the city polygon from nominatim (the only network call),
+    or the radius around the city if there's no polygon
+    Args:
+        config object
+    Returns:
+        osmnx graph object
+    """
+    import geopandas
+
+    extract = os.path.join(RAW_FP, 'maps', config.osm_extract)
+    if not os.path.exists(extract):
+        sys.exit("osm extract not found at {}".format(extract))
+    print("Reading roads from osm extract {}".format(extract))
+
+    polygon = None
+    if config.map_geography == 'shapefile':
+        polygons = geopandas.read_file(os.path.join(
+            RAW_FP, 'maps', config.boundary_shapefile))
+        polygons = polygons.to_crs({'init': 'epsg:4326'})
+        polygon = polygons.geometry.unary_union
+    elif config.map_geography != 'radius':
+        print("searching nominatim for " + str(config.city) + " polygon")
+        try:
+            _, city_polygon = find_osm_polygon(config.city)
+        except requests.exceptions.RequestException:
+            print("Couldn't reach nominatim, using the city radius")
+            city_polygon = None
+        if city_polygon:
+            polygon = expand_polygon(city_polygon, os.path.join(
+                STANDARDIZED_FP, 'crashes.json')) or shape(city_polygon)
+
+    if polygon is not None:
+        return graph_from_extract(extract, polygon=polygon)
+
+    print("Building graph of roads within {} km of city ({}/{})".format(
+        str(config.city_radius),
+        str(config.city_latitude),
+        str(config.city_longitude)))
+    return graph_from_extract(
+        extract,
+        point=(config.city_latitude, config.city_longitude),
+        distance=config.city_radius * 1000)
+
+
 def get_graph(config):
+    """
+    Get the unsimplified graph for a city, from the cache if it's been
+    downloaded (or read from an extract) with the same parameters before
+    Args:
+        config object
+    Returns:
+        osmnx graph object
+    """
+    import osmnx as ox
+
+    if not CACHE_FP:
+        return fetch_graph(config)
+
+    params = graph_cache_params(config)
+    filename = 'graph_' + cache_key(params) + '.graphml'
+    if os.path.exists(os.path.join(CACHE_FP, filename)):
+        print("Using cached graph {}".format(filename))
+        return ox.load_graphml(filename, folder=CACHE_FP)
+
+    G = fetch_graph(config)
+    ox.save_graphml(G, filename=filename, folder=CACHE_FP)
+    # Record what the graph was made from, for reference
+    write_cache_json(os.path.join(
+        CACHE_FP, os.path.splitext(filename)[0] + '.json'), params)
+    print("Cached graph as {}".format(filename))
+    return G
+
+
+def fetch_graph(config):
     """
     Use osmnx to get a graph for a city according to shape type
     specified in config object
@@ -146,6 +463,11 @@ def get_graph(config):
     Returns:
         osmnx graph object
     """
+    import osmnx as ox
+    import geopandas
+
+    if config.osm_extract:
+        return get_graph_from_extract(config)
 
     if config.map_geography == 'shapefile':
         print("Reading from shape file")
@@ -214,6 +536,8 @@ def simple_get_roads(config, mapfp):
            osm_ways.shp - the simplified road network
            osm_nodes.shp - the intersections and dead ends
     """
+    import osmnx as ox
+    import geopandas
 
     ox.settings.useful_tags_path.append('cycleway')
     G1 = get_graph(config)
@@ -307,42 +631,41 @@ def get_connections(ways, nodes):
         nodes - a dict containing the roads connected to each node
         ways - the ways, with a unique osmid-fromnode-to-node string
     """
-    node_info = {}
-    for way in ways:
-        # There are some collector roads and others that don't
-        # have names. Skip these
-        if way['properties']['name']:
-
-            # While we are still merging segments with different names,
-            # just use both roads. This should be revisited
-            if '[' in way['properties']['name']:
-                way['properties']['name'] = re.sub(
-                    r'[^\s\w,]|_', '', way['properties']['name'])
-                way['properties']['name'] = "/".join(
-                    way['properties']['name'].split(', '))
-
-            if way['properties']['from'] not in node_info.keys():
-                node_info[way['properties']['from']] = []
-            node_info[way['properties']['from']].append(
-                way['properties']['name'])
-
-            if way['properties']['to'] not in node_info.keys():
-                node_info[way['properties']['to']] = []
-            node_info[way['properties']['to']].append(
-                way['properties']['name'])
-
-        ident = str(way['properties']['osmid']) + '-' \
-            + str(way['properties']['from']) + '-' \
-            + str(way['properties']['to'])
+    props = property_table(ways, ['osmid', 'name', 'from', 'to'])
+
+    # While we are still merging segments with different names,
+    # just use both roads. This should be revisited
+    merged = props['name'].str.contains('[', regex=False).fillna(False)
+    props.loc[merged, 'name'] = props.loc[merged, 'name'].str.replace(
+        r'[^\s\w,]|_', '', regex=True).str.replace(', ', '/', regex=False)
+    names = props['name'].values
+    for i in np.flatnonzero(merged.values):
+        ways[i]['properties']['name'] = names[i]
+
+    ids = props['osmid'].astype(str) + '-' \
+        + props['from'].astype(str) + '-' + props['to'].astype(str)
+    for way, ident in zip(ways, ids):
         way['properties']['segment_id'] = ident
 
+    # There are some collector roads and others that don't
+    # have names. Skip these
+    named = props[props['name'].fillna('').astype(bool)]
+    # Each way's from node then its to node, sorted stably by node so
+    # the streets at each node are in the order they're first seen
+    ends = pd.DataFrame({
+        'node': named[['from', 'to']].values.ravel(),
+        'name': np.repeat(named['name'].values, 2),
+    }).drop_duplicates().sort_values('node', kind='mergesort')
+    node = ends['node'].values
+    starts = np.flatnonzero(np.r_[True, node[1:] != node[:-1]])
+    streets = dict(zip(
+        node[starts],
+        [', '.join(x) for x in np.split(ends['name'].values, starts[1:])]))
+
     nodes_with_streets = []
     for node in nodes:
-        if node['properties']['osmid'] in node_info:
-            node['properties']['streets'] = ', '.join(
-                set(node_info[node['properties']['osmid']]))
-        else:
-            node['properties']['streets'] = ''
+        node['properties']['streets'] = streets.get(
+            node['properties']['osmid'], '')
         nodes_with_streets.append(node)
     return nodes_with_streets, ways
 
@@ -407,6 +730,47 @@ def get_speed(speed):
     return 0
 
 
+def get_lanes(lanes):
+    """
+    Parse the number of lanes from the openstreetmap lanes property field
+    If there's more than one (from merged ways), use the highest
+    Args:
+        lanes - a string
+    Returns:
+        lanes - an int
+    """
+    if lanes:
+        return max([int(x) for x in re.findall(r'\d', lanes)])
+    return 0
+
+
+def parse_values(values, parse):
+    """
+    Parse each distinct value of an osm property once, since the same
+    few values repeat across most ways
+    Args:
+        values - a series of property values
+        parse - function from a value to an int, e.g. get_speed
+    Returns:
+        array of ints
+    """
+    codes, uniques = pd.factorize(values)
+    # Missing values have code -1, so they get the last element
+    parsed = np.array([parse(x) for x in uniques] + [parse(None)], dtype=int)
+    return parsed[codes]
+
+
+def property_table(features, columns):
+    """
+    Get some of the properties of a list of features as a dataframe,
+    with None for features that don't have a property, e.g. cycleway
+    """
+    return pd.DataFrame({
+        column: [feature['properties'].get(column) for feature in features]
+        for column in columns
+    }, columns=columns)
+
+
 def clean_ways(orig_file, DOC_FP):
     """
     Reads in osm_ways file, cleans up the features, and reprojects
@@ -427,59 +791,45 @@ def clean_ways(orig_file, DOC_FP):
         a list of reprojected way lines
     """
 
-    way_lines = fiona.open(orig_file)
-
+    results = list(fiona.open(orig_file))
+    ways = property_table(results, [
+        'maxspeed', 'width', 'lanes', 'highway', 'cycleway', 'oneway'])
+
+    speed = parse_values(ways['maxspeed'], get_speed)
+    width = parse_values(ways['width'], get_width)
+    lanes = parse_values(ways['lanes'], get_lanes)
+
+    # All fields need to be int
+    # Make dicts for the fields that aren't to track the value
+    # Write these to file for lookup
+    # Ways without a highway type are 0, the rest are numbered in the
+    # order they're first seen
+    codes, uniques = pd.factorize(ways['highway'])
+    hwy_type = codes + 1
     highway_keys = {None: 0}
-    cycleway_keys = {}
-    results = []
-
-    for way_line in way_lines:
-
-        speed = get_speed(way_line['properties']['maxspeed']) \
-            if 'maxspeed' in list(way_line['properties']) else 0
-        width = get_width(way_line['properties']['width']) \
-            if 'width' in list(way_line['properties']) else 0
-
-        lanes = way_line['properties']['lanes']
-        if lanes:
-            lanes = max([int(x) for x in re.findall(r'\d', lanes)])
-        else:
-            lanes = 0
-
-        # All fields need to be int
-        # Make dicts for the fields that aren't to track the value
-        # Write these to file for lookup
-        if way_line['properties']['highway'] not in list(highway_keys.keys()):
-            highway_keys[way_line['properties']['highway']] = len(highway_keys)
-        if 'cycleway' in way_line['properties'] and \
-           way_line['properties']['cycleway'] and \
-           way_line['properties']['cycleway'] not in list(cycleway_keys.keys()):
-            cycleway_keys[way_line['properties']['cycleway']] = len(cycleway_keys)
-
-        # Width per lane
-        width_per_lane = 0
-        if lanes and width:
-            width_per_lane = round(width/lanes)
-
-        # Use oneway
-        oneway = 0
-        if way_line['properties']['oneway'] == 'True':
-            oneway = 1
-
-        way_line['properties'].update({
-            'width': width,
-            'lanes': int(lanes),
-            'hwy_type': highway_keys[way_line['properties']['highway']],
-            'cycleway_type': cycleway_keys[way_line['properties']['cycleway']]
-                if 'cycleway' in way_line['properties'] and \
-                    way_line['properties']['cycleway']
-                else 0,
-            'osm_speed': speed,
-            'signal': 0,
-            'oneway': oneway,
-            'width_per_lane': width_per_lane
-        })
-        results.append(way_line)
+    highway_keys.update(zip(uniques, range(1, len(uniques) + 1)))
+
+    codes, uniques = pd.factorize(ways['cycleway'].where(
+        ways['cycleway'].fillna('').astype(bool)))
+    cycleway_type = np.maximum(codes, 0)
+    cycleway_keys = dict(zip(uniques, range(len(uniques))))
+
+    # Width per lane
+    width_per_lane = np.where(
+        (lanes > 0) & (width > 0),
+        np.round(width / np.maximum(lanes, 1)), 0).astype(int)
+
+    # Use oneway
+    oneway = (ways['oneway'] == 'True').astype(int).values
+
+    columns = ['width', 'lanes', 'hwy_type', 'cycleway_type',
+               'osm_speed', 'signal', 'oneway', 'width_per_lane']
+    cleaned = np.column_stack([
+        width, lanes, hwy_type, cycleway_type, speed,
+        np.zeros(len(ways), dtype=int), oneway, width_per_lane,
+    ]).tolist() if len(ways) else []
+    for way_line, values in zip(results, cleaned):
+        way_line['properties'].update(zip(columns, values))
 
     write_keys(DOC_FP, 'highway', highway_keys)
     write_keys(DOC_FP, 'cycleway', cycleway_keys)
@@ -517,6 +867,9 @@ if __name__ == '__main__':
     # Can force update
     parser.add_argument('--forceupdate', action='store_true',
                         help='Whether to force update the maps')
+    parser.add_argument('--refetch', action='store_true',
+                        help='Download the map again, even if ' +
+                        'it is cached')
 
     args = parser.parse_args()
 
@@ -525,15 +878,18 @@ if __name__ == '__main__':
     DOC_FP = os.path.join(args.datadir, 'docs')
     STANDARDIZED_FP = os.path.join(args.datadir, 'standardized')
     RAW_FP = os.path.join(args.datadir, 'raw')
+    CACHE_FP = os.path.join(args.datadir, 'cache', 'osm')
+    if args.refetch and os.path.exists(CACHE_FP):
+        shutil.rmtree(CACHE_FP)
 
     # If maps do not exist, create
     if not os.path.exists(os.path.join(MAP_FP, 'osm_ways.shp')) \
-       or args.forceupdate:
+       or args.forceupdate or args.refetch:
         print('Generating map from open street map...')
         simple_get_roads(config, MAP_FP)
 
     if not os.path.exists(os.path.join(MAP_FP, 'osm_elements.geojson')) \
-       or args.forceupdate:
+       or args.forceupdate or args.refetch:
         print("Cleaning and writing to {}...".format('osm_elements.geojson'))
 
         clean_and_write(
@@ -0,0 +1,188 @@
+# Run a stage's module under a profiler
+# Used by the --profile option of pipeline.py and make_dataset.py, which
+# run the stages they're asked to profile as
+#   python -m data.profiling -o <prefix> <module> <args>
+# instead of python -m <module> <args>.
+# By default the stage is profiled with cProfile, writing <prefix>.prof
+# (for pstats or snakeviz) and <prefix>.collapsed, stacks estimated from
+# the profile's call graph.  With --sampling, the stage's stack is sampled
+# every few milliseconds of cpu time instead, which has much less overhead,
+# and only <prefix>.collapsed is written.
+# Collapsed stack files can be turned into flamegraphs with flamegraph.pl
+# or opened in speedscope.
+
+import argparse
+import cProfile
+import os
+import pstats
+import runpy
+import signal
+import sys
+from collections import Counter
+
+# Seconds of cpu time between samples
+SAMPLE_INTERVAL = 0.005
+# Call graph paths with less than this fraction of the total time
+# are left out of the estimated stacks
+MIN_FRACTION = 0.0005
+
+
+def frame_label(name, filename, line):
+    """
+    Label for a function in a collapsed stack, e.g.
+    find_nearest (util.py:172)
+    Semicolons separate frames in the file, so can't be in labels
+    """
+    label = '{} ({}:{})'.format(name, os.path.basename(filename), line)
+    return label.replace(';', ',')
+
+
+class Sampler(object):
+    """
+    Count the stacks the program is in, sampled on a cpu time timer
+    Only works where there's a SIGPROF signal (not windows)
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+
+    def sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(frame_label(
+                code.co_name, code.co_filename, code.co_firstlineno))
+            frame = frame.f_back
+        self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+
+def stats_to_stacks(stats, min_fraction=MIN_FRACTION):
+    """
+    Estimate stacks from a cProfile call graph
+    cProfile only records which function called which, not whole stacks,
+    so a function's time is split between the paths to it in proportion
+    to the time spent in it from each of its callers
+    Args:
+        stats - pstats.Stats
+        min_fraction - leave out paths with less than this
+            fraction of the total time
+    Returns:
+        Counter of stack (frames separated by ;) to microseconds
+    """
+    stats = stats.stats
+    callees = {}
+    for func, (_, _, _, _, callers) in stats.items():
+        for caller, edge in callers.items():
+            # edge is (primitive calls, calls, total time, cumulative time)
+            callees.setdefault(caller, []).append((func, edge[3]))
+
+    roots = [func for func, value in stats.items()
+             if not [x for x in value[4] if x != func]]
+    total = sum(stats[func][3] for func in roots)
+    min_time = total * min_fraction
+
+    stacks = Counter()
+    todo = [(func, (), stats[func][3]) for func in roots]
+    while todo:
+        func, path, time = todo.pop()
+        _, _, own_time, cumulative, _ = stats[func]
+        if time < min_time or not cumulative:
+            continue
+        path = path + (func,)
+        stack = ';'.join(frame_label(x[2], x[0], x[1]) for x in path)
+        stacks[stack] += int(1e6 * time * own_time / cumulative)
+        for callee, edge_time in callees.get(func, []):
+            # Skip recursive calls, their time is already included
+            if callee not in path:
+                todo.append((callee, path, time * edge_time / cumulative))
+
+    return Counter({k: v for k, v in stacks.items() if v > 0})
+
+
+def write_collapsed(stacks, filename):
+    """
+    Write stacks in the collapsed format: one stack per line,
+    with frames separated by ; followed by a space and the count
+    """
+    with open(filename, 'w') as f:
+        for stack, value in sorted(stacks.items()):
+            f.write('{} {}\n'.format(stack, value))
+
+
+def run_module(module, args):
+    """
+    Run a module as if it were run with python -m module args
+    """
+    sys.argv = [module] + args
+    runpy.run_module(module, run_name='__main__', alter_sys=True)
+
+
+def profile_module(module, args, prefix, sampling=False):
+    """
+    Run a module under a profiler, and write the results,
+    even if the module exits with an error
+    Args:
+        module - e.g. data.create_segments
+        args - the module's arguments
+        prefix - path and start of the filename to write to
+        sampling - sample the stack instead of using cProfile
+    """
+    directory = os.path.dirname(prefix)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+
+    if sampling:
+        sampler = Sampler()
+        sampler.start()
+        try:
+            run_module(module, args)
+        finally:
+            sampler.stop()
+            # Counts are samples, so the same units as the cProfile
+            # stacks' microseconds
+            write_collapsed(Counter({
+                k: int(v * sampler.interval * 1e6)
+                for k, v in sampler.stacks.items()}),
+                prefix + '.collapsed')
+            print("Wrote {} sampled stacks to {}".format(
+                sum(sampler.stacks.values()), prefix + '.collapsed'))
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        run_module(module, args)
+    finally:
+        profiler.disable()
+        profiler.dump_stats(prefix + '.prof')
+        stats = pstats.Stats(prefix + '.prof')
+        write_collapsed(stats_to_stacks(stats), prefix + '.collapsed')
+        print("Wrote profile to {}".format(prefix + '.prof'))
+        stats.sort_stats('cumulative').print_stats(20)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", "--output", type=str, required=True,
+                        help="Path and start of the filename to write " +
+                        "the profile to, e.g. profiles/create_segments")
+    parser.add_argument("--sampling", action='store_true',
+                        help="Sample the stack instead of using cProfile")
+    parser.add_argument("module", type=str,
+                        help="Module to run, e.g. data.create_segments")
+    parser.add_argument("args", nargs=argparse.REMAINDER,
+                        help="Arguments to the module")
+
+    args = parser.parse_args()
+    if args.sampling and not hasattr(signal, 'setitimer'):
+        sys.exit("Sampling isn't supported on this platform")
+    profile_module(args.module, args.args, args.output, args.sampling)
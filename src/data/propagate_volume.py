@@ -3,12 +3,13 @@ import os
 import rtree
 import argparse
 from . import util
+from . import instrument
+from . import segment_attributes
 from .record import Record
 import numpy as np
 import pandas as pd
 from pandas.io.json import json_normalize
-import geopandas as gpd
-from sklearn.neighbors import KNeighborsRegressor
+from scipy.spatial import cKDTree
 import sys
 
 
@@ -21,38 +22,18 @@ PROCESSED_DATA_FP = os.path.join(BASE_DIR, 'data/processed')
 STANDARDIZED_DATA_FP = os.path.join(BASE_DIR, 'data', 'standardized')
 
 
-def update_properties(segments, df, features):
+def update_properties(df, features):
     """
-    Takes a segment list and a dataframe, and writes out updated
-    intersection and non-intersection segments
+    Takes a dataframe of segment features and adds them to the
+    segment attributes table, leaving the segment geojson files untouched
     Args:
-        segments - a list of intersection and non-intersection segments
-        df - a dataframe of features
+        df - a dataframe of features, with an id column
         features - a list of features to extract from the dataframe
     Returns:
-        nothing - writes to inter_segments.geojson and non_inter_segments.geojson
+        nothing - writes to the segment attributes table in the maps dir
     """
-
-    df = df[['id'] + features]
-    df = df.fillna('')
-    # a dict where the id is the key and the value is the feature
-
-    values = df.to_dict()
-    id_mapping = {value: key for key, value in values['id'].items()}
-    for segment in segments:
-        seg_id = str(segment.properties['id'])
-
-        if seg_id in id_mapping:
-            for feature in features:
-                if values[feature][id_mapping[seg_id]] == '':
-                    segment.properties[feature] = None
-                else:
-                    segment.properties[feature] = values[feature][id_mapping[seg_id]]
-
-    inters = [x for x in segments if util.is_inter(x.properties['id'])]
-    non_inters = [x for x in segments if not util.is_inter(x.properties['id'])]
-    util.write_segments(non_inters, inters, os.path.join(
-        PROCESSED_DATA_FP, 'maps'))
+    segment_attributes.add_attributes(
+        os.path.join(PROCESSED_DATA_FP, 'maps'), df, features)
 
 
 def read_volume():
@@ -94,6 +75,51 @@ def read_volume():
     return volume
 
 
+def get_centroids(segments):
+    """
+    Get the centroid of every segment
+    Args:
+        segments - a list of segment objects
+    Returns:
+        an n x 2 numpy array of x, y coordinates
+    """
+    return np.array([x.geometry.centroid.coords[0] for x in segments])
+
+
+def impute_nearest(coords, known, values, k=3):
+    """
+    Distance weighted k nearest neighbor imputation for several columns
+    at once.  One KD-tree is built over the known points, and a single
+    batched query gives the neighbors used for every column.
+    Matches sklearn's KNeighborsRegressor(k, weights='distance')
+    Args:
+        coords - an n x 2 array of point coordinates
+        known - a boolean array of length n, True where values are known
+        values - an n x m array of values (only known rows are used)
+        k - number of neighbors
+    Returns:
+        an array with a row of m predictions for each unknown point
+    """
+    k = min(k, int(known.sum()))
+    tree = cKDTree(coords[known])
+    dist, idx = tree.query(coords[~known], k=k)
+    if k == 1:
+        dist = dist[:, np.newaxis]
+        idx = idx[:, np.newaxis]
+
+    # Points that sit exactly on a known point only use those points
+    with np.errstate(divide='ignore'):
+        weights = 1. / dist
+    inf_mask = np.isinf(weights)
+    inf_row = inf_mask.any(axis=1)
+    weights[inf_row] = inf_mask[inf_row]
+
+    neighbors = values[known][idx]
+    return (neighbors * weights[:, :, np.newaxis]).sum(axis=1) \
+        / weights.sum(axis=1)[:, np.newaxis]
+
+
+@instrument.traced
 def propagate_volume():
     """
     Propagate volume from given volume data to other segments
@@ -121,6 +147,8 @@ def propagate_volume():
     print('Created spatial index')
 
     volume = read_volume()
+    instrument.count('volumes', len(volume))
+    instrument.count('segments', len(combined_seg))
 
     # Find nearest atr - 20 tolerance
     print("Snapping atr to segments")
@@ -173,63 +201,42 @@ def propagate_volume():
     print(('Dropped {} volumes that bound to same segment as another'.format(
         after - len(volume_df))))
 
-    # create dataframe of all segments
-    seg_df = pd.DataFrame([(x.geometry, x.properties) for x in combined_seg])
-    seg_df.columns = ['geometry', 'seg_id']
-    
-    # seg_id column is read in as a dictionary
-    # separate, get `id` value, and rejoin
-    seg_df = pd.concat([seg_df['geometry'], seg_df.seg_id.apply(
-        pd.Series)['id']], axis=1)
+    # create dataframe of all segments, with the centroid of each
+    centroids = get_centroids(combined_seg)
+    seg_df = pd.DataFrame({
+        'id': [x.properties['id'] for x in combined_seg],
+        'geometry': [x.geometry for x in combined_seg],
+        'px': centroids[:, 0],
+        'py': centroids[:, 1],
+    }, columns=['id', 'geometry', 'px', 'py'])
 
-    # change to geo df for centroid method
-    seg_gdf = gpd.GeoDataFrame(seg_df['id'], geometry=seg_df['geometry'])
+    # merge atrs and seg_df
+    merged_df = pd.merge(seg_df, volume_df, on='id', how='left')
 
-    # create two columns for x and y of centroid of segment
-    seg_gdf['px'] = seg_gdf.geometry.centroid.apply(lambda p: p.x)
-    seg_gdf['py'] = seg_gdf.geometry.centroid.apply(lambda p: p.y)
-    
-    # merge atrs and seg_gdf
-    merged_df = pd.merge(seg_gdf, volume_df, on='id', how='left')
+    print(('Length of merged: {}, Length of seg_df: {}'.format(
+        len(merged_df), len(seg_df))))
 
-    print(('Length of merged: {}, Length of seg_gdf: {}'.format(
-        len(merged_df), len(seg_gdf))))
-    
     # values to run KNN on
     col_to_predict = ['heavy', 'light', 'bikes', 'speed', 'volume']
 
-    for col in col_to_predict:
-        print(('Predicting missing values for {} column'.format(col)))
-        # split into X, y, X_pred for KNN regression
-        X = merged_df[merged_df[col].notnull()][['px', 'py']]
-        y = merged_df[merged_df[col].notnull()][col]
-        X_pred = merged_df[merged_df[col].isnull()][['px', 'py']]
-
-        # predict on missing segments
-        knn = KNeighborsRegressor(3, weights='distance')
-        y_pred = knn.fit(X, y).predict(X_pred)
-
-        # create empty column to fill with predicted values
-        col_name = col + '_pred'
-        merged_df[col_name] = np.nan
-
-        merged_df.loc[merged_df[col].isnull(), col_name] = y_pred
+    # Every column is known for the same segments (the ones with a volume)
+    # so all of them can be predicted from one neighbor query
+    print('Predicting missing values for {} columns'.format(
+        ', '.join(col_to_predict)))
+    known = merged_df[col_to_predict].notnull().all(axis=1).values
+    preds = impute_nearest(
+        merged_df[['px', 'py']].values,
+        known,
+        merged_df[col_to_predict].values.astype(float)
+    )
 
     # coalesce all columns
     print('Creating coalesced columns')
 
-    for col in col_to_predict:
+    for i, col in enumerate(col_to_predict):
         col_name = col + '_coalesced'
-        pred_col = col + '_pred'
-        merged_df[col_name] = merged_df[col].combine_first(merged_df[pred_col])
-
-    # drop predicted columns
-    pred_cols = [col + '_pred' for col in col_to_predict]
-
-    # drop
-    merged_df.drop(labels=pred_cols, axis=1, inplace=True)
-    # in pandas 0.21.0 do:
-    # merged_df.drop(columns=pred_cols, axis=1, inplace=True)
+        merged_df[col_name] = merged_df[col]
+        merged_df.loc[~known, col_name] = preds[:, i]
 
     # write to csv
     print('Writing to CSV')
@@ -239,7 +246,6 @@ def propagate_volume():
 
     merged_df.to_csv(output_fp, index=False)
     update_properties(
-        combined_seg,
         merged_df,
         ['volume', 'speed', 'volume_coalesced', 'speed_coalesced']
     )
@@ -1,13 +1,36 @@
-from pyproj import Transformer
 from . import util
 from dateutil.parser import parse
 
+
+class LazyTransformer(object):
+    """
+    A pyproj transformer between two projections, created the first time
+    it's used, so stages that don't reproject don't have to import pyproj
+    """
+
+    def __init__(self, from_proj, to_proj):
+        self.from_proj = from_proj
+        self.to_proj = to_proj
+        self.transformer = None
+
+    def transform(self, *args, **kwargs):
+        if self.transformer is None:
+            from pyproj import Transformer
+            self.transformer = Transformer.from_proj(
+                self.from_proj, self.to_proj, always_xy=True)
+        return self.transformer.transform(*args, **kwargs)
+
+    def __getstate__(self):
+        # Created again after unpickling, e.g. in a worker process
+        state = dict(self.__dict__)
+        state['transformer'] = None
+        return state
+
+
 # transformer object between 4326 projection and 3857 projection
-transformer_4326_to_3857 = Transformer.from_proj(
-    4326, 3857, always_xy=True)
+transformer_4326_to_3857 = LazyTransformer(4326, 3857)
 # transformer object between 3857 projection and 4326 projection
-transformer_3857_to_4326 = Transformer.from_proj(
-    3857, 4326, always_xy=True)
+transformer_3857_to_4326 = LazyTransformer(3857, 4326)
 
 
 class Record(object):
@@ -0,0 +1,84 @@
+# Side-car table of segment attributes, keyed by segment id
+# Stages that compute a feature for existing segments (e.g. volume
+# propagation) append columns here instead of rewriting the segment
+# geojson files, so geometry is never re-read, reprojected or rewritten
+# just to add a feature.  Readers join the table onto segment properties
+# when they need it.
+import os
+import pandas as pd
+
+ATTRIBUTES_FILE = 'segment_attributes.csv'
+
+
+def attributes_path(mapfp):
+    """
+    Path to the attributes table in a maps directory
+    """
+    return os.path.join(mapfp, ATTRIBUTES_FILE)
+
+
+def read_attributes(mapfp):
+    """
+    Read the segment attributes for a maps directory
+    Args:
+        mapfp - maps directory
+    Returns:
+        dataframe indexed by segment id (as a string), empty if
+        no attributes have been written
+    """
+    fp = attributes_path(mapfp)
+    if not os.path.exists(fp):
+        return pd.DataFrame(index=pd.Index([], name='id'))
+
+    return pd.read_csv(fp, dtype={'id': str}).set_index('id')
+
+
+def add_attributes(mapfp, df, features):
+    """
+    Add or replace columns in the segment attributes table
+    Args:
+        mapfp - maps directory
+        df - dataframe with an id column and the feature columns
+        features - list of columns of df to add
+    """
+    new = df[['id'] + features].copy()
+    new['id'] = new['id'].astype('str')
+    new = new.drop_duplicates('id').set_index('id')
+
+    attributes = read_attributes(mapfp)
+    attributes = attributes.drop(
+        columns=[x for x in features if x in attributes.columns])
+    attributes = attributes.join(new, how='outer')
+
+    attributes.to_csv(attributes_path(mapfp), index_label='id')
+    print("Wrote {} to segment attributes".format(', '.join(features)))
+
+
+def join_attributes(df, mapfp):
+    """
+    Join the segment attributes onto a dataframe of segment properties
+    Attributes take precedence over properties with the same name
+    Args:
+        df - dataframe indexed by segment id
+        mapfp - maps directory
+    Returns:
+        dataframe with the attribute columns added
+    """
+    attributes = read_attributes(mapfp)
+    if attributes.empty:
+        return df
+
+    df = df.drop(columns=[x for x in attributes.columns if x in df.columns])
+    return df.join(attributes, on=df.index.astype('str'))
+
+
+def remove_attributes(mapfp):
+    """
+    Remove the attributes table, e.g. when the segments are regenerated
+    and the ids no longer refer to the same segments
+    Args:
+        mapfp - maps directory
+    """
+    fp = attributes_path(mapfp)
+    if os.path.exists(fp):
+        os.remove(fp)
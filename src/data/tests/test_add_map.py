@@ -1,6 +1,11 @@
 import os
 import subprocess
 import shutil
+import rtree
+from shapely.geometry import LineString, Point
+from shapely.ops import unary_union
+from .. import add_map
+from ..segment import Segment
 
 
 def test_add_map(tmpdir):
@@ -79,3 +84,73 @@ def test_add_map(tmpdir):
         path,
         'boston',
     ])
+
+
+def test_get_distances():
+    line = LineString([(0, 0), (10, 0)])
+    candidates = [
+        LineString([(0, 3), (5, -4)]),
+        LineString([(2, 0), (4, 0)]),
+    ]
+    candidate_distances, line_distances = add_map.get_distances(
+        (line, candidates))
+
+    # The furthest vertex of each candidate from the line
+    assert candidate_distances == [4, 0]
+    # The furthest vertex of the line from each candidate
+    for candidate, distance in zip(candidates, line_distances):
+        assert round(distance, 8) == round(max(
+            Point(coord).distance(candidate) for coord in line.coords), 8)
+
+
+def test_within_buffer():
+    line = LineString([(0, 0), (10, 0)])
+    assert add_map.within_buffer([(5, 4)], line, 4, 5, {})
+    assert not add_map.within_buffer([(5, 6)], line, 6, 5, {})
+
+    # Just inside 5 meters from the end of the line, where the
+    # buffer polygon cuts off the corner of the circle
+    buffers = {}
+    corner = (10 + 4.999 * 0.7071, 4.999 * 0.7071)
+    distance = Point(corner).distance(line)
+    assert add_map.within_buffer([corner], line, distance, 5, buffers) \
+        == Point(corner).within(line.buffer(5))
+    assert 5 in buffers
+
+
+def test_get_overlap():
+    line_buffer = LineString([(0, 0), (30, 0)]).buffer(10)
+    buffer = LineString([(5, 2), (40, 2)]).buffer(10)
+    overlap = add_map.get_overlap(
+        (line_buffer, line_buffer.area, line_buffer.bounds),
+        (buffer, buffer.area, buffer.bounds))
+    assert round(overlap, 8) == round(
+        buffer.area / unary_union([line_buffer, buffer]).area, 8)
+
+    # Can't be better than an overlap we already have
+    far = LineString([(25, 15), (60, 15)]).buffer(10)
+    assert add_map.get_overlap(
+        (line_buffer, line_buffer.area, line_buffer.bounds),
+        (far, far.area, far.bounds), .9) is None
+
+
+def test_get_int_mapping():
+    lines = [
+        Segment(LineString([(0, 0), (20, 0)]), {'id': 1}),
+        Segment(LineString([(100, 0), (120, 0)]), {'id': 2}),
+        Segment(LineString([(300, 0), (320, 0)]), {'id': 3}),
+    ]
+    other = [
+        LineString([(1, 1), (21, 1)]),
+        LineString([(95, 8), (125, 8)]),
+        LineString([(101, 2), (119, 2)]),
+    ]
+    buffered = []
+    index = rtree.index.Index()
+    for i, geometry in enumerate(other):
+        buffer = geometry.buffer(10)
+        buffered.append((buffer, geometry, {'id': 'new' + str(i)}))
+        index.insert(i, buffer.bounds)
+
+    results = add_map.get_int_mapping(lines, buffered, index)
+    assert [x[2].get('id') for x in results] == ['new0', 'new2', None]
@@ -133,3 +133,21 @@ def test_concerns_by_type():
          67.0, 2, 3, 100.0, 1, 1, 50.0, 1, 2],
         ["people don't yield while turning", 0.0, 0, 1, 0.0, 0, 0, 0.0, 0, 1]
     ]
+
+
+def test_concern_percentages_gaps():
+    def counts(inter_crash, inter_no_crash, crash, no_crash):
+        return {'inter': {'crash': inter_crash, 'no_crash': inter_no_crash},
+                'non_inter': {'crash': crash, 'no_crash': no_crash}}
+
+    # Every location with at least that many concerns is counted,
+    # even when some numbers of concerns have no locations
+    results = analysis_util.concern_percentages([
+        (1, counts(0, 1, 0, 1)),
+        (3, counts(1, 0, 0, 0)),
+        (4, counts(0, 0, 1, 0)),
+        (5, counts(0, 0, 1, 1)),
+    ])
+    assert [x[2] for x in results] == [6, 4, 3, 2]
+    assert [x[1] for x in results] == [50.0, 75.0, 67.0, 50.0]
+    assert [x[4] for x in results] == [2, 1, 0, 0]
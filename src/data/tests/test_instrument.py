@@ -0,0 +1,112 @@
+import os
+import subprocess
+import sys
+import pytest
+from .. import instrument
+
+SRC_FP = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def trace(tmpdir, monkeypatch):
+    for var in [instrument.TRACE_FILE, instrument.RUN_ID,
+                instrument.PARENT_SPAN]:
+        monkeypatch.delenv(var, raising=False)
+    trace_file = instrument.start_run(str(tmpdir))
+    yield trace_file
+    # start_run sets these in os.environ directly
+    for var in [instrument.TRACE_FILE, instrument.RUN_ID]:
+        os.environ.pop(var, None)
+
+
+def test_span(trace):
+    @instrument.traced
+    def snap(records):
+        instrument.count('records', len(records))
+        instrument.count('records')
+        return len(records)
+
+    with instrument.span('stage') as stage:
+        assert snap([1, 2, 3]) == 3
+        stage.count('segments', 5)
+
+    with pytest.raises(ValueError):
+        with instrument.span('broken'):
+            raise ValueError()
+
+    spans = instrument.read_trace(trace)
+    assert [x['name'] for x in spans] == ['snap', 'stage', 'broken']
+    snapped, stage, broken = spans
+    assert snapped['parent'] == stage['id']
+    assert stage['parent'] is None
+    assert snapped['counters'] == {'records': 4}
+    assert stage['counters'] == {'segments': 5}
+    assert stage['run'] == snapped['run']
+    assert stage['wall'] >= snapped['wall']
+    assert broken['status'] == 'error'
+
+    rows = instrument.summarize(spans)
+    assert [(depth, x['name']) for depth, x in rows] == [
+        (0, 'stage'), (1, 'snap'), (0, 'broken')]
+
+
+def test_no_trace(tmpdir, monkeypatch):
+    monkeypatch.delenv(instrument.TRACE_FILE, raising=False)
+    with instrument.span('stage') as stage:
+        instrument.count('records')
+    assert stage.counters == {'records': 1}
+    assert not os.listdir(str(tmpdir))
+
+
+def test_check_call(trace, monkeypatch):
+    monkeypatch.chdir(SRC_FP)
+    code = """
+from data import instrument
+with instrument.span('step'):
+    instrument.count('records', 2)
+x = bytearray(64 * 1024 * 1024)
+"""
+    with instrument.span('run'):
+        instrument.check_call([sys.executable, '-c', code], name='stage')
+    with pytest.raises(subprocess.CalledProcessError):
+        instrument.check_call(
+            [sys.executable, '-c', 'import sys; sys.exit(2)'])
+
+    spans = {x['name']: x for x in instrument.read_trace(trace)}
+    assert spans['step']['parent'] == spans['stage']['id']
+    assert spans['stage']['parent'] == spans['run']['id']
+    assert spans['step']['pid'] != spans['stage']['pid']
+    assert spans['step']['counters'] == {'records': 2}
+    # The stage's memory is the subprocess's
+    assert spans['stage']['max_rss_mb'] > 64
+    assert spans[os.path.basename(sys.executable)]['status'] == 'error'
+
+
+def test_stage_name():
+    assert instrument.stage_name(
+        ['python', '-m', 'data.create_segments', '-d', 'x']) == \
+        'data.create_segments'
+    assert instrument.stage_name(['/usr/bin/python', 'x.py']) == 'python'
+
+
+def test_profile_args(tmpdir, monkeypatch):
+    monkeypatch.delenv(instrument.PROFILE_STAGES, raising=False)
+    args = ['python', '-m', 'data.create_segments', '-d', 'x']
+    assert instrument.profile_args(args, 'abc') == args
+
+    monkeypatch.setenv(instrument.PROFILE_STAGES, 'create_segments')
+    monkeypatch.setenv(instrument.PROFILE_DIR, str(tmpdir))
+    monkeypatch.delenv(instrument.PROFILE_SAMPLING, raising=False)
+    assert instrument.profile_args(args, 'abc') == [
+        'python', '-m', 'data.profiling',
+        '-o', os.path.join(str(tmpdir), 'create_segments-abc'),
+        'data.create_segments', '-d', 'x']
+    assert instrument.profile_args(
+        ['python', '-m', 'data.add_waze_data'], 'abc') == \
+        ['python', '-m', 'data.add_waze_data']
+
+    monkeypatch.setenv(instrument.PROFILE_STAGES, 'data.create_segments')
+    monkeypatch.setenv(instrument.PROFILE_SAMPLING, '1')
+    assert instrument.profile_args(args, 'abc')[3:6] == [
+        '-o', os.path.join(str(tmpdir), 'create_segments-abc'), '--sampling']
@@ -1,7 +1,11 @@
+import os
+import json
 import geopandas as gpd
-from shapely.geometry import Point
+from shapely.geometry import Point, LineString, mapping
 from pandas.util.testing import assert_frame_equal
 from .. import join_segments_crash
+from .. import record
+from .. import util
 
 
 def test_make_rollup():
@@ -113,3 +117,91 @@ def test_make_rollup():
     assert_frame_equal(results['all'], expected_rollup_total)
     assert_frame_equal(results['pedestrian'], expected_rollup_pedestrian)
     assert_frame_equal(results['bike'], expected_rollup_bike)
+
+
+def test_rollup_table(tmpdir):
+    crashes = [{
+        "dateOccurred": "2015-04-15T00:45:00-05:00",
+        "location": {"latitude": 42.365, "longitude": -71.106},
+        "pedestrian": 1
+    }, {
+        "dateOccurred": "2015-01-01T00:45:00-05:00",
+        "location": {"latitude": 42.365, "longitude": -71.106},
+        "bike": 1
+    }, {
+        "dateOccurred": "2015-01-01T00:45:00-05:00",
+        "location": {"latitude": 42.365, "longitude": -71.106},
+        "bike": 1
+    }, {
+        "dateOccurred": "2015-01-01T01:12:00-05:00",
+        "location": {"latitude": 42.361, "longitude": -71.097},
+        "bike": 1
+    }]
+    split_columns = ['bike', 'pedestrian', 'vehicle']
+    rollups = join_segments_crash.rollup_table(
+        join_segments_crash.read_crash_table(crashes, split_columns),
+        split_columns)
+
+    rollup = rollups['all']
+    assert list(rollup['longitude']) == [-71.106, -71.097]
+    assert list(rollup['total_crashes']) == [3, 1]
+    assert list(rollup['crash_dates']) == [
+        "2015-01-01T00:45:00-05:00,2015-04-15T00:45:00-05:00",
+        "2015-01-01T01:12:00-05:00"]
+    assert list(rollup['total_crashes_bike']) == [2, 1]
+    assert list(rollup['total_crashes_pedestrian']) == [1, 0]
+    assert list(rollup['crash_dates_pedestrian']) == [
+        "2015-04-15T00:45:00-05:00", ""]
+    assert list(rollups['bike']['total_crashes']) == [2, 1]
+    assert len(rollups['vehicle']) == 0
+
+    join_segments_crash.write_crash_rollups(rollups, tmpdir.strpath)
+    with open(os.path.join(tmpdir.strpath, 'crashes_rollup.geojson')) as f:
+        features = json.load(f)['features']
+    assert features[1]['geometry']['coordinates'] == [-71.097, 42.361]
+    assert features[1]['properties']['total_crashes_bike'] == 1
+    with open(os.path.join(
+            tmpdir.strpath, 'crashes_rollup_vehicle.geojson')) as f:
+        assert json.load(f)['features'] == []
+
+
+def test_snap_records_chunked(tmpdir, monkeypatch):
+    # A road running east to west through the crashes, in 3857
+    x, y = record.transformer_4326_to_3857.transform(-71.1, 42.36)
+    segments, index = util.index_segments([{
+        'geometry': mapping(LineString([(x - 500, y), (x + 500, y)])),
+        'properties': {'id': '1'}}])
+
+    crashes = [{
+        'id': i,
+        'dateOccurred': '2015-0{}-01T00:45:00-05:00'.format(i % 3 + 1),
+        # Every fourth crash is too far from the road to snap
+        'location': {'latitude': 42.36 + (0.01 if i % 4 == 3 else 0),
+                     'longitude': -71.1 + i * 0.0001},
+    } for i in range(25)]
+    crash_file = os.path.join(tmpdir.strpath, 'crashes.json')
+    with open(crash_file, 'w') as f:
+        json.dump(crashes, f)
+
+    snapped = {}
+    for chunksize in [None, 4]:
+        outdir = tmpdir.mkdir('chunks_{}'.format(chunksize)).strpath
+        monkeypatch.setattr(join_segments_crash, 'PROCESSED_DATA_FP', outdir)
+        if chunksize:
+            join_segments_crash.snap_records_chunked(
+                segments, index, crash_file, chunksize)
+        else:
+            join_segments_crash.snap_records(segments, index, crash_file)
+        with open(os.path.join(outdir, 'crash_joined.json')) as f:
+            snapped[chunksize] = json.load(f)
+
+    assert snapped[4] == snapped[None]
+    assert [x['id'] for x in snapped[4]] == [
+        x for x in range(25) if x % 4 != 3]
+    assert set(x['near_id'] for x in snapped[4]) == set(['1'])
+
+    table = join_segments_crash.read_crash_table_chunked(
+        os.path.join(outdir, 'crash_joined.json'), chunksize=5)
+    assert len(table) == 19
+    assert list(table['date'][:2]) == [
+        '2015-01-01T00:45:00-05:00', '2015-02-01T00:45:00-05:00']
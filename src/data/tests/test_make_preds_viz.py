@@ -1,4 +1,5 @@
 import os
+import json
 import pandas as pd
 import ruamel
 import shutil
@@ -142,3 +143,53 @@ def test_write_all_preds_split_column(tmpdir):
     make_preds_viz.write_all_preds(tmpdir, config)
     assert os.path.exists(os.path.join(
         tmpdir, 'processed', 'preds_viz_pedestrian.geojson'))
+
+    make_preds_viz.write_all_preds(
+        tmpdir, config, tolerance=1, precision=6, shared=True)
+    with open(os.path.join(tmpdir, 'processed', 'preds_viz.geojson')) as f:
+        properties = json.load(f)['features'][0]['properties']
+    assert properties['prediction_pedestrian'] == properties['prediction']
+
+
+def test_compact_geometry():
+    geometry = {
+        'type': 'LineString',
+        'coordinates': [[-71.06858488357565, 42.35165031556542],
+                        [-71.0686, 42.351651],
+                        [-71.06876751642436, 42.35161688446769]]
+    }
+    assert make_preds_viz.compact_geometry(geometry) == geometry
+    assert make_preds_viz.compact_geometry(geometry, precision=5) == {
+        'type': 'LineString',
+        'coordinates': [[-71.06858, 42.35165], [-71.0686, 42.35165],
+                        [-71.06877, 42.35162]]
+    }
+    # The middle point is well within a meter of the line
+    simplified = make_preds_viz.compact_geometry(geometry, tolerance=1)
+    assert len(simplified['coordinates']) == 2
+
+
+def test_make_shared_features():
+    segments = make_preds_viz.segments_to_frame(pd.read_json(os.path.join(
+        DATA_FP, "single_segment.geojson"))["features"])
+    preds = []
+    for target, prediction in (('bike', 0.1), ('pedestrian', 0.3)):
+        target_preds = make_preds_viz.predictions_to_frame([{
+            'segment_id': '001', 'prediction': prediction, 'crash': 1,
+            'osm_speed': 25}])
+        target_preds['target'] = target
+        preds.append(target_preds)
+    combined = make_preds_viz.merge_predictions(
+        pd.concat(preds, ignore_index=True), segments)
+
+    features = make_preds_viz.make_shared_features(
+        combined, ['prediction', 'crash', 'segment_id', 'osm_speed'])
+    assert len(features) == 1
+    properties = features[0]['properties']
+    assert properties['prediction'] == 0.3
+    assert properties['prediction_bike'] == 0.1
+    assert properties['prediction_pedestrian'] == 0.3
+    assert properties['crash_bike'] == 1
+    assert properties['osm_speed'] == 25
+    assert properties['segment']['id'] == '001'
+    assert 'crash' not in properties
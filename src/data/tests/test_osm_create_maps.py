@@ -4,6 +4,7 @@ from shapely.geometry import Polygon
 import networkx as nx
 import json
 import fiona
+import pandas as pd
 from .. import osm_create_maps
 from .. import util
 from .. import config
@@ -26,6 +27,62 @@ def test_get_speed():
     assert osm_create_maps.get_speed("['90', '100']") == 100
 
 
+def test_get_lanes():
+    assert osm_create_maps.get_lanes('') == 0
+    assert osm_create_maps.get_lanes(None) == 0
+    assert osm_create_maps.get_lanes('2') == 2
+    assert osm_create_maps.get_lanes("['2', '3']") == 3
+
+
+def test_parse_values():
+    speeds = pd.Series(['25 mph', None, "['25', '30']", '25 mph', ''])
+    assert list(osm_create_maps.parse_values(
+        speeds, osm_create_maps.get_speed)) == [25, 0, 30, 25, 0]
+
+
+def test_get_connections():
+    ways = [
+        {'properties': {'osmid': 1, 'name': 'Main Street',
+                        'from': 10, 'to': 11}},
+        {'properties': {'osmid': '[2, 3]', 'name': "['Elm St', 'Oak_St']",
+                        'from': 11, 'to': 12}},
+        {'properties': {'osmid': 4, 'name': None, 'from': 12, 'to': 13}},
+        {'properties': {'osmid': 5, 'name': 'Main Street',
+                        'from': 11, 'to': 13}},
+    ]
+    nodes = [{'properties': {'osmid': x}} for x in (10, 11, 12, 13, 14)]
+    nodes, ways = osm_create_maps.get_connections(ways, nodes)
+
+    assert [x['properties']['segment_id'] for x in ways] == [
+        '1-10-11', '[2, 3]-11-12', '4-12-13', '5-11-13']
+    assert ways[1]['properties']['name'] == 'Elm St/OakSt'
+    assert [x['properties']['streets'] for x in nodes] == [
+        'Main Street', 'Main Street, Elm St/OakSt', 'Elm St/OakSt',
+        'Main Street', '']
+
+
+def test_is_drive_way():
+    assert osm_create_maps.is_drive_way({'highway': 'residential'})
+    assert osm_create_maps.is_drive_way(
+        {'highway': 'primary', 'service': 'alley'})
+    assert not osm_create_maps.is_drive_way({'name': 'Park Plaza'})
+    assert not osm_create_maps.is_drive_way({'highway': 'footway'})
+    assert not osm_create_maps.is_drive_way({'highway': 'service'})
+    assert not osm_create_maps.is_drive_way(
+        {'highway': 'residential', 'access': 'private'})
+    assert not osm_create_maps.is_drive_way(
+        {'highway': 'tertiary', 'motor_vehicle': 'no'})
+
+
+def test_longest_run():
+    nodes = {1: {}, 2: {}, 3: {}, 5: {}, 6: {}, 7: {}, 8: {}}
+    assert osm_create_maps.longest_run([1, 2, 3], nodes) == [1, 2, 3]
+    # The way leaves the area at 4 and comes back
+    assert osm_create_maps.longest_run(
+        [1, 2, 4, 5, 6, 7], nodes) == [5, 6, 7]
+    assert osm_create_maps.longest_run([9, 10], nodes) == []
+
+
 def test_reproject_and_clean_feats(tmpdir):
 
     tmppath = tmpdir.strpath
@@ -85,6 +142,72 @@ def test_expand_polygon():
     assert result_shape.contains(records[2].point)
 
 
+def test_find_osm_polygon_cache(tmpdir, monkeypatch):
+    matches = [
+        {'geojson': {'type': 'Point', 'coordinates': [-71.1, 42.3]}},
+        {'geojson': {'type': 'Polygon', 'coordinates': [
+            [[-71.1, 42.3], [-71.0, 42.3], [-71.0, 42.4], [-71.1, 42.3]]]}},
+    ]
+    requested = []
+    responses = {}
+
+    class MockResponse(object):
+        def __init__(self, ok, result):
+            self.ok = ok
+            self.status_code = 200 if ok else 503
+            self.result = result
+
+        def json(self):
+            return self.result
+
+    def mockget(url, params=None):
+        requested.append(params['q'])
+        return responses.get(params['q'], MockResponse(True, matches))
+
+    monkeypatch.setattr(osm_create_maps.requests, 'get', mockget)
+    monkeypatch.setattr(osm_create_maps, 'CACHE_FP', str(tmpdir))
+
+    result = osm_create_maps.find_osm_polygon('Boston, MA')
+    assert result == (2, matches[1]['geojson'])
+    # The second lookup is read from the cache
+    assert osm_create_maps.find_osm_polygon('Boston, MA') == result
+    assert requested == ['Boston, MA']
+    osm_create_maps.find_osm_polygon('Cambridge, MA')
+    assert requested == ['Boston, MA', 'Cambridge, MA']
+
+    # Errors and empty results aren't cached
+    responses['Somerville, MA'] = MockResponse(False, {'error': 'busy'})
+    responses['Nowhere'] = MockResponse(True, [])
+    for _ in range(2):
+        assert osm_create_maps.find_osm_polygon('Somerville, MA') == (
+            None, None)
+        assert osm_create_maps.find_osm_polygon('Nowhere') == (None, None)
+    assert requested[2:] == ['Somerville, MA', 'Nowhere'] * 2
+
+
+def test_graph_cache_params(tmpdir, monkeypatch):
+    os.makedirs(os.path.join(tmpdir, 'maps'))
+    for ext in ('shp', 'dbf'):
+        with open(os.path.join(tmpdir, 'maps', 'city.' + ext), 'w') as f:
+            f.write(ext)
+    monkeypatch.setattr(osm_create_maps, 'RAW_FP', str(tmpdir))
+    c = config.Configuration(
+        os.path.join(TEST_FP, 'data', 'config_features.yml'))
+    c.map_geography = 'shapefile'
+    c.boundary_shapefile = 'city.shp'
+
+    params = osm_create_maps.graph_cache_params(c)
+    key = osm_create_maps.cache_key(params)
+    assert key == osm_create_maps.cache_key(
+        osm_create_maps.graph_cache_params(c))
+
+    # Changing any of the boundary files changes the key
+    with open(os.path.join(tmpdir, 'maps', 'city.dbf'), 'w') as f:
+        f.write('changed')
+    assert key != osm_create_maps.cache_key(
+        osm_create_maps.graph_cache_params(c))
+
+
 def mockreturn(config):
     G1 = nx.read_gpickle(os.path.join(TEST_FP, 'data', 'osm_output.gpickle'))
     return G1
@@ -0,0 +1,111 @@
+import json
+import os
+import shutil
+import numpy as np
+import xlrd
+from ..TMC_scraping import parse_tmc
+
+TEST_FP = os.path.dirname(os.path.abspath(__file__))
+TMC_FILE = '1_TMC_Main-St,Elm-St_12-HR_x_2015-06-01.XLS'
+
+
+def test_get_conflict_count():
+    dir_locations = {
+        'north': {'to': {'thru': 1, 'left': 2}},
+        'south': {'to': {'thru': 3, 'left': 4}},
+    }
+    counts = np.array([
+        [np.nan, np.nan, np.nan, np.nan, np.nan],
+        [np.nan, 5, 2, 1, 7],
+        [np.nan, 4, np.nan, 3, 3],
+        [np.nan, 9, 9, 9, 9],
+    ])
+    totals = np.array([False, False, False, True])
+
+    # min(2, 1) + min(7, 5) + min(3, 4); the total row is skipped,
+    # as is the left turn from the north with no count
+    assert parse_tmc.get_conflict_count(
+        dir_locations, counts, 0, totals) == 9
+
+
+def test_fit_counts():
+    counts = np.array([[1., 2.], [3., 4.]])
+    np.testing.assert_array_equal(
+        parse_tmc.fit_counts(counts, (1, 3)), [[1, 2, np.nan]])
+    np.testing.assert_array_equal(
+        parse_tmc.fit_counts(counts, (3, 1)), [[1], [3], [np.nan]])
+
+
+def test_parse_15_min_format_sheet_shapes(monkeypatch):
+    workbook = xlrd.open_workbook(
+        os.path.join(TEST_FP, 'data', 'tmc', TMC_FILE))
+    read_sheet = parse_tmc.read_sheet
+
+    def resize_second_sheet(rows, cols):
+        def mock_read_sheet(workbook, sheet_name):
+            cells, counts = read_sheet(workbook, sheet_name)
+            if sheet_name == 'Trucks & Bikes':
+                if rows > 0:
+                    counts = np.pad(counts, ((0, rows), (0, cols)),
+                                    'constant', constant_values=1000)
+                else:
+                    counts = counts[:rows, :cols]
+            return cells, counts
+        return mock_read_sheet
+
+    # Counts past the end of the first sheet are ignored
+    monkeypatch.setattr(
+        parse_tmc, 'read_sheet', resize_second_sheet(5, 3))
+    assert parse_tmc.parse_15_min_format(
+        workbook, 'Cars & Peds', 1, sheet_name2='Trucks & Bikes') == \
+        [23380, 7024, 7482, 8678, 28]
+
+    # And a smaller second sheet only counts where it has cells
+    monkeypatch.setattr(
+        parse_tmc, 'read_sheet', resize_second_sheet(-5, -2))
+    result = parse_tmc.parse_15_min_format(
+        workbook, 'Cars & Peds', 1, sheet_name2='Trucks & Bikes')
+    assert len(result) == 5
+    assert result[0] < 23380
+
+
+def test_parse_file():
+    result = parse_tmc.parse_file(
+        os.path.join(TEST_FP, 'data', 'tmc', TMC_FILE))
+    assert result == [23380, 7024, 7482, 8678, 28]
+
+
+def test_parse_files(tmpdir, monkeypatch):
+    shutil.copy(os.path.join(TEST_FP, 'data', 'tmc', TMC_FILE), tmpdir)
+    monkeypatch.setattr(parse_tmc, 'TMC_FP', str(tmpdir))
+
+    parsed = {}
+    results = parse_tmc.parse_files([TMC_FILE], parsed, processes=1)
+    assert results[TMC_FILE] == [23380, 7024, 7482, 8678, 28]
+    assert parsed[TMC_FILE]['result'] == results[TMC_FILE]
+
+    # Unchanged files aren't parsed again
+    def mockparse(file_path):
+        raise AssertionError(file_path + ' was parsed again')
+    monkeypatch.setattr(parse_tmc, 'parse_file', mockparse)
+    assert parse_tmc.parse_files(
+        [TMC_FILE], parsed, processes=1) == results
+
+
+def test_skip_files(tmpdir, monkeypatch):
+    shutil.copy(os.path.join(TEST_FP, 'data', 'tmc', TMC_FILE), tmpdir)
+    monkeypatch.setattr(parse_tmc, 'TMC_FP', str(tmpdir))
+    monkeypatch.setattr(parse_tmc, 'PROCESSED_DATA_FP', str(tmpdir))
+    assert parse_tmc.tmc_files_changed()
+
+    # A file that isn't parsed isn't new or changed the next time
+    parsed = {}
+    parse_tmc.skip_files([TMC_FILE], parsed)
+    with open(os.path.join(str(tmpdir), parse_tmc.PARSED_FILE), 'w') as f:
+        json.dump(parsed, f)
+    assert not parse_tmc.tmc_files_changed()
+
+    # But it's parsed if it's given to parse_files later
+    results = parse_tmc.parse_files([TMC_FILE], parsed, processes=1)
+    assert results[TMC_FILE] == [23380, 7024, 7482, 8678, 28]
+    assert not parsed[TMC_FILE].get('skipped')
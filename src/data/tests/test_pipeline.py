@@ -1,9 +1,11 @@
 
 import os
+import gzip
 import shutil
 import pipeline
 import ruamel
 import data.config
+from showcase import tiles
 
 
 TEST_FP = os.path.dirname(os.path.abspath(__file__))
@@ -35,7 +37,7 @@ def test_copy_files(tmpdir):
         os.path.join(
             data_dir,
             'processed',
-            'preds_viz_pedestrian.geojson'
+            'preds_viz.geojson'
         )
     )
     shutil.copy(
@@ -43,11 +45,11 @@ def test_copy_files(tmpdir):
             TEST_FP,
             'data',
             'viz_preds_tests',
-            'crashes_rollup_pedestrian.geojson'),
+            'crashes_rollup.geojson'),
         os.path.join(
             data_dir,
             'processed',
-            'crashes_rollup_pedestrian.geojson'
+            'crashes_rollup.geojson'
         )
     )
     config_dict = {
@@ -74,7 +76,7 @@ def test_copy_files(tmpdir):
         ruamel.yaml.round_trip_dump(config_dict, f)
     config = data.config.Configuration(config_filename)
 
-    pipeline.copy_files(
+    files = pipeline.copy_files(
         base_dir,
         data_dir,
         config
@@ -85,14 +87,45 @@ def test_copy_files(tmpdir):
         'showcase',
         'data',
         'cambridge',
-        'crashes_rollup_pedestrian.geojson'))
+        'crashes_rollup.geojson'))
     assert os.path.exists(os.path.join(
         base_dir,
         'src',
         'showcase',
         'data',
         'cambridge',
-        'preds_viz_pedestrian.geojson'))
+        'preds_viz.geojson'))
+
+    # Content-hashed and compressed copies are written too
+    showcase_dir = os.path.join(
+        base_dir, 'src', 'showcase', 'data', 'cambridge')
+    hashed_file = files['preds_viz.geojson']
+    assert hashed_file.startswith('preds_viz.')
+    assert hashed_file.endswith('.geojson')
+    assert os.path.exists(os.path.join(showcase_dir, hashed_file))
+    with gzip.open(os.path.join(showcase_dir, hashed_file + '.gz')) as f:
+        with open(orig_file, 'rb') as orig:
+            assert f.read() == orig.read()
+    # and the low zoom tiles
+    x, y = tiles.lonlat_to_world(-71.0686, 42.3516)
+    assert os.path.exists(os.path.join(
+        showcase_dir, hashed_file + '.tiles', '12',
+        str(int(x * 2 ** 12)), '{}.pbf'.format(int(y * 2 ** 12))))
+
+    # Copying again with the same contents gives the same name,
+    # and doesn't leave old copies around, just the plain and hashed files
+    assert pipeline.copy_files(base_dir, data_dir, config) == files
+    assert len([x for x in os.listdir(showcase_dir)
+                if x.startswith('preds_viz.')
+                and x.endswith('.geojson')]) == 2
+
+    pipeline.make_js_config(base_dir, config, files)
+    with open(os.path.join(
+            base_dir, 'src', 'showcase', 'data', 'config_cambridge.js')) as f:
+        js_config = f.read()
+    assert 'file: "data/cambridge/{}"'.format(hashed_file) in js_config
+    assert 'tiles: "tiles/cambridge/{}"'.format(
+        os.path.splitext(hashed_file)[0]) in js_config
 
 
 def test_make_js_config_brisbane(tmpdir):
@@ -131,7 +164,10 @@ def test_make_js_config_brisbane(tmpdir):
         longitude: 153.0251235,
         speed_unit: "kph",
         file: "data/brisbane/preds_viz.geojson",
-        crashes: "data/brisbane/crashes_rollup.geojson"
+        crashes: "data/brisbane/crashes_rollup.geojson",
+        tiles: "tiles/brisbane/preds_viz",
+        crash_tiles: "tiles/brisbane/crashes_rollup",
+        api: "api/brisbane/preds_viz"
     }
 ]"""
     expected_file_contents = expected_file_contents.lstrip()
@@ -180,23 +216,18 @@ def test_make_js_config_boston(tmpdir):
     # check that the file contents generated is identical to a pre-built string
     expected_file_contents = """var config = [
     {
-        name: "Boston, Massachusetts, USA (pedestrian)",
-        id: "boston_pedestrian",
-        latitude: 42.3600825,
-        longitude: -71.0588801,
-        speed_unit: "mph",
-        file: "data/boston/preds_viz_pedestrian.geojson",
-        crashes: "data/boston/crashes_rollup_pedestrian.geojson"
-    },
-    {
-        name: "Boston, Massachusetts, USA (bike)",
-        id: "boston_bike",
+        name: "Boston, Massachusetts, USA",
+        id: "boston",
         latitude: 42.3600825,
         longitude: -71.0588801,
         speed_unit: "mph",
-        file: "data/boston/preds_viz_bike.geojson",
-        crashes: "data/boston/crashes_rollup_bike.geojson"
-    },
+        targets: ["pedestrian", "bike"],
+        file: "data/boston/preds_viz.geojson",
+        crashes: "data/boston/crashes_rollup.geojson",
+        tiles: "tiles/boston/preds_viz",
+        crash_tiles: "tiles/boston/crashes_rollup",
+        api: "api/boston/preds_viz"
+    }
 ]"""
     expected_file_contents = expected_file_contents.lstrip()
 
@@ -0,0 +1,66 @@
+import cProfile
+import os
+import pstats
+import sys
+import pytest
+from .. import instrument
+from .. import profiling
+
+SRC_FP = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+
+def inner():
+    return sum(i * i for i in range(20000))
+
+
+def outer():
+    return [inner() for _ in range(10)]
+
+
+def test_stats_to_stacks():
+    profiler = cProfile.Profile()
+    profiler.enable()
+    outer()
+    profiler.disable()
+
+    stacks = profiling.stats_to_stacks(pstats.Stats(profiler))
+    outer_label = profiling.frame_label(
+        'outer', __file__, outer.__code__.co_firstlineno)
+    inner_label = profiling.frame_label(
+        'inner', __file__, inner.__code__.co_firstlineno)
+    in_inner = [stack for stack in stacks if inner_label in stack]
+    assert in_inner
+    for stack in in_inner:
+        frames = stack.split(';')
+        assert frames.index(outer_label) < frames.index(inner_label)
+    # Most of the time is spent below inner
+    assert sum(stacks[x] for x in in_inner) > 0.5 * sum(stacks.values())
+
+
+def test_write_collapsed(tmpdir):
+    filename = os.path.join(str(tmpdir), 'x.collapsed')
+    profiling.write_collapsed({'a;b': 3, 'a': 1}, filename)
+    with open(filename) as f:
+        assert f.read() == 'a 1\na;b 3\n'
+
+
+@pytest.mark.parametrize('sampling', [False, True])
+def test_profile_stage(tmpdir, monkeypatch, sampling):
+    monkeypatch.chdir(SRC_FP)
+    for var in [instrument.TRACE_FILE, instrument.PROFILE_SAMPLING]:
+        monkeypatch.delenv(var, raising=False)
+    try:
+        instrument.start_profiling(str(tmpdir), 'timeit', sampling)
+        instrument.check_call(
+            [sys.executable, '-m', 'timeit', '-n', '1000', 'sorted([3, 1])'])
+    finally:
+        for var in [instrument.PROFILE_STAGES, instrument.PROFILE_DIR,
+                    instrument.PROFILE_SAMPLING]:
+            os.environ.pop(var, None)
+
+    files = os.listdir(os.path.join(str(tmpdir), 'profiles'))
+    extensions = sorted(os.path.splitext(x)[1] for x in files)
+    assert extensions == (['.collapsed'] if sampling
+                          else ['.collapsed', '.prof'])
+    assert all(x.startswith('timeit-') for x in files)
@@ -0,0 +1,32 @@
+import numpy as np
+from sklearn.neighbors import KNeighborsRegressor
+from shapely.geometry import LineString
+from .. import propagate_volume
+from ..segment import Segment
+
+
+def test_get_centroids():
+    segments = [
+        Segment(LineString([(0, 0), (2, 0)]), {'id': 1}),
+        Segment(LineString([(0, 0), (0, 4)]), {'id': '001'}),
+    ]
+    result = propagate_volume.get_centroids(segments)
+    assert result.tolist() == [[1, 0], [0, 2]]
+
+
+def test_impute_nearest():
+    rng = np.random.RandomState(1)
+    coords = rng.uniform(0, 100, size=(50, 2))
+    values = rng.randint(0, 1000, size=(50, 3)).astype(float)
+    known = rng.uniform(size=50) < .3
+    # An unknown point on top of a known point takes the known value
+    coords[np.where(~known)[0][0]] = coords[np.where(known)[0][0]]
+
+    result = propagate_volume.impute_nearest(coords, known, values)
+
+    assert result.shape == ((~known).sum(), 3)
+    for i in range(3):
+        knn = KNeighborsRegressor(3, weights='distance')
+        expected = knn.fit(coords[known], values[known, i]).predict(
+            coords[~known])
+        np.testing.assert_allclose(result[:, i], expected)
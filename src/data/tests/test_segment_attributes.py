@@ -0,0 +1,56 @@
+import os
+import pandas as pd
+from .. import segment_attributes
+
+
+def test_add_and_read_attributes(tmpdir):
+    mapfp = tmpdir.strpath
+
+    assert segment_attributes.read_attributes(mapfp).empty
+
+    segment_attributes.add_attributes(mapfp, pd.DataFrame({
+        'id': [1, '001'],
+        'volume': [100, 200],
+        'speed': [25, 30],
+    }), ['volume'])
+    segment_attributes.add_attributes(mapfp, pd.DataFrame({
+        'id': ['001', '002'],
+        'Conflict': [3, 4],
+    }), ['Conflict'])
+    # Re-adding a column replaces it
+    segment_attributes.add_attributes(mapfp, pd.DataFrame({
+        'id': [1, '001'],
+        'volume': [150, 250],
+    }), ['volume'])
+
+    result = segment_attributes.read_attributes(mapfp)
+    assert sorted(result.columns) == ['Conflict', 'volume']
+    assert result.loc['1', 'volume'] == 150
+    assert result.loc['001', 'volume'] == 250
+    assert result.loc['002', 'Conflict'] == 4
+    assert pd.isnull(result.loc['1', 'Conflict'])
+
+
+def test_join_attributes(tmpdir):
+    mapfp = tmpdir.strpath
+    props = pd.DataFrame({
+        'id': [1, '001', '002'],
+        'width': [24, 12, 15],
+        'volume': [None, None, None],
+    }).set_index('id')
+
+    # Nothing to join yet
+    assert segment_attributes.join_attributes(props, mapfp).equals(props)
+
+    segment_attributes.add_attributes(mapfp, pd.DataFrame({
+        'id': [1, '001'],
+        'volume': [100, 200],
+    }), ['volume'])
+
+    result = segment_attributes.join_attributes(props, mapfp)
+    assert list(result.index) == [1, '001', '002']
+    assert list(result.width) == [24, 12, 15]
+    assert list(result.volume.fillna(0)) == [100, 200, 0]
+
+    segment_attributes.remove_attributes(mapfp)
+    assert not os.path.exists(segment_attributes.attributes_path(mapfp))
@@ -1,6 +1,10 @@
 from .. import util
+from .. import record
 from ..segment import Segment
 import os
+import json
+import pickle
+import pytest
 from shapely.geometry import Point, LineString, MultiLineString
 import fiona
 import geojson
@@ -230,3 +234,75 @@ def test_output_from_shapes(tmpdir):
             items['features'][1]['geometry']['coordinates'][0][0],
             [-71.11198305054148, 42.37143999999999])
 
+
+def test_lazy_transformer():
+    transformer = record.LazyTransformer(4326, 3857)
+    assert transformer.transformer is None
+    x, y = transformer.transform(-71.06, 42.36)
+    assert round(x) == -7910363 and round(y) == 5215059
+    assert transformer.transformer is not None
+
+    # Pickles without the pyproj transformer, which is created again
+    copy = pickle.loads(pickle.dumps(transformer))
+    assert copy.transformer is None
+    assert copy.transform(-71.06, 42.36) == (x, y)
+
+
+def test_iter_json_list(tmpdir):
+    items = [{'id': i, 'text': 'x' * i, 'nested': [{'close': ']'}]}
+             for i in range(20)]
+    filename = os.path.join(tmpdir.strpath, 'items.json')
+    with open(filename, 'w') as f:
+        json.dump(items, f, indent=2)
+    # Small buffers split items between reads
+    for buffer_size in [1, 7, 2 ** 20]:
+        assert list(util.iter_json_list(filename, buffer_size)) == items
+
+    # Numbers that end at the end of a read
+    numbers = [1234, -5.5e10, 7, 0, 123456789]
+    with open(filename, 'w') as f:
+        f.write(json.dumps(numbers).replace(' ', ''))
+    for buffer_size in range(1, 12):
+        assert list(util.iter_json_list(filename, buffer_size)) == numbers
+
+    with open(filename, 'w') as f:
+        f.write(' [\n] ')
+    assert list(util.iter_json_list(filename)) == []
+
+    with open(filename, 'w') as f:
+        f.write('[{"id": 1}, {"id": ')
+    with pytest.raises(ValueError):
+        list(util.iter_json_list(filename, 4))
+
+
+def test_chunks():
+    assert list(util.chunks(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(util.chunks([], 2)) == []
+
+
+def test_find_nearest_in_parallel():
+    # A grid of lines 100 apart, with points scattered around it,
+    # some between two lines and some too far from any
+    segments = [Segment(LineString([(x, 0), (x, 1000)]), {'id': 'v' + str(x)})
+                for x in range(0, 1001, 100)]
+    segments += [Segment(LineString([(0, y), (1000, y)]), {'id': 'h' + str(y)})
+                 for y in range(0, 1001, 100)]
+    segments, segments_index = util.index_segments(segments, segment=True)
+    points = [Point((i * 37) % 1300 - 150, (i * 53) % 1100 - 50)
+              for i in range(300)] + [Point(50, 50), Point(110, 110)]
+
+    serial = [util.nearest_segment(p, segments, segments_index, 20)
+              for p in points]
+    assert None in serial
+    # Small tiles, so points near tile edges are snapped to
+    # segments from the neighbouring tiles
+    assert util.snap_in_parallel(
+        points, segments, segments_index, 20, 2, tile_size=150) == serial
+
+    records = [{'point': p, 'properties': {}} for p in points]
+    util.find_nearest(records, segments, segments_index, 20, processes=2)
+    assert [x['properties']['near_id'] for x in records] == [
+        '' if x is None else segments[x].properties['id'] for x in serial]
+    # Equally close to two lines, the first in the list is used
+    assert records[-2]['properties']['near_id'] == ''
+    assert records[-1]['properties']['near_id'] == 'v100'
@@ -1,8 +1,10 @@
-import fiona
-import pyproj
+# fiona, matplotlib and segment_attributes (which needs pandas) are
+# imported in the functions that use them, since every stage imports
+# this module and most of them don't need all of these
+import math
 import rtree
+from multiprocessing import Pool, cpu_count
 from shapely.geometry import Point, shape, mapping, MultiLineString, LineString
-from matplotlib import pyplot
 import os
 import json
 from dateutil.parser import parse
@@ -10,10 +12,10 @@ import datetime
 from .record import Crash, Record
 import geojson
 from .segment import Segment
+from . import instrument
 from .record import transformer_4326_to_3857, transformer_3857_to_4326
 
 
-PROJ = pyproj.Proj(init='epsg:3857')
 BASE_DIR = os.path.dirname(
     os.path.dirname(
         os.path.dirname(
@@ -21,6 +23,9 @@ BASE_DIR = os.path.dirname(
 
 MAP_FP = BASE_DIR + '/data/processed/maps'
 PROCESSED_DATA_FP = BASE_DIR + '/data/processed/'
+# Width and height of the tiles records are split into
+# to snap them to segments in parallel, in meters
+SNAP_TILE_SIZE = 2000
 
 
 
@@ -57,6 +62,7 @@ def plot_hourly_rates(all_counts, outfile):
         all_counts - a list of lists of percentages
         outfile - where to write the resulting plot
     """
+    from matplotlib import pyplot
 
     bins = list(range(0, 24))
     for val in all_counts:
@@ -151,11 +157,7 @@ def read_records(filename, record_type,
             record = Record(item)
         records.append(record)
 
-    if startdate:
-        records = [x for x in records if x.timestamp >= parse(startdate)]
-    if enddate:
-        records = [x for x in records
-                   if x.timestamp < parse(enddate) + datetime.timedelta(1)]
+    records = filter_by_date(records, startdate, enddate)
 
     # Keep track of the earliest and latest crash date used
     start = min([x.timestamp for x in records])
@@ -168,52 +170,227 @@ def read_records(filename, record_type,
     return records
 
 
+def filter_by_date(records, startdate=None, enddate=None):
+    """
+    Keep the records from startdate through enddate
+    Args:
+        records - list of Records
+        startdate - optional first date, e.g. 2016-01-01
+        enddate - optional last date
+    Returns:
+        list of Records
+    """
+    if startdate:
+        records = [x for x in records if x.timestamp >= parse(startdate)]
+    if enddate:
+        records = [x for x in records
+                   if x.timestamp < parse(enddate) + datetime.timedelta(1)]
+    return records
+
+
+def iter_json_list(filename, buffer_size=2 ** 20):
+    """
+    Read the objects in a json file containing a list one at a time,
+    without reading the whole file into memory
+    Args:
+        filename - json file of a list of objects, e.g. crashes.json
+        buffer_size - number of characters to read at a time
+    Returns:
+        generator of the items in the list
+    """
+    decoder = json.JSONDecoder()
+    with open(filename) as f:
+        buffer = f.read(buffer_size).lstrip()
+        if not buffer.startswith('['):
+            raise ValueError("{} isn't a json list".format(filename))
+        position = 1
+        while True:
+            # Skip the whitespace and commas between items,
+            # reading more of the file if we get to the end
+            while position == len(buffer) or \
+                    buffer[position] in ' \t\r\n,':
+                if position == len(buffer):
+                    buffer = f.read(buffer_size)
+                    position = 0
+                    if not buffer:
+                        raise ValueError(
+                            "{} ends before the list does".format(filename))
+                else:
+                    position += 1
+            if buffer[position] == ']':
+                return
+
+            # Read more until the buffer has the whole item and the comma,
+            # bracket or whitespace after it, since part of a number
+            # (e.g. 12 of 12.5) decodes as a number too
+            while True:
+                try:
+                    item, end = decoder.raw_decode(buffer, position)
+                    if end < len(buffer) and buffer[end] in ' \t\r\n,]':
+                        break
+                except ValueError:
+                    pass
+                more = f.read(buffer_size)
+                if not more:
+                    # Raises if the file ends partway through the item
+                    item, end = decoder.raw_decode(buffer, position)
+                    break
+                buffer = buffer[position:] + more
+                position = 0
+            position = end
+            yield item
+
+
+def chunks(items, size):
+    """
+    Split an iterable into lists of at most size items
+    """
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def nearest_segment(point, segments, segments_index, tolerance):
+    """
+    Find the nearest segment to a point, among the segments whose bounds
+    are within tolerance of it
+    If segments are the same distance away, the first in the list is used
+    Args:
+        point - shapely point
+        segments - list of Segments
+        segments_index - rtree index of the segments' bounds
+        tolerance - distance in each direction to look for segments
+    Returns:
+        the nearest segment's position in segments, or None if
+        there aren't any nearby
+    """
+    bounds = point.buffer(tolerance).bounds
+    nearest = None
+    for index in segments_index.intersection(bounds):
+        distance = (segments[index].geometry.distance(point), index)
+        if nearest is None or distance < nearest:
+            nearest = distance
+    return nearest[1] if nearest else None
+
+
+def snap_tile(args):
+    """
+    Find the nearest segment to each point in a tile
+    Args:
+        tuple of the points' coordinates, list of (position, geometry)
+        of the segments near the tile, sorted by position, and tolerance
+    Returns:
+        the nearest segment's position for each point, or None
+    """
+    coords, tile_segments, tolerance = args
+    segments = [Segment(geometry, {}) for _, geometry in tile_segments]
+    segments_index = rtree.index.Index()
+    for idx, element in enumerate(segments):
+        segments_index.insert(idx, element.geometry.bounds)
+
+    results = []
+    for x, y in coords:
+        index = nearest_segment(
+            Point(x, y), segments, segments_index, tolerance)
+        results.append(None if index is None else tile_segments[index][0])
+    return results
+
+
+def snap_in_parallel(points, segments, segments_index, tolerance,
+                     processes=None, tile_size=SNAP_TILE_SIZE):
+    """
+    Find the nearest segment to each point, with the points split into
+    square tiles that are snapped in parallel.  Each tile is only sent
+    the segments near it, and a segment's position in segments is used
+    to choose between segments the same distance away, so the result is
+    the same as snapping each point with nearest_segment
+    Args:
+        points - list of shapely points
+        segments - list of Segments
+        segments_index - rtree index of the segments' bounds
+        tolerance - distance in each direction to look for segments
+        processes - number of processes to use, None for all the cpus
+        tile_size - width and height of the tiles
+    Returns:
+        the nearest segment's position for each point, or None
+    """
+    # Points are sent to the processes as coordinates, which is
+    # quicker than pickling them
+    coords = [point.coords[0] for point in points]
+    tiles = {}
+    for i, (x, y) in enumerate(coords):
+        tiles.setdefault((math.floor(x / tile_size),
+                          math.floor(y / tile_size)), []).append(i)
+    tiles = sorted(tiles.items())
+
+    # The halo around each tile includes every segment a point in the
+    # tile could be snapped to, with room to spare for rounding
+    halo = 2 * tolerance
+    args = []
+    for (x, y), indexes in tiles:
+        nearby = sorted(segments_index.intersection((
+            x * tile_size - halo, y * tile_size - halo,
+            (x + 1) * tile_size + halo, (y + 1) * tile_size + halo)))
+        args.append((
+            [coords[i] for i in indexes],
+            [(j, segments[j].geometry) for j in nearby],
+            tolerance))
+
+    with Pool(processes) as pool:
+        results = pool.map(snap_tile, args)
+
+    nearest = [None] * len(points)
+    for (_, indexes), result in zip(tiles, results):
+        for i, index in zip(indexes, result):
+            nearest[i] = index
+    return nearest
+
+
+@instrument.traced
 def find_nearest(records, segments, segments_index, tolerance,
-                 type_record=False):
+                 type_record=False, processes=1):
     """ Finds nearest segment to records
     tolerance : max units distance from record point to consider
+    processes : number of processes to snap with, None for all the cpus
     """
 
     print("Using tolerance {}".format(tolerance))
 
-    for record in records:
-
-        # We are in process of transition to using Record class
-        # but haven't converted it everywhere, so until we do, need
-        # to look at whether the records are of type record or not
-        record_point = None
-        if type_record:
-            record_point = record.point
-        else:
-            record_point = record['point']
+    # We are in process of transition to using Record class
+    # but haven't converted it everywhere, so until we do, need
+    # to look at whether the records are of type record or not
+    if type_record:
+        points = [record.point for record in records]
+    else:
+        points = [record['point'] for record in records]
 
-        record_buffer_bounds = record_point.buffer(tolerance).bounds
-        nearby_segments = segments_index.intersection(record_buffer_bounds)
+    processes = processes or cpu_count()
+    if processes == 1 or len(records) < 2:
+        nearest = [nearest_segment(
+            point, segments, segments_index, tolerance) for point in points]
+    else:
+        nearest = snap_in_parallel(
+            points, segments, segments_index, tolerance, processes)
 
-        segment_id_with_distance = [
-            # Get db index and distance to point
-            (
-                segments[segment_id].properties['id'],
-                segments[segment_id].geometry.distance(record_point)
-            )
-            for segment_id in nearby_segments
-        ]
-
-        # Find nearest segment
-        if len(segment_id_with_distance):
-            nearest = min(segment_id_with_distance, key=lambda tup: tup[1])
-            db_segment_id = nearest[0]
-            # Add db_segment_id to record
-            if type_record:
-                record.near_id = db_segment_id
-            else:
-                record['properties']['near_id'] = db_segment_id
+    snapped = 0
+    for record, index in zip(records, nearest):
         # If no segment matched, populate key = ''
+        db_segment_id = ''
+        if index is not None:
+            db_segment_id = segments[index].properties['id']
+            snapped += 1
+        if type_record:
+            record.near_id = db_segment_id
         else:
-            if type_record:
-                record.near_id = ''
-            else:
-                record['properties']['near_id'] = ''
+            record['properties']['near_id'] = db_segment_id
+
+    instrument.count('records', len(records))
+    instrument.count('records_snapped', snapped)
 
 
 def read_segments(dirname=MAP_FP, get_inter=True, get_non_inter=True):
@@ -228,6 +405,7 @@ def read_segments(dirname=MAP_FP, get_inter=True, get_non_inter=True):
     Returns:
         The segments and spatial index
     """
+    import fiona
 
     inter = []
     non_inter = []
@@ -283,9 +461,7 @@ def index_segments(segments, geojson=True, segment=False):
 def group_json_by_field(items, field):
     results = {}
     for item in items:
-        if item[field] not in list(results.keys()):
-            results[item[field]] = []
-        results[item[field]].append(item)
+        results.setdefault(item[field], []).append(item)
     return results
 
 
@@ -305,14 +481,15 @@ def group_json_by_location(
     for item in items:
         if not years or (
                 years and yearfield and parse(item[yearfield]).year in years):
-            if str(item['near_id']) not in list(locations.keys()):
+            near_id = str(item['near_id'])
+            if near_id not in locations:
                 d = {'count': 0}
                 for field in otherfields:
                     d[field] = []
-                locations[str(item['near_id'])] = d
-            locations[str(item['near_id'])]['count'] += 1
+                locations[near_id] = d
+            locations[near_id]['count'] += 1
             for field in otherfields:
-                locations[str(item['near_id'])][field].append(item[field])
+                locations[near_id][field].append(item[field])
 
     return items, locations
 
@@ -493,6 +670,8 @@ def get_roads_and_inters(filename):
     Returns:
         roads, intersections
     """
+    import fiona
+
     data = fiona.open(filename)
 
     data = reproject_records([x for x in data])
@@ -566,11 +745,15 @@ def output_from_shapes(items, filename):
 def write_segments(non_inters, inters, mapfp):
     """
     Writes non_inters, inters and combined inter_and_non_int.geojson
+    Any segment attributes from a previous run are removed, since
+    they refer to the old segments
     Args:
         non_inters - list of non_inters segment objects
         inters - list of inters segment objects
         mapfp - maps directory to write to
     """
+    from . import segment_attributes
+
     # Store non-intersection segments
 
     non_inters = write_records_to_geojson(
@@ -588,4 +771,6 @@ def write_segments(non_inters, inters, mapfp):
     with open(os.path.join(mapfp, 'inter_and_non_int.geojson'), 'w') as outfile:
         geojson.dump(geojson.FeatureCollection(segments), outfile)
 
+    segment_attributes.remove_attributes(mapfp)
+
 
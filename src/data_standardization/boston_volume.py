@@ -4,8 +4,44 @@ import re
 import openpyxl
 from collections import OrderedDict
 import csv
+import hashlib
+import json
+from multiprocessing import Pool
 from dateutil.parser import parse
 
+# Parsed ATRs, keyed by filename, with the hash of the file they came from
+ATR_CACHE = 'atr_parsed.json'
+
+
+def file_hash(fname):
+    """
+    md5 of a file's contents, to tell if an ATR has changed
+    """
+    md5 = hashlib.md5()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def read_cells(sheet, min_row, max_row, min_col, max_col):
+    """
+    Values of a block of cells, read in a single pass over the sheet
+    (read-only sheets are streamed, so each lookup is a pass)
+    Args:
+        sheet - worksheet
+        min_row, max_row, min_col, max_col - 1-based, inclusive
+    Returns:
+        list of rows, each a tuple of values; cells past the end of
+        the sheet are None, as they are when read with sheet.cell
+    """
+    width = max_col - min_col + 1
+    rows = [tuple(row) + (None,) * (width - len(row))
+            for row in sheet.iter_rows(
+                min_row=min_row, max_row=max_row,
+                min_col=min_col, max_col=max_col, values_only=True)]
+    return rows + [(None,) * width] * (max_row - min_row + 1 - len(rows))
+
 
 class BostonVolumeParser:
     """
@@ -19,15 +55,18 @@ class BostonVolumeParser:
         self.ATR_FP = os.path.join(self.RAW_FP, "ATRs")
         self.CURR_FP = os.path.dirname(os.path.abspath(__file__))
 
-    def get_volume(self):
+    def get_volume(self, processes=None):
         """
         return volume counts for Boston
+        Args:
+            processes - number of processes to read ATRs with,
+                None for all the cpus
         """
-        atr_volume = self.get_ATRs()
+        atr_volume = self.get_ATRs(processes)
 
         return atr_volume
 
-    def get_ATRs(self):
+    def get_ATRs(self, processes=None):
 
         print("Standardizing volume data for Boston")
 
@@ -43,47 +82,56 @@ class BostonVolumeParser:
         cached = read_geocode_cache(filename=os.path.join(
             self.PROCESSED_DATA_FP, 'geocoded_addresses.csv'))
 
-        results = []
+        atrs = [atr for atr in atrs
+                if self.is_readable_ATR(os.path.join(self.ATR_FP, atr))]
+
+        # Geocode everything before reading any of the workbooks
+        locations = {}
         geocoded_count = [0, 0, 0]
         for atr in atrs:
-            if self.is_readable_ATR(os.path.join(self.ATR_FP, atr)):
-                atr_address = self.clean_ATR_fname(
-                    os.path.join(self.ATR_FP, atr))
-                print(atr_address)
-                geocoded_add, lat, lng, status = lookup_address(
-                    atr_address, cached)
-
-                cached[atr_address] = [geocoded_add, lat, lng, status]
-
-                print(str(geocoded_add) + ',' + str(lat) + ',' + str(lng))
-                vol, speed, motos, light, heavy, date, counts = self.read_ATR(
-                    os.path.join(self.ATR_FP, atr))
-                if status == 'S':
-                    geocoded_count[0] += 1
-                elif status == 'F':
-                    geocoded_count[1] += 1
-                else:
-                    geocoded_count[2] += 1
-
-                r = OrderedDict([
-                    ("startDateTime", date),
-                    ("location", OrderedDict([
-                        ("latitude", float(lat) if lat else ''),
-                        ("longitude", float(lng) if lng else ''),
-                        ("address", geocoded_add if geocoded_add else '')
-                    ])),
-                    ("volume", OrderedDict([
-                        ("totalVolume", vol),
-                        ("totalLightVehicles", light),
-                        ("totalHeavyVehicles", heavy),
-                        ("bikes", motos),
-                        ("hourlyVolume", counts)
-                    ])),
-                    ("speed", OrderedDict([
-                        ("averageSpeed", speed)
-                    ]))
-                ])
-                results.append(r)
+            atr_address = self.clean_ATR_fname(
+                os.path.join(self.ATR_FP, atr))
+            print(atr_address)
+            geocoded_add, lat, lng, status = lookup_address(
+                atr_address, cached)
+
+            cached[atr_address] = [geocoded_add, lat, lng, status]
+            locations[atr] = (geocoded_add, lat, lng)
+
+            print(str(geocoded_add) + ',' + str(lat) + ',' + str(lng))
+            if status == 'S':
+                geocoded_count[0] += 1
+            elif status == 'F':
+                geocoded_count[1] += 1
+            else:
+                geocoded_count[2] += 1
+
+        parsed = self.read_ATRs(atrs, processes)
+
+        results = []
+        for atr in atrs:
+            geocoded_add, lat, lng = locations[atr]
+            vol, speed, motos, light, heavy, date, counts = parsed[atr]
+
+            r = OrderedDict([
+                ("startDateTime", date),
+                ("location", OrderedDict([
+                    ("latitude", float(lat) if lat else ''),
+                    ("longitude", float(lng) if lng else ''),
+                    ("address", geocoded_add if geocoded_add else '')
+                ])),
+                ("volume", OrderedDict([
+                    ("totalVolume", vol),
+                    ("totalLightVehicles", light),
+                    ("totalHeavyVehicles", heavy),
+                    ("bikes", motos),
+                    ("hourlyVolume", counts)
+                ])),
+                ("speed", OrderedDict([
+                    ("averageSpeed", speed)
+                ]))
+            ])
+            results.append(r)
 
         print('Number successfully geocoded: {}'.format(geocoded_count[0]))
         print('Unable to geocode: {}'.format(geocoded_count[1]))
@@ -106,6 +154,46 @@ class BostonVolumeParser:
                 writer.writerow([name] + value)
         return results
 
+    def read_ATRs(self, atrs, processes=None):
+        """
+        Read the ATRs that are new or have changed since they were last
+        read, in parallel, and cache the results in the processed directory
+        Args:
+            atrs - ATR filenames, in the ATR directory
+            processes - number of processes, None for all the cpus
+        Returns:
+            dict of filename to the values from read_ATR
+        """
+        cache_file = os.path.join(self.PROCESSED_DATA_FP, ATR_CACHE)
+        parsed = {}
+        if os.path.exists(cache_file):
+            with open(cache_file) as f:
+                parsed = json.load(f)
+
+        hashes = {atr: file_hash(os.path.join(self.ATR_FP, atr))
+                  for atr in atrs}
+        changed = [atr for atr in atrs
+                   if atr not in parsed or parsed[atr]['hash'] != hashes[atr]]
+        print("Reading {} new or changed ATRs, {} unchanged".format(
+            len(changed), len(atrs) - len(changed)))
+
+        fnames = [os.path.join(self.ATR_FP, atr) for atr in changed]
+        if processes == 1 or len(changed) < 2:
+            results = [self.read_ATR(fname) for fname in fnames]
+        else:
+            with Pool(processes) as pool:
+                results = pool.map(self.read_ATR, fnames)
+
+        for atr, result in zip(changed, results):
+            parsed[atr] = {'hash': hashes[atr], 'result': list(result)}
+
+        # Only keep the ATRs that are still there
+        parsed = {atr: parsed[atr] for atr in atrs}
+        with open(cache_file, 'w') as f:
+            json.dump(parsed, f)
+
+        return {atr: tuple(parsed[atr]['result']) for atr in atrs}
+
     def is_readable_ATR(self, fname):
         """
         Function to check if ATR is of type we want to read
@@ -153,54 +241,45 @@ class BostonVolumeParser:
         and heavy(# of heavy duty vehicles)
         """
 
-        # data_only=True so as to not read formulas
-        wb = openpyxl.load_workbook(fname, data_only=True)
+        # data_only=True so as to not read formulas, and read_only so
+        # cells are streamed instead of the whole workbook being loaded
+        wb = openpyxl.load_workbook(fname, read_only=True, data_only=True)
         sheet_names = wb.sheetnames
 
         # get total volume cell F106
         if 'Volume' in sheet_names:
-            sheet = wb['Volume']
-            vol = sheet['F106'].value
+            vol = read_cells(wb['Volume'], 106, 106, 6, 6)[0][0]
         else:
             vol = 0
 
-        # get mean speed data
+        # get mean speed cell E42
         if 'Speed Combined' in sheet_names:
-            sheet = wb['Speed Combined']
-            speed = sheet['E42'].value
+            speed = read_cells(wb['Speed Combined'], 42, 42, 5, 5)[0][0]
         elif 'Speed-1' in sheet_names:
-            sheet = wb['Speed-1']
-            speed = sheet['E42'].value
+            speed = read_cells(wb['Speed-1'], 42, 42, 5, 5)[0][0]
         else:
             speed = 0
 
-        # get classification data
+        # get classification data: hourly counts in O9:O32,
+        # and motos, light and heavy in D38:D40
         counts = []
+        sheet = None
         if 'Classification-Combined' in sheet_names:
             sheet = wb['Classification-Combined']
-            motos = sheet['D38'].value
-            light = sheet['D39'].value
-            heavy = sheet['D40'].value
-
-            for row_index in range(9, 33):
-                cell = "{}{}".format('O', row_index)
-                val = sheet[cell].value
-                counts.append(val)
-
         elif 'Classification-1' in sheet_names:
             sheet = wb['Classification-1']
-            motos = sheet['D38'].value
-            light = sheet['D39'].value
-            heavy = sheet['D40'].value
-
-            for row_index in range(9, 33):
-                cell = "{}{}".format('O', row_index)
-                val = sheet[cell].value
-                counts.append(val)
+
+        if sheet is not None:
+            rows = read_cells(sheet, 9, 40, 4, 15)
+            motos = rows[29][0]
+            light = rows[30][0]
+            heavy = rows[31][0]
+            counts = [row[11] for row in rows[:24]]
         else:
             motos = 0
             light = 0
             heavy = 0
+        wb.close()
 
         date = parse(fname.split('.')[-2].split('_')[-1]).strftime("%Y-%m-%d")
 
@@ -29,13 +29,17 @@ if __name__ == '__main__':
                         help="city config filename")
     parser.add_argument("-d", "--datadir", type=str,
                         help="data directory")
+    parser.add_argument("-p", "--processes", type=int,
+                        help="Number of processes to read ATRs " +
+                        "with, defaults to the number of cpus")
 
     args = parser.parse_args()
     BASE_FP = os.path.join(args.datadir)
 
     config = data.config.Configuration(args.config)
     if config.name == 'boston':
-        volume_counts = BostonVolumeParser(args.datadir).get_volume()
+        volume_counts = BostonVolumeParser(args.datadir).get_volume(
+            args.processes)
         write_volume(volume_counts)
     else:
         print("No volume data given for {}".format(config.name))
@@ -1,5 +1,7 @@
-from ..boston_volume import BostonVolumeParser
+from ..boston_volume import BostonVolumeParser, read_cells
+import openpyxl
 import os
+import shutil
 
 
 def test_is_readable_ATR():
@@ -23,6 +25,26 @@ def test_clean_ATR_fname():
     assert parser.clean_ATR_fname(file) == '147 TRAIN ST Boston, MA'
 
 
+def test_read_cells(tmpdir):
+    wb = openpyxl.Workbook()
+    sheet = wb.active
+    sheet['A1'] = 1
+    sheet['B2'] = 2
+    fname = os.path.join(str(tmpdir), 'cells.xlsx')
+    wb.save(fname)
+
+    # Cells past the end of the sheet are None
+    wb = openpyxl.load_workbook(fname, read_only=True, data_only=True)
+    assert read_cells(wb.active, 1, 4, 1, 3) == [
+        (1, None, None),
+        (None, 2, None),
+        (None, None, None),
+        (None, None, None),
+    ]
+    assert read_cells(wb.active, 5, 6, 2, 2) == [(None,), (None,)]
+    wb.close()
+
+
 def test_read_ATR():
     path = os.path.dirname(
         os.path.abspath(__file__)) + '/data/'
@@ -48,3 +70,22 @@ def test_read_ATR():
          11, 16, 23, 11, 10, 11, 4, 3]
     )
 
+
+
+def test_read_ATRs(tmpdir, monkeypatch):
+    path = os.path.dirname(
+        os.path.abspath(__file__)) + '/data/'
+    atr = '8811_NA_NA_83_PEARL-ST_CHARLESTOWN_24-HOURS_XXX_01-11-2017.XLSX'
+    atr_dir = tmpdir.mkdir('raw').mkdir('volume').mkdir('ATRs')
+    tmpdir.mkdir('processed')
+    shutil.copy(os.path.join(path, atr), str(atr_dir))
+
+    parser = BostonVolumeParser(str(tmpdir))
+    results = parser.read_ATRs([atr], processes=1)
+    assert results[atr] == parser.read_ATR(os.path.join(path, atr))
+
+    # Unchanged files are read from the cache
+    def mockread(fname):
+        raise AssertionError(fname + ' was read again')
+    monkeypatch.setattr(parser, 'read_ATR', mockread)
+    assert parser.read_ATRs([atr], processes=1) == results
@@ -3,12 +3,14 @@
 # Generate canonical dataset for hackathon
 # Developed by: bpben
 import json
+import numpy as np
 import pandas as pd
-from data.util import read_geojson
 import os
 import argparse
 import warnings
 import data.config
+from data import instrument
+from data.segment_attributes import join_attributes
 
 
 BASE_DIR = os.path.dirname(
@@ -24,6 +26,8 @@ def read_records(fp, id_col, split_columns=[]):
     """
     Read point data, output segments with crash counts, and counts
     for each additional column that's been specified in split_columns
+    Only the id column and the split columns are pulled out of the
+    records, and all counts are computed in a single groupby
     Args:
         fp - file, probably a crash_joined.json file
         id_col - column that corresponds to segment id, probably near_id
@@ -35,27 +39,39 @@ def read_records(fp, id_col, split_columns=[]):
     with open(fp, 'r') as f:
         data = json.load(f)
 
-    df = pd.DataFrame(data)
+    # Build a columnar table holding only the columns we aggregate
+    df = pd.DataFrame({
+        col: [item.get(col) for item in data]
+        for col in [id_col] + split_columns
+    }, columns=[id_col] + split_columns)
     df = df.fillna(0)
 
     print("total number of records in {}:{}".format(fp, len(df)))
-    
-    df_g = df.groupby([id_col]).size()
-    df_g = df_g.to_frame()
-    df_g.columns = ['crash']
 
-    # Get counts for all the modes
-    extra_columns = df[[id_col] + split_columns].groupby(
-        'near_id').sum()
-    extra_columns = extra_columns.astype('int')
-
-    df_g = pd.concat([df_g, extra_columns], axis=1)
+    df['crash'] = 1
 
+    df_g = df.groupby(id_col)[['crash'] + split_columns].sum()
+    df_g = df_g.astype('int')
     df_g.reset_index(inplace=True)
 
     return(df_g)
 
 
+def read_segment_properties(fp):
+    """
+    Read the properties of each segment in a geojson file into a dataframe
+    The geometry is never parsed or reprojected, since only the
+    properties are needed for the canonical dataset
+    Args:
+        fp - geojson file
+    Returns:
+        dataframe with one row per segment
+    """
+    with open(fp) as f:
+        data = json.load(f)
+    return pd.DataFrame([x['properties'] for x in data['features']])
+
+
 def road_make(feats, fp):
     """ Makes road feature df, intersections + non-intersections
     Args:
@@ -67,11 +83,13 @@ def road_make(feats, fp):
 
     # Read in segments data (geojson)
     print("reading ", fp)
-    segments = read_geojson(fp)
-    df = pd.DataFrame([x.properties for x in segments])
+    df = read_segment_properties(fp)
 
     df.set_index('id', inplace=True)
 
+    # Add features that later stages stored in the attributes table
+    df = join_attributes(df, os.path.dirname(fp))
+
     # Check for missing features
     missing_feats = [x for x in feats if x not in df.columns]
     feats = [x for x in feats if x in df.columns]
@@ -85,6 +103,7 @@ def road_make(feats, fp):
     return df[feats]
 
 
+@instrument.traced
 def aggregate_roads(feats, datadir, split_columns):
 
     # read/aggregate crashes
@@ -105,7 +124,9 @@ def aggregate_roads(feats, datadir, split_columns):
     aggregated = aggregated.fillna(0)
 
     # All features as int
-    aggregated = aggregated.apply(lambda x: x.astype('int'))
+    aggregated = aggregated.astype('int')
+    instrument.count('segments', len(aggregated))
+    instrument.count('crashes', len(crash))
 
     return aggregated, crash
 
@@ -124,12 +145,48 @@ def combine_crash_with_segments(crash, aggregated):
     return crash_roads
 
 
+def write_canon_dataset(crash_roads, fp):
+    """
+    Write the canonical dataset as a compressed columnar numpy archive,
+    with one array per column.  This is much faster to write and read
+    back than the gzipped csv
+    Args:
+        crash_roads - dataframe with a segment_id column
+        fp - file to write to, typically vz_predict_dataset.npz
+    """
+    # A feature listed twice in the config shows up as two columns
+    crash_roads = crash_roads.loc[:, ~crash_roads.columns.duplicated()]
+    columns = {}
+    for col in crash_roads.columns:
+        values = crash_roads[col].values
+        if values.dtype == object:
+            values = values.astype('str')
+        columns[col] = values
+    np.savez_compressed(fp, **columns)
+
+
+def read_canon_dataset(fp):
+    """
+    Read a canonical dataset written by write_canon_dataset
+    Args:
+        fp - npz file
+    Returns:
+        dataframe, with the columns in the order they were written
+    """
+    with np.load(fp) as archive:
+        return pd.DataFrame(
+            {col: archive[col] for col in archive.files},
+            columns=archive.files)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("-d", "--datadir", type=str,
                         help="Can give alternate data directory")
     parser.add_argument("-c", "--config", type=str,
                         help="Config file", required=True)
+    parser.add_argument("--csv", action='store_true',
+                        help="Also export the dataset as a gzipped csv")
 
     args = parser.parse_args()
 
@@ -155,7 +212,11 @@ if __name__ == '__main__':
     # output canon dataset
     print("exporting canonical dataset to ", DATA_FP)
 
-    crash_roads.set_index('segment_id').to_csv(
-        os.path.join(DATA_FP, 'vz_predict_dataset.csv.gz'),
-        compression='gzip')
+    write_canon_dataset(
+        crash_roads, os.path.join(DATA_FP, 'vz_predict_dataset.npz'))
+
+    if args.csv:
+        crash_roads.set_index('segment_id').to_csv(
+            os.path.join(DATA_FP, 'vz_predict_dataset.csv.gz'),
+            compression='gzip')
 
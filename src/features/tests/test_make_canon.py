@@ -61,3 +61,39 @@ def test_road_make():
     expected.set_index('id', inplace=True)
     assert expected.equals(result)
 
+
+
+def test_read_segment_properties():
+    result = make_canon_dataset.read_segment_properties(
+        os.path.join(DATA_FP, 'maps', 'inter_and_non_int.geojson'))
+    assert len(result) == 14
+    assert 'id' in result.columns
+    assert 'geometry' not in result.columns
+
+
+def test_write_read_canon_dataset(tmpdir):
+    aggregated, cr_con = make_canon_dataset.aggregate_roads(
+        ['width', 'lanes', 'hwy_type', 'osm_speed', 'signal', 'oneway'],
+        DATA_FP,
+        ['bike', 'pedestrian', 'vehicle']
+    )
+    crash_roads = make_canon_dataset.combine_crash_with_segments(
+        cr_con, aggregated)
+
+    fp = os.path.join(tmpdir.strpath, 'vz_predict_dataset.npz')
+    make_canon_dataset.write_canon_dataset(crash_roads, fp)
+    result = make_canon_dataset.read_canon_dataset(fp)
+
+    assert list(result.columns) == list(crash_roads.columns)
+    assert list(result.segment_id) == [
+        str(x) for x in crash_roads.segment_id]
+    assert list(result.crash.fillna(-1)) == list(
+        crash_roads.crash.fillna(-1))
+
+    # A feature listed twice is only written once
+    duplicated = pd.concat([crash_roads, crash_roads[['width']]], axis=1)
+    make_canon_dataset.write_canon_dataset(duplicated, fp)
+    result = make_canon_dataset.read_canon_dataset(fp)
+    assert list(result.columns) == list(crash_roads.columns)
+    assert list(result.width.fillna(-1)) == list(
+        crash_roads.width.fillna(-1))
@@ -0,0 +1,206 @@
+# Generate a segment by time period panel of crash counts
+# The panel is stored in long (sparse) form, with only the segment/period
+# pairs that had at least one crash, so that we never materialize the
+# full segments x periods cross product unless a dense view is requested
+
+import os
+import json
+import argparse
+import pandas as pd
+from features.make_canon_dataset import road_make, write_canon_dataset
+import data.config
+
+BASE_DIR = os.path.dirname(
+    os.path.dirname(
+        os.path.dirname(
+            os.path.abspath(__file__))))
+
+# pandas period frequency for each supported time bucket
+PERIODS = {
+    'week': 'W',
+    'month': 'M',
+}
+
+
+def read_crash_times(fp, id_col='near_id', split_columns=[]):
+    """
+    Read the segment id, date and split columns of each snapped crash
+    into a columnar table, parsing all the dates in one pass
+    Args:
+        fp - file, probably a crash_joined.json file
+        id_col - column that corresponds to segment id, probably near_id
+        split_columns - a list of columns to add
+    Returns:
+        dataframe with id_col, timestamp and the split columns
+    """
+    with open(fp) as f:
+        data = json.load(f)
+
+    columns = [id_col, 'dateOccurred'] + split_columns
+    df = pd.DataFrame({
+        col: [item.get(col) for item in data] for col in columns
+    }, columns=columns)
+    df[split_columns] = df[split_columns].fillna(0)
+
+    # Dates are standardized iso strings with a utc offset; the first
+    # 19 characters are the local date and time of the crash
+    df['timestamp'] = pd.to_datetime(df['dateOccurred'].str.slice(0, 19))
+
+    return df.drop(columns=['dateOccurred'])
+
+
+def bucket_columns(starts, period):
+    """
+    Get the year and week (or month) number for the start of each period
+    Weeks are iso weeks, so the year is the iso year
+    Args:
+        starts - series of datetimes for the start of each period
+        period - 'week' or 'month'
+    Returns:
+        dataframe with year and week/month columns
+    """
+    if period == 'week':
+        return pd.DataFrame({
+            'year': starts.dt.strftime('%G').astype('int'),
+            'week': starts.dt.strftime('%V').astype('int'),
+        }, columns=['year', 'week'])
+    return pd.DataFrame({
+        'year': starts.dt.year,
+        'month': starts.dt.month,
+    }, columns=['year', 'month'])
+
+
+def make_panel(crashes, split_columns=[], period='week', id_col='near_id'):
+    """
+    Count crashes per segment and time period
+    Args:
+        crashes - dataframe from read_crash_times
+        split_columns - a list of columns to also count
+        period - 'week' or 'month'
+        id_col - column that corresponds to segment id
+    Returns:
+        long dataframe with segment_id, year, week/month, crash
+        and one count per split column, only for non-zero counts
+    """
+    if period not in PERIODS:
+        raise ValueError("Period must be one of {}".format(
+            ', '.join(PERIODS.keys())))
+
+    starts = crashes['timestamp'].dt.to_period(
+        PERIODS[period]).dt.start_time
+    df = bucket_columns(starts, period)
+    df['segment_id'] = crashes[id_col].astype('str').values
+    df['crash'] = 1
+    for column in split_columns:
+        df[column] = crashes[column].values
+
+    panel = df.groupby(
+        ['segment_id', 'year', period])[['crash'] + split_columns].sum()
+    panel = panel.astype('int')
+    panel.reset_index(inplace=True)
+
+    return panel
+
+
+def make_dense(panel, start, end, period='week', segment_ids=None):
+    """
+    Expand a long panel into every segment/period pair, filling zeros
+    Only do this for the segments you need, since the result has
+    len(segment_ids) x number of periods rows
+    Args:
+        panel - long dataframe from make_panel
+        start - first date to include
+        end - last date to include
+        period - 'week' or 'month'
+        segment_ids - optional list of segments, defaults to
+            the segments in the panel
+    Returns:
+        dataframe with a row for every segment and period
+    """
+    if segment_ids is None:
+        segment_ids = panel['segment_id'].unique()
+
+    starts = pd.period_range(
+        start, end, freq=PERIODS[period]).start_time.to_series()
+    buckets = bucket_columns(starts, period)
+
+    keys = ['segment_id', 'year', period]
+    index = pd.MultiIndex.from_tuples(
+        [(str(segment_id), year, number)
+         for segment_id in segment_ids
+         for year, number in buckets.itertuples(index=False)],
+        names=keys)
+
+    dense = panel.set_index(keys).reindex(index, fill_value=0)
+    dense.reset_index(inplace=True)
+
+    return dense
+
+
+def join_segment_features(panel, segments):
+    """
+    Add segment features to every row of the panel.  Segments without
+    any crashes get a single row with empty period and crash columns,
+    the same as in the canonical dataset, so the result can be used
+    directly by train_model
+    Args:
+        panel - long or dense panel
+        segments - dataframe of features indexed by segment id
+    Returns:
+        dataframe
+    """
+    segments = segments.copy()
+    segments.index = segments.index.astype('str')
+    segments.index.name = 'segment_id'
+
+    return pd.merge(
+        segments.reset_index(), panel, on='segment_id', how='outer')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--config", type=str,
+                        help="Config file", required=True)
+    parser.add_argument("-d", "--datadir", type=str,
+                        help="Can give alternate data directory")
+    parser.add_argument("-p", "--period", type=str, default='week',
+                        choices=list(PERIODS.keys()),
+                        help="Time period to count crashes by")
+    parser.add_argument("--dense", action='store_true',
+                        help="Write every segment/period pair, " +
+                        "instead of only those with crashes")
+
+    args = parser.parse_args()
+    config = data.config.Configuration(args.config)
+
+    if args.datadir:
+        DATA_FP = os.path.join(args.datadir, 'processed')
+    else:
+        DATA_FP = os.path.join(BASE_DIR, 'data', config.name, 'processed')
+
+    crashes = read_crash_times(
+        os.path.join(DATA_FP, 'crash_joined.json'),
+        split_columns=config.split_columns)
+    panel = make_panel(crashes, config.split_columns, args.period)
+    print("{} segment/{} pairs with crashes".format(
+        len(panel), args.period))
+
+    segments = road_make(
+        config.features,
+        os.path.join(DATA_FP, 'maps', 'inter_and_non_int.geojson'))
+    segments = segments.fillna(0).astype('int')
+
+    if args.dense:
+        panel = make_dense(
+            panel,
+            config.startdate or crashes['timestamp'].min(),
+            config.enddate or crashes['timestamp'].max(),
+            args.period,
+            segment_ids=segments.index)
+
+    panel = join_segment_features(panel, segments)
+
+    outfile = os.path.join(
+        DATA_FP, 'crash_panel_{}.npz'.format(args.period))
+    print("exporting panel dataset to ", outfile)
+    write_canon_dataset(panel, outfile)
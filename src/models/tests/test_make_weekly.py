@@ -0,0 +1,72 @@
+import os
+import json
+import pandas as pd
+from .. import make_weekly
+
+
+def write_crashes(tmpdir):
+    crashes = [
+        {'near_id': '001', 'dateOccurred': '2016-01-04T08:00:00-05:00',
+         'bike': 1},
+        {'near_id': '001', 'dateOccurred': '2016-01-10T23:30:00-05:00'},
+        {'near_id': '001', 'dateOccurred': '2016-01-11T01:00:00-05:00',
+         'bike': 1},
+        {'near_id': 2, 'dateOccurred': '2016-02-01T12:00:00-05:00'},
+    ]
+    fp = os.path.join(tmpdir.strpath, 'crash_joined.json')
+    with open(fp, 'w') as f:
+        json.dump(crashes, f)
+    return fp
+
+
+def test_make_panel_weekly(tmpdir):
+    crashes = make_weekly.read_crash_times(write_crashes(tmpdir),
+                                           split_columns=['bike'])
+    result = make_weekly.make_panel(crashes, ['bike'], 'week')
+
+    expected = pd.DataFrame({
+        'segment_id': ['001', '001', '2'],
+        'year': [2016, 2016, 2016],
+        'week': [1, 2, 5],
+        'crash': [2, 1, 1],
+        'bike': [1, 1, 0],
+    })
+    assert expected.equals(result)
+
+
+def test_make_panel_monthly(tmpdir):
+    crashes = make_weekly.read_crash_times(write_crashes(tmpdir))
+    result = make_weekly.make_panel(crashes, period='month')
+
+    assert list(result.columns) == ['segment_id', 'year', 'month', 'crash']
+    assert list(result.month) == [1, 2]
+    assert list(result.crash) == [3, 1]
+
+
+def test_make_dense(tmpdir):
+    crashes = make_weekly.read_crash_times(write_crashes(tmpdir))
+    panel = make_weekly.make_panel(crashes)
+    result = make_weekly.make_dense(
+        panel, '2016-01-04', '2016-02-07',
+        segment_ids=['001', '2', '003'])
+
+    # 3 segments x 5 weeks
+    assert len(result) == 15
+    assert result.crash.sum() == 4
+    assert list(result[result.segment_id == '001'].crash) == [
+        2, 1, 0, 0, 0]
+    assert result[result.segment_id == '003'].crash.sum() == 0
+
+
+def test_join_segment_features(tmpdir):
+    crashes = make_weekly.read_crash_times(write_crashes(tmpdir))
+    panel = make_weekly.make_panel(crashes)
+    segments = pd.DataFrame({
+        'id': ['001', 2, '003'],
+        'width': [24, 12, 15]
+    }).set_index('id')
+
+    result = make_weekly.join_segment_features(panel, segments)
+    assert len(result) == 4
+    assert list(result.width) == [24, 24, 12, 15]
+    assert pd.isnull(result.crash.iloc[3])
@@ -9,7 +9,9 @@ import json
 import argparse
 from copy import deepcopy
 from .model_classes import Indata, Tuner, Tester
+from features.make_canon_dataset import read_canon_dataset
 import data.config
+from data import instrument
 
 # all model outputs must be stored in the "data/processed/" directory
 BASE_DIR = os.path.dirname(
@@ -73,7 +75,23 @@ def set_defaults(config):
         config object
     """
     if not hasattr(config, 'seg_data'):
-        config.seg_data = 'vz_predict_dataset.csv.gz'
+        config.seg_data = 'vz_predict_dataset.npz'
+
+
+def read_seg_data(seg_data):
+    """
+    Read the canonical segment dataset, either from the columnar
+    npz file or from a csv
+    Args:
+        seg_data - path to the segment dataset
+    Returns:
+        dataframe with segment_id as a string
+    """
+    if seg_data.endswith('.npz'):
+        data = read_canon_dataset(seg_data)
+        data['segment_id'] = data['segment_id'].astype('str')
+        return data
+    return pd.read_csv(seg_data, dtype={'segment_id': 'str'})
 
         
 def get_features(config, data):
@@ -221,10 +239,13 @@ def process_features(features, f_cat, f_cont, data_segs):
     return data_segs, features, lm_features
 
 
+@instrument.traced
 def initialize_and_run(data_model, features, lm_features, target,
                        datadir, seed=None):
 
     cvp, mp, perf_cutoff = set_params()
+    instrument.count('segments', len(data_model))
+    instrument.count('features', len(features))
 
     # Initialize data
     df = Indata(data_model, target)
@@ -287,13 +308,21 @@ if __name__ == '__main__':
     )
     parser.add_argument('-d', '--datadir', type=str,
                         help="data directory")
+    parser.add_argument('-s', '--seg_data', type=str,
+                        help="segment dataset in the processed directory, " +
+                        "e.g. crash_panel_week.npz from models.make_weekly")
 
     args = parser.parse_args()
     config = data.config.Configuration(args.config)
+    if args.seg_data:
+        config.seg_data = args.seg_data
     set_defaults(config)
 
     DATA_FP = os.path.join(BASE_DIR, 'data', config.name)
-    PROCESSED_DATA_FP = os.path.join(BASE_DIR, 'data', config.name, 'processed/')
+    # Can override the hardcoded data directory
+    if args.datadir:
+        DATA_FP = args.datadir
+    PROCESSED_DATA_FP = os.path.join(DATA_FP, 'processed/')
     seg_data = os.path.join(PROCESSED_DATA_FP, config.seg_data)
 
     # get the targets
@@ -305,7 +334,7 @@ if __name__ == '__main__':
     print(('Outputting to: %s' % PROCESSED_DATA_FP))
 
     # Read in data
-    data = pd.read_csv(seg_data, dtype={'segment_id': 'str'})
+    data = read_seg_data(seg_data)
 
     f_cat, f_cont, features = get_features(config, data)
 
@@ -1,8 +1,17 @@
 import argparse
+import glob
+import gzip
+import hashlib
 import os
-import subprocess
 import shutil
 import data.config
+from data import instrument
+from showcase import tiles
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 BASE_DIR = os.path.dirname(
     os.path.dirname(
@@ -23,7 +32,7 @@ def data_standardization(config_file, DATA_FP, forceupdate=False):
     if not os.path.exists(os.path.join(
             DATA_FP, 'standardized', 'crashes.json')) or forceupdate:
         print("Standardizing crash data..")
-        subprocess.check_call([
+        instrument.check_call([
             'python',
             '-m',
             'data_standardization.standardize_crashes',
@@ -38,7 +47,7 @@ def data_standardization(config_file, DATA_FP, forceupdate=False):
     # Handling volume data
     if (not os.path.exists(os.path.join(
             DATA_FP, 'standardized', 'volume.json'))) or forceupdate:
-        subprocess.check_call([
+        instrument.check_call([
             'python',
             '-m',
             'data_standardization.standardize_volume',
@@ -52,7 +61,7 @@ def data_standardization(config_file, DATA_FP, forceupdate=False):
 
     if not os.path.exists(os.path.join(
            DATA_FP, 'standardized', 'points.json')) or forceupdate:
-        subprocess.check_call([
+        instrument.check_call([
             'python',
             '-m',
             'data_standardization.standardize_point_data',
@@ -68,7 +77,7 @@ def data_standardization(config_file, DATA_FP, forceupdate=False):
     if os.path.exists(os.path.join(DATA_FP, 'raw', 'waze')) and \
        (not os.path.exists(os.path.join(BASE_DIR, 'standardized', 'waze.json')
                            or forceupdate)):
-        subprocess.check_call([
+        instrument.check_call([
             'python',
             '-m',
             'data_standardization.standardize_waze_data',
@@ -98,7 +107,7 @@ def data_generation(config_file, DATA_FP, startdate=None, enddate=None,
         enddate (optional)
     """
     print("Generating data and features...")
-    subprocess.check_call([
+    instrument.check_call([
         'python',
         '-m',
         'data.make_dataset',
@@ -121,7 +130,7 @@ def train_model(config_file, DATA_FP):
         DATA_FP - path to data directory, e.g. ../data/boston/
     """
     print("Training model...")
-    subprocess.check_call([
+    instrument.check_call([
         'python',
         '-m',
         'models.train_model',
@@ -139,24 +148,58 @@ def visualize(DATA_FP, config_file):
         DATA_FP - path to data directory, e.g. ../data/boston/
     """
     print("Generating visualization data")
-    subprocess.check_call([
+    instrument.check_call([
         'python',
         '-m',
         'data.make_preds_viz',
         '-d',
         DATA_FP,
         '-c',
-        config_file
+        config_file,
+        '--shared',
+        '--precision',
+        '6'
     ])
 
 
+def content_hash(filename):
+    """
+    Short hash of a file's contents, used to make cache-safe filenames
+    """
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            md5.update(chunk)
+    return md5.hexdigest()[:10]
+
+
+def compress_file(filename):
+    """
+    Write gzip (and brotli, if available) compressed copies of a file
+    next to it, so the showcase can serve them without compressing
+    on every request
+    """
+    with open(filename, 'rb') as f:
+        contents = f.read()
+    with gzip.open(filename + '.gz', 'wb', compresslevel=9) as f:
+        f.write(contents)
+    if brotli:
+        with open(filename + '.br', 'wb') as f:
+            f.write(brotli.compress(contents))
+
+
 def copy_files(base_dir, data_fp, config):
     """
     Copy necessary files into showcase directory
+    Along with each file, writes a copy with the content hash in its name
+    (e.g. preds_viz.3f2a9c0d1e.geojson), compressed versions of it, and
+    its low zoom vector tiles
     Args:
         base_dir - top level directory
         data_fp - data directory
         config
+    Returns:
+        dict of file name to content-hashed file name
     """
 
     showcase_dir = os.path.join(base_dir, 'src', 'showcase', 'data')
@@ -167,31 +210,50 @@ def copy_files(base_dir, data_fp, config):
     if not os.path.exists(showcase_dir):
         os.makedirs(showcase_dir)
 
-    files = []
-    if config.split_columns:
-        for column in config.split_columns:
-            files.append('preds_viz_' + column + '.geojson')
-            files.append('crashes_rollup_' + column + ".geojson")
-    else:
-        files.append('preds_viz.geojson')
-        files.append('crashes_rollup.geojson')
+    # Predictions and crashes for every split column are in one file each
+    files = ['preds_viz.geojson', 'crashes_rollup.geojson']
 
+    hashed_files = {}
     for file in files:
         shutil.copyfile(
             os.path.join(data_fp, 'processed', file),
             os.path.join(showcase_dir, file))
 
+        name, ext = os.path.splitext(file)
+        # Remove versions of this file from previous runs
+        for old_file in glob.glob(os.path.join(
+                showcase_dir, name + '.*' + ext + '*')):
+            if os.path.isdir(old_file):
+                shutil.rmtree(old_file)
+            else:
+                os.remove(old_file)
+
+        hashed_file = '{}.{}{}'.format(
+            name, content_hash(os.path.join(showcase_dir, file)), ext)
+        shutil.copyfile(
+            os.path.join(showcase_dir, file),
+            os.path.join(showcase_dir, hashed_file))
+        compress_file(os.path.join(showcase_dir, hashed_file))
+        print("Wrote {} tiles for {}".format(tiles.write_tiles(
+            os.path.join(showcase_dir, hashed_file)), hashed_file))
+        hashed_files[file] = hashed_file
+
+    return hashed_files
+
 
-def make_js_config(BASE_DIR, config):
+def make_js_config(BASE_DIR, config, files=None):
     """
     Make a city specific js config file in the showcase's data directory
     Args:
         BASE_DIR - city's data directory
         config - configuration object
+        files - optional dict of file name to the name to use in the
+            config, e.g. the content-hashed names from copy_files
     Returns:
         nothing, just writes the js file in showcase/data/
     """
 
+    files = files or {}
     showcase_data = os.path.join(
         BASE_DIR, 'src', 'showcase', 'data')
     if not os.path.exists(showcase_data):
@@ -204,33 +266,34 @@ def make_js_config(BASE_DIR, config):
     f.write(
         'var config = [\n')
 
+    preds_file = files.get('preds_viz.geojson', 'preds_viz.geojson')
+    crashes_file = files.get(
+        'crashes_rollup.geojson', 'crashes_rollup.geojson')
+    # Tile and api paths are the files' names without the extension
+    preds_name = os.path.splitext(preds_file)[0]
+    crashes_name = os.path.splitext(crashes_file)[0]
+    targets = ''
     if config.split_columns:
-        for split_column in config.split_columns:
-            name = config.city + " (" + split_column + ")"
-            f.write(
-                '    {\n' +
-                '        name: "{}",\n'.format(name) +
-                '        id: "{}",\n'.format(config.name + '_' + split_column) +
-                '        latitude: {},\n'.format(config.city_latitude) +
-                '        longitude: {},\n'.format(config.city_longitude) +
-                '        speed_unit: "{}",\n'.format(config.speed_unit) +
-                '        file: "data/{}/preds_viz_{}.geojson",\n'.format(config.name, split_column) +
-                '        crashes: "data/{}/crashes_rollup_{}.geojson"\n'.format(config.name, split_column) +
-                '    },\n'
-            )
-    else:
-        f.write(
-            '    {\n' +
-            '        name: "{}",\n'.format(config.city) +
-            '        id: "{}",\n'.format(config.name) +
-            '        latitude: {},\n'.format(config.city_latitude) +
-            '        longitude: {},\n'.format(config.city_longitude) +
-            '        speed_unit: "{}",\n'.format(config.speed_unit) +
-            '        file: "data/{}/preds_viz.geojson",\n'.format(config.name) +
-            '        crashes: "data/{}/crashes_rollup.geojson"\n'.format(config.name) +
-            '    }\n'
-        )
-        
+        # Each split column is a target the showcase can switch between
+        targets = '        targets: [{}],\n'.format(', '.join(
+            '"{}"'.format(x) for x in config.split_columns))
+    f.write(
+        '    {\n' +
+        '        name: "{}",\n'.format(config.city) +
+        '        id: "{}",\n'.format(config.name) +
+        '        latitude: {},\n'.format(config.city_latitude) +
+        '        longitude: {},\n'.format(config.city_longitude) +
+        '        speed_unit: "{}",\n'.format(config.speed_unit) +
+        targets +
+        '        file: "data/{}/{}",\n'.format(config.name, preds_file) +
+        '        crashes: "data/{}/{}",\n'.format(config.name, crashes_file) +
+        '        tiles: "tiles/{}/{}",\n'.format(config.name, preds_name) +
+        '        crash_tiles: "tiles/{}/{}",\n'.format(
+            config.name, crashes_name) +
+        '        api: "api/{}/{}"\n'.format(config.name, preds_name) +
+        '    }\n'
+    )
+
     f.write(']')
     f.close()
 
@@ -241,12 +304,24 @@ if __name__ == '__main__':
     parser.add_argument("-c", "--config_file", required=True, type=str,
                         help="config file location")
     parser.add_argument('--forceupdate', action='store_true',
-                        help='Whether to force update the maps and standard data')
+                        help='Whether to force update the maps and ' +
+                        'standard data')
     # Can also choose which steps of the process to run
     parser.add_argument('--onlysteps',
                         help="Give list of steps to run, as comma-separated " +
                         "string.  Has to be among 'standardization'," +
                         "'generation', 'model', 'visualization'")
+    parser.add_argument('--summary', action='store_true',
+                        help="Print a table of the time, memory and " +
+                        "counts for each stage at the end of the run")
+    parser.add_argument('--profile', type=str,
+                        help="Comma-separated stages to run under a " +
+                        "profiler, e.g. create_segments,train_model. " +
+                        "Profiles are written to the profiles directory " +
+                        "in the city's data directory")
+    parser.add_argument('--sampling', action='store_true',
+                        help="With --profile, sample the stack instead " +
+                        "of using cProfile, which has less overhead")
 
     args = parser.parse_args()
     if args.onlysteps:
@@ -257,21 +332,31 @@ if __name__ == '__main__':
 
     DATA_FP = os.path.join(BASE_DIR, 'data', config.name)
 
-    if not args.onlysteps or 'standardization' in args.onlysteps:
-        data_standardization(args.config_file, DATA_FP, forceupdate=args.forceupdate)
-
-    startdate = config.startdate
-    enddate = config.enddate
-    if not args.onlysteps or 'generation' in args.onlysteps:
-        data_generation(args.config_file, DATA_FP,
-                        startdate=startdate,
-                        enddate=enddate,
-                        forceupdate=args.forceupdate)
-
-    if not args.onlysteps or 'model' in args.onlysteps:
-        train_model(args.config_file, DATA_FP)
-
-    if not args.onlysteps or 'visualization' in args.onlysteps:
-        visualize(DATA_FP, args.config_file)
-        copy_files(BASE_DIR, DATA_FP, config)
-        make_js_config(BASE_DIR, config)
+    # Every stage's timing, memory and counters are written here
+    trace_file = instrument.start_run(DATA_FP)
+    if args.profile:
+        instrument.start_profiling(DATA_FP, args.profile, args.sampling)
+    with instrument.span(config.name):
+        if not args.onlysteps or 'standardization' in args.onlysteps:
+            data_standardization(
+                args.config_file, DATA_FP, forceupdate=args.forceupdate)
+
+        startdate = config.startdate
+        enddate = config.enddate
+        if not args.onlysteps or 'generation' in args.onlysteps:
+            data_generation(args.config_file, DATA_FP,
+                            startdate=startdate,
+                            enddate=enddate,
+                            forceupdate=args.forceupdate)
+
+        if not args.onlysteps or 'model' in args.onlysteps:
+            train_model(args.config_file, DATA_FP)
+
+        if not args.onlysteps or 'visualization' in args.onlysteps:
+            visualize(DATA_FP, args.config_file)
+            files = copy_files(BASE_DIR, DATA_FP, config)
+            make_js_config(BASE_DIR, config, files)
+
+    print("Wrote stage timings to {}".format(trace_file))
+    if args.summary:
+        instrument.print_summary(trace_file)
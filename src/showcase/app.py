@@ -1,26 +1,205 @@
 import os
-from flask import Flask, render_template, send_from_directory
+import re
+import hashlib
+import mimetypes
+from flask import Flask, render_template, send_from_directory, \
+    make_response, request, abort, jsonify
+
+try:
+    from . import tiles
+    from . import segment_index
+except ImportError:
+    # Running as a script from the showcase directory
+    import tiles
+    import segment_index
 
 
 app = Flask(__name__)
 
 
-CONFIG_FILE = os.path.join('static', 'config.js')
+# The environment doesn't change while the app is running,
+# so read it once instead of on every request
+CONFIG_FILE = os.environ.get(
+    'CONFIG_FILE', os.path.join('static', 'config.js'))
+MAPBOX_TOKEN = os.environ.get('MAPBOX_TOKEN')
+DATA_DIR = os.path.join(app.root_path, 'data')
+
+# City and layer names in tile urls, e.g. boston and preds_viz_bike,
+# or preds_viz_bike.3f2a9c0d1e for a content-hashed file
+TILE_NAME = re.compile(r'^[\w\-]+(\.[0-9a-f]+)?$')
+MAX_TILE_ZOOM = 18
+TILE_MAX_AGE = 3600
+
+# Files with a content hash in their name, written by pipeline.copy_files,
+# never change, so browsers can cache them forever
+HASHED_FILE = re.compile(r'\.[0-9a-f]{10}\.[^./]+$')
+IMMUTABLE_MAX_AGE = 31536000
+
+# Precompressed versions of data files, in order of preference
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+# Load every city's tiles, and index its preds_viz files for the api,
+# now rather than on the first request; they're reloaded when the
+# files change
+tiles.load_sources(DATA_DIR)
+segment_index.load_indexes(DATA_DIR)
+MAX_API_SEGMENTS = 1000
 
 
 @app.route('/data/<path:path>')
 def static_files(path):
-    return send_from_directory('data', path)
+    """
+    Serve a data file, using a precompressed copy of it
+    if there is one the browser accepts
+    """
+    response = None
+    for encoding, ext in ENCODINGS:
+        if request.accept_encodings[encoding] and os.path.isfile(
+                os.path.join(DATA_DIR, path + ext)):
+            response = send_from_directory(
+                DATA_DIR, path + ext,
+                mimetype=mimetypes.guess_type(path)[0] or 'application/json')
+            response.headers['Content-Encoding'] = encoding
+            break
+    if response is None:
+        response = send_from_directory(DATA_DIR, path)
+    response.vary.add('Accept-Encoding')
+
+    if HASHED_FILE.search(path):
+        response.headers['Cache-Control'] = \
+            'public, max-age={}, immutable'.format(IMMUTABLE_MAX_AGE)
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+@app.route('/tiles/<city>/<layer>/<int:z>/<int:x>/<int:y>.pbf')
+def vector_tile(city, layer, z, x, y):
+    """
+    Serve a mapbox vector tile cut from data/<city>/<layer>.geojson
+    """
+    if not TILE_NAME.match(city) or not TILE_NAME.match(layer):
+        abort(404)
+    if z > MAX_TILE_ZOOM or x >= 2 ** z or y >= 2 ** z:
+        abort(404)
+    filename = os.path.join(DATA_DIR, city, layer + '.geojson')
+    if not os.path.exists(filename):
+        abort(404)
+
+    tile = tiles.get_tile(filename, z, x, y)
+
+    response = make_response(tile)
+    response.headers['Content-Type'] = 'application/x-protobuf'
+    response.headers['Cache-Control'] = 'public, max-age={}'.format(
+        TILE_MAX_AGE)
+    response.set_etag(hashlib.md5(tile).hexdigest())
+    return response.make_conditional(request)
+
+
+def get_index(city, layer):
+    """
+    Get the segment index for a city's preds_viz file
+    The layer can be the plain or content-hashed file name, without
+    .geojson, e.g. preds_viz_bike or preds_viz_bike.3f2a9c0d1e
+    """
+    if not TILE_NAME.match(city) or not TILE_NAME.match(layer) \
+       or not layer.startswith('preds_viz'):
+        abort(404)
+    filename = os.path.join(
+        DATA_DIR, city, layer.split('.')[0] + '.geojson')
+    if not os.path.exists(filename):
+        abort(404)
+    try:
+        # Keyed on the modification time, as tiles are, so the api
+        # and the map agree after the pipeline is re-run
+        return segment_index.get_index(
+            filename, os.path.getmtime(filename))
+    except (ValueError, KeyError):
+        abort(404)
+
+
+def get_key(index):
+    """
+    The prediction to use, e.g. prediction_bike for ?target=bike
+    """
+    target = request.args.get('target')
+    key = 'prediction_' + target if target else 'prediction'
+    if key not in index.prediction_keys:
+        abort(404)
+    return key
+
+
+def get_limit(default):
+    limit = request.args.get('n', default, type=int)
+    if limit < 1:
+        abort(400)
+    return min(limit, MAX_API_SEGMENTS)
+
+
+def api_response(data):
+    response = jsonify(data)
+    response.headers['Cache-Control'] = 'public, max-age={}'.format(
+        TILE_MAX_AGE)
+    return response
+
+
+@app.route('/api/<city>/<layer>/top')
+def top_segments(city, layer):
+    """
+    The highest risk segments, e.g. /api/boston/preds_viz_bike/top?n=10
+    or /api/boston/preds_viz/top?n=10&target=bike for a file with
+    predictions for several targets
+    Also gives the number of segments and the median prediction
+    """
+    index = get_index(city, layer)
+    key = get_key(index)
+    return api_response({
+        'count': len(index.segments),
+        'median': index.median(key),
+        'segments': index.top(get_limit(10), key),
+    })
+
+
+@app.route('/api/<city>/<layer>/bbox')
+def bbox_segments(city, layer):
+    """
+    Segments in a bounding box, highest risk first, e.g.
+    /api/boston/preds_viz/bbox?bbox=-71.07,42.35,-71.06,42.36&n=100
+    Optionally only segments with min_prediction or higher,
+    and the target to use, as for top_segments
+    """
+    index = get_index(city, layer)
+    key = get_key(index)
+    try:
+        minx, miny, maxx, maxy = [
+            float(x) for x in request.args.get('bbox', '').split(',')]
+    except ValueError:
+        abort(400)
+    return api_response({
+        'segments': index.in_bbox(
+            minx, miny, maxx, maxy,
+            limit=get_limit(MAX_API_SEGMENTS),
+            min_prediction=request.args.get('min_prediction', type=float),
+            key=key),
+    })
+
+
+@app.route('/api/<city>/<layer>/segments/<segment_id>')
+def segment_details(city, layer, segment_id):
+    """
+    A single segment's properties, e.g. /api/boston/preds_viz/segments/001
+    """
+    segment = get_index(city, layer).get(segment_id)
+    if segment is None:
+        abort(404)
+    return api_response(segment)
 
 
 @app.route('/', methods=['GET', 'POST'])
 def index():
-    if 'CONFIG_FILE' in os.environ:
-        global CONFIG_FILE
-        CONFIG_FILE = os.environ['CONFIG_FILE']
     return render_template(
         'index.html',
-        mapbox_token=os.environ['MAPBOX_TOKEN'],
+        mapbox_token=MAPBOX_TOKEN,
         config_file=CONFIG_FILE
     )
 
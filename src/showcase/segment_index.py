@@ -0,0 +1,203 @@
+# In-memory index of the segments in the showcase's preds_viz files
+# Loaded when the app starts, and again when a file changes, so the api
+# can answer top-n, bounding box and single segment queries without the
+# browser having to download every segment.
+# Like tiles.py, this only uses the standard library.
+
+import glob
+import json
+import os
+import re
+from functools import lru_cache
+
+# Size, in degrees, of the grid cells used for bounding box queries
+CELL_SIZE = 0.005
+
+# Content-hashed copies of a file, e.g. preds_viz_bike.3f2a9c0d1e.geojson,
+# have the same contents as the plain file, so aren't indexed separately
+HASHED_FILE = re.compile(r'\.[0-9a-f]+\.geojson$')
+
+
+def get_coords(geometry):
+    """
+    Get a flat list of the coordinates in a point or line geometry
+    """
+    if geometry['type'] == 'Point':
+        return [geometry['coordinates']]
+    if geometry['type'] in ('MultiPoint', 'LineString'):
+        return geometry['coordinates']
+    if geometry['type'] == 'MultiLineString':
+        return [coord for part in geometry['coordinates'] for coord in part]
+    return []
+
+
+def get_cell(x, y):
+    return int(x // CELL_SIZE), int(y // CELL_SIZE)
+
+
+class SegmentIndex(object):
+    """
+    The segments of a preds_viz file, ordered by prediction,
+    indexed by segment id and by location
+    Files with predictions for several targets (prediction_bike, etc.)
+    can be ordered by any of them
+    """
+
+    def __init__(self, features):
+        features = [f for f in features if f['properties']]
+        features.sort(key=lambda f: -(f['properties'].get('prediction') or 0))
+
+        self.segments = [f['properties'] for f in features]
+        self.prediction_keys = set(
+            key for segment in self.segments for key in segment
+            if key == 'prediction' or key.startswith('prediction_'))
+        self.orders = {'prediction': list(range(len(self.segments)))}
+        self.ranks = {}
+        self.by_id = {}
+        self.bounds = []
+        self.cells = {}
+        for i, feature in enumerate(features):
+            self.by_id.setdefault(
+                str(feature['properties'].get('segment_id')), i)
+
+            coords = get_coords(feature['geometry']) \
+                if feature['geometry'] else []
+            if not coords:
+                self.bounds.append(None)
+                continue
+            xs = [coord[0] for coord in coords]
+            ys = [coord[1] for coord in coords]
+            bounds = (min(xs), min(ys), max(xs), max(ys))
+            self.bounds.append(bounds)
+
+            minx, miny = get_cell(bounds[0], bounds[1])
+            maxx, maxy = get_cell(bounds[2], bounds[3])
+            for cell_x in range(minx, maxx + 1):
+                for cell_y in range(miny, maxy + 1):
+                    self.cells.setdefault((cell_x, cell_y), []).append(i)
+
+    @classmethod
+    def from_file(cls, filename):
+        with open(filename) as f:
+            return cls(json.load(f)['features'])
+
+    def order(self, key):
+        """
+        Positions of the segments, from highest to lowest value of key
+        """
+        if key not in self.orders:
+            self.orders[key] = sorted(
+                range(len(self.segments)),
+                key=lambda i: -(self.segments[i].get(key) or 0))
+        return self.orders[key]
+
+    def rank(self, key):
+        """
+        Each segment's place in the order for key
+        """
+        if key not in self.ranks:
+            ranks = [0] * len(self.segments)
+            for place, i in enumerate(self.order(key)):
+                ranks[i] = place
+            self.ranks[key] = ranks
+        return self.ranks[key]
+
+    def median(self, key='prediction'):
+        """
+        Median prediction, for comparing a segment to the rest of the city
+        """
+        if not self.segments:
+            return None
+        order = self.order(key)
+        return self.segments[order[len(order) // 2]].get(key)
+
+    def top(self, n, key='prediction'):
+        """
+        The n segments with the highest predictions
+        """
+        return [self.segments[i] for i in self.order(key)[:n]]
+
+    def get(self, segment_id):
+        """
+        A segment's properties, or None if there's no segment with that id
+        """
+        i = self.by_id.get(str(segment_id))
+        return None if i is None else self.segments[i]
+
+    def in_bbox(self, minx, miny, maxx, maxy, limit=None,
+                min_prediction=None, key='prediction'):
+        """
+        Segments that overlap a bounding box, highest prediction first
+        Args:
+            minx, miny, maxx, maxy - bounding box in longitude and latitude
+            limit - optional max number of segments to return
+            min_prediction - optional threshold on the prediction
+            key - prediction to order and threshold by
+        Returns:
+            list of segment properties
+        """
+        min_cell_x, min_cell_y = get_cell(minx, miny)
+        max_cell_x, max_cell_y = get_cell(maxx, maxy)
+
+        # For large boxes it's faster to check every segment
+        n_cells = (max_cell_x - min_cell_x + 1) * (max_cell_y - min_cell_y + 1)
+        if n_cells > len(self.cells):
+            candidates = self.order(key)
+        else:
+            candidates = set()
+            for cell_x in range(min_cell_x, max_cell_x + 1):
+                for cell_y in range(min_cell_y, max_cell_y + 1):
+                    candidates.update(self.cells.get((cell_x, cell_y), []))
+            candidates = sorted(candidates, key=self.rank(key).__getitem__)
+
+        results = []
+        for i in candidates:
+            bounds = self.bounds[i]
+            if bounds is None or bounds[0] > maxx or bounds[2] < minx \
+               or bounds[1] > maxy or bounds[3] < miny:
+                continue
+            segment = self.segments[i]
+            # Segments are in order of prediction, so we can stop here
+            if min_prediction is not None \
+               and (segment.get(key) or 0) < min_prediction:
+                break
+            results.append(segment)
+            if limit is not None and len(results) >= limit:
+                break
+        return results
+
+
+@lru_cache(maxsize=16)
+def get_index(filename, mtime):
+    """
+    Load a file's segment index, reloading if the file has changed
+    Args:
+        filename - preds_viz file
+        mtime - modification time of the file, so edits aren't cached
+    """
+    return SegmentIndex.from_file(filename)
+
+
+def load_indexes(data_dir):
+    """
+    Index every preds_viz file in the showcase's data directory
+    Args:
+        data_dir - directory with a subdirectory per city
+    Returns:
+        dict of (city, layer) to SegmentIndex,
+        e.g. ('boston', 'preds_viz_bike')
+    """
+    indexes = {}
+    for filename in sorted(glob.glob(
+            os.path.join(data_dir, '*', 'preds_viz*.geojson'))):
+        if HASHED_FILE.search(filename):
+            continue
+        city = os.path.basename(os.path.dirname(filename))
+        layer = os.path.splitext(os.path.basename(filename))[0]
+        try:
+            indexes[(city, layer)] = get_index(
+                filename, os.path.getmtime(filename))
+        except (ValueError, KeyError) as e:
+            print("Couldn't index {}: {}".format(filename, e))
+    print("Indexed {} prediction files".format(len(indexes)))
+    return indexes
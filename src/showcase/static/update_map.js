@@ -8,30 +8,105 @@ var riskColor = d3.scaleLinear()
 	.domain([0.2, 0.4, 0.6, 0.8])
 	.range(["#ffe0b2", "#ffb74d", "#ff9800", "#f57c00"]);
 
-d3.json(city.file, function(data) {
+// cities with several targets (e.g. bike, pedestrian) have a prediction
+// and crash counts per target, all in the same file
+var target = city.targets ? city.targets[0] : null;
 
-	for (var segment in data.features) {
-		segments.push(data.features[segment].properties);
+function predictionKey() {
+	return target ? "prediction_" + target : "prediction";
+}
+
+function crashesKey() {
+	return target ? "total_crashes_" + target : "total_crashes";
+}
+
+function crashDatesKey() {
+	return target ? "crash_dates_" + target : "crash_dates";
+}
+
+function loadHighestRisk() {
+	if(city.api) {
+		// only fetch the segments we show, the map itself is drawn from tiles
+		var url = city.api + "/top?n=10";
+		if(target) {
+			url += "&target=" + encodeURIComponent(target);
+		}
+		d3.json(url, function(data) {
+			showHighestRisk(data.segments);
+			showMedian(data.median);
+		});
+	}
+	else if(segments.length) {
+		showSegmentsFromFile();
+	}
+	else {
+		d3.json(city.file, function(data) {
+
+			for (var segment in data.features) {
+				segments.push(data.features[segment].properties);
+			}
+
+			segmentsHash = d3.map(segments, function(d) { return d.segment_id; });
+
+			showSegmentsFromFile();
+			// populateFeatureImportancesTbl(data);
+		});
 	}
+}
+
+function showSegmentsFromFile() {
+	var key = predictionKey();
+	var sorted = segments.slice().sort(function(a, b) { return b[key] - a[key]; });
+
+	var midpoint = Math.floor(sorted.length/2);
+	var median = sorted[midpoint][key];
+
+	showHighestRisk(sorted.slice(0, 10));
+	showMedian(median);
+}
+
+loadHighestRisk();
+
+// switch the map, highest risk list and bar chart to another target
+function setTarget(newTarget) {
+	target = newTarget;
+
+	var lineColor = map.getPaintProperty('predictions', 'line-color');
+	lineColor.property = predictionKey();
+	map.setPaintProperty('predictions', 'line-color', lineColor);
+	map.setPaintProperty('crashes', 'circle-radius', crashRadius());
 
-	var midpoint = Math.floor(segments.length/2);
-	var median = segments[midpoint].prediction;
+	update_map(map);
+	loadHighestRisk();
+}
+
+// crash circles are sized by the number of crashes at that location
+function crashRadius() {
+	return [
+		'interpolate', ['linear'], ['zoom'],
+		12, ['interpolate', ['linear'], ['get', crashesKey()], 1, 3, 100, 40],
+		18, ['interpolate', ['linear'], ['get', crashesKey()], 1, 10, 100, 120],
+	];
+}
+
+function showMedian(median) {
+	d3.select("#predChart").selectAll("*").remove();
+	makeBarChart(0, median);
+}
 
-	segmentsHash = d3.map(segments, function(d) { return d.segment_id; });
+function showHighestRisk(highestRisk) {
+	d3.select("#highest_risk_list").selectAll("li").remove();
 
 	d3.select("#highest_risk_list")
 		.selectAll("li")
-		.data(segments.slice(0, 10))
+		.data(highestRisk)
 		.enter()
 		.append("li")
 		.attr("class", "highRiskSegment")
 		.html(function(d) { var nameObj = splitSegmentName(d.segment.display_name);
 							return nameObj["name"] + "<br><span class='secondary'>" + nameObj["secondary"] + "</span>"; })
 		.on("click", function(d) { populateSegmentInfo(d.segment_id); });
-
-	makeBarChart(0, median);
-	// populateFeatureImportancesTbl(data);
-});
+}
 
 function splitSegmentName(segmentName) {
 	var i = segmentName.length;
@@ -53,8 +128,25 @@ function zoomToSegment(segmentX, segmentY) {
 	map.flyTo({center:[segmentX, segmentY], zoom: 18});
 }
 
+// get a segment's properties from the api, or from the loaded file
+function getSegment(segmentID, callback) {
+	if(city.api) {
+		d3.json(city.api + "/segments/" + encodeURIComponent(segmentID), function(segmentData) {
+			if(segmentData) {
+				callback(segmentData);
+			}
+		});
+	}
+	else {
+		callback(segmentsHash.get(segmentID));
+	}
+}
+
 function populateSegmentInfo(segmentID) {
-	var segmentData = segmentsHash.get(segmentID);
+	getSegment(segmentID, showSegmentInfo);
+}
+
+function showSegmentInfo(segmentData) {
 	// console.log(segmentData);
 
 	d3.select('#segment_details .segment_name')
@@ -62,11 +154,12 @@ function populateSegmentInfo(segmentID) {
 						   return nameObj["name"] + "<br><span class='secondary'>" + nameObj["secondary"] + "</span>"; })
 		.on("click", function(d) { zoomToSegment(segmentData.segment.center_x, segmentData.segment.center_y); });
 
-	d3.select("#segment_details #prediction").text(DECIMALFMT(segmentData.prediction));
-	d3.select("#risk_circle").style("fill", function(d) { return riskColor(segmentData.prediction); });
+	var prediction = segmentData[predictionKey()];
+	d3.select("#segment_details #prediction").text(DECIMALFMT(prediction));
+	d3.select("#risk_circle").style("fill", function(d) { return riskColor(prediction); });
 
 	// update prediction bar chart gauge
-	updateBarChart(segmentData.prediction);
+	updateBarChart(prediction);
 
 	// update feature importances based on segment's attributes
 	// updateFeatureImportances(segmentData);
@@ -228,13 +321,18 @@ function update_map(map) {
 	var new_filter;
 
 	if(cityId === "boston") {
-		new_filter = ['all', ['>=', 'prediction', +filters['riskThreshold']], ['>=', 'SPEEDLIMIT', +filters['speedlimit']]];
+		new_filter = ['all', ['>=', predictionKey(), +filters['riskThreshold']], ['>=', 'SPEEDLIMIT', +filters['speedlimit']]];
 	}
 	else {
-		new_filter = ['all', ['>=', 'prediction', +filters['riskThreshold']], ['>=', 'osm_speed', +filters['speedlimit']]];
+		new_filter = ['all', ['>=', predictionKey(), +filters['riskThreshold']], ['>=', 'osm_speed', +filters['speedlimit']]];
 	}
 
 	map.setFilter('predictions', new_filter);
+
+	// only show locations with crashes of the current target
+	if(target) {
+		map.setFilter('crashes', ['>=', crashesKey(), 1]);
+	}
 }
 
 // event handlers to toggle crashes layer
@@ -0,0 +1,102 @@
+import os
+import gzip
+import json
+from .. import app
+from .test_segment_index import FEATURES, make_feature
+
+
+def write_data(tmpdir):
+    city_dir = os.path.join(tmpdir.strpath, 'boston')
+    os.makedirs(city_dir)
+    contents = b'{"type": "FeatureCollection", "features": []}'
+    for filename in ('preds_viz.geojson', 'preds_viz.3f2a9c0d1e.geojson'):
+        with open(os.path.join(city_dir, filename), 'wb') as f:
+            f.write(contents)
+    with gzip.open(os.path.join(
+            city_dir, 'preds_viz.3f2a9c0d1e.geojson.gz'), 'wb') as f:
+        f.write(contents)
+    return contents
+
+
+def test_static_files_compressed(tmpdir, monkeypatch):
+    contents = write_data(tmpdir)
+    monkeypatch.setattr(app, 'DATA_DIR', tmpdir.strpath)
+    client = app.app.test_client()
+
+    url = '/data/boston/preds_viz.3f2a9c0d1e.geojson'
+    response = client.get(url, headers={'Accept-Encoding': 'gzip, br'})
+    assert response.status_code == 200
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.headers['Content-Type'] == 'application/geo+json'
+    assert 'Accept-Encoding' in response.headers['Vary']
+    assert 'immutable' in response.headers['Cache-Control']
+    assert gzip.decompress(response.data) == contents
+
+    # Browsers that don't accept gzip get the original file
+    response = client.get(url, headers={'Accept-Encoding': 'identity'})
+    assert 'Content-Encoding' not in response.headers
+    assert response.data == contents
+
+
+def test_static_files_not_hashed(tmpdir, monkeypatch):
+    contents = write_data(tmpdir)
+    monkeypatch.setattr(app, 'DATA_DIR', tmpdir.strpath)
+    client = app.app.test_client()
+
+    response = client.get(
+        '/data/boston/preds_viz.geojson',
+        headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    assert 'Content-Encoding' not in response.headers
+    assert response.headers['Cache-Control'] == 'no-cache'
+    assert response.data == contents
+
+    assert client.get('/data/boston/missing.geojson').status_code == 404
+
+
+def write_preds(tmpdir, features, mtime):
+    filename = os.path.join(tmpdir.strpath, 'boston', 'preds_viz.geojson')
+    if not os.path.exists(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    with open(filename, 'w') as f:
+        json.dump({'type': 'FeatureCollection', 'features': features}, f)
+    os.utime(filename, (mtime, mtime))
+
+
+def test_api(tmpdir, monkeypatch):
+    write_preds(tmpdir, FEATURES, 1000)
+    monkeypatch.setattr(app, 'DATA_DIR', tmpdir.strpath)
+    client = app.app.test_client()
+
+    response = client.get('/api/boston/preds_viz/top?n=2')
+    assert response.status_code == 200
+    data = response.get_json()
+    assert data['count'] == 3
+    assert data['median'] == 0.5
+    assert [x['segment_id'] for x in data['segments']] == ['002', '003']
+
+    # Content-hashed names refer to the same file
+    response = client.get('/api/boston/preds_viz.3f2a9c0d1e/segments/001')
+    assert response.get_json()['prediction'] == 0.2
+
+    response = client.get(
+        '/api/boston/preds_viz/bbox?bbox=-71.07,42.35,-71.06,42.365')
+    assert [x['segment_id'] for x in response.get_json()['segments']] == [
+        '002', '001']
+
+    assert client.get('/api/boston/preds_viz/bbox?bbox=1,2').status_code \
+        == 400
+    assert client.get('/api/boston/preds_viz/top?n=0').status_code == 400
+    assert client.get('/api/boston/preds_viz/segments/999').status_code \
+        == 404
+    assert client.get('/api/boston/preds_viz_bike/top').status_code == 404
+    assert client.get(
+        '/api/boston/preds_viz/top?target=bike').status_code == 404
+
+    # The index is reloaded when the file changes
+    write_preds(tmpdir, FEATURES + [
+        make_feature('004', 1.0, [[-71.06, 42.36], [-71.061, 42.361]])],
+        2000)
+    response = client.get('/api/boston/preds_viz/top?n=1')
+    assert response.get_json()['count'] == 4
+    assert response.get_json()['segments'][0]['segment_id'] == '004'
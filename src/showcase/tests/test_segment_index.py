@@ -0,0 +1,71 @@
+import os
+import json
+from .. import segment_index
+
+
+def make_feature(segment_id, prediction, coords):
+    return {
+        'type': 'Feature',
+        'geometry': {'type': 'LineString', 'coordinates': coords},
+        'properties': {
+            'prediction': prediction,
+            'segment_id': segment_id,
+            'segment': {'id': segment_id, 'display_name': segment_id},
+        }
+    }
+
+
+FEATURES = [
+    make_feature('001', 0.2, [[-71.0686, 42.3516], [-71.0688, 42.3516]]),
+    make_feature('002', 0.9, [[-71.0600, 42.3600], [-71.0610, 42.3610]]),
+    make_feature('003', 0.5, [[-71.1000, 42.3000], [-71.1010, 42.3010]]),
+]
+
+
+def test_top_and_get():
+    index = segment_index.SegmentIndex(FEATURES)
+    assert [x['segment_id'] for x in index.top(2)] == ['002', '003']
+    assert index.median() == 0.5
+    assert index.get('001')['prediction'] == 0.2
+    assert index.get(1) is None
+
+
+def test_in_bbox():
+    index = segment_index.SegmentIndex(FEATURES)
+    assert [x['segment_id'] for x in index.in_bbox(
+        -71.07, 42.35, -71.06, 42.365)] == ['002', '001']
+    assert [x['segment_id'] for x in index.in_bbox(
+        -71.07, 42.35, -71.06, 42.365, min_prediction=0.5)] == ['002']
+    assert [x['segment_id'] for x in index.in_bbox(
+        -71.07, 42.35, -71.06, 42.365, limit=1)] == ['002']
+    # A box bigger than the whole city
+    assert len(index.in_bbox(-180, -90, 180, 90)) == 3
+    assert index.in_bbox(0, 0, 1, 1) == []
+
+
+def test_targets():
+    features = [make_feature('001', 0.2, [[-71.0686, 42.3516]]),
+                make_feature('002', 0.9, [[-71.0600, 42.3600]])]
+    features[0]['properties']['prediction_bike'] = 0.2
+    features[1]['properties']['prediction_bike'] = 0.1
+    index = segment_index.SegmentIndex(features)
+
+    assert index.prediction_keys == {'prediction', 'prediction_bike'}
+    assert [x['segment_id'] for x in index.top(2, 'prediction_bike')] == [
+        '001', '002']
+    assert index.median('prediction_bike') == 0.1
+    assert [x['segment_id'] for x in index.in_bbox(
+        -71.07, 42.35, -71.06, 42.365, key='prediction_bike',
+        min_prediction=0.15)] == ['001']
+
+
+def test_load_indexes(tmpdir):
+    city_dir = os.path.join(tmpdir.strpath, 'boston')
+    os.makedirs(city_dir)
+    for filename in ('preds_viz.geojson', 'preds_viz.3f2a9c0d1e.geojson',
+                     'crashes_rollup.geojson'):
+        with open(os.path.join(city_dir, filename), 'w') as f:
+            json.dump({'type': 'FeatureCollection', 'features': FEATURES}, f)
+
+    indexes = segment_index.load_indexes(tmpdir.strpath)
+    assert list(indexes.keys()) == [('boston', 'preds_viz')]
@@ -0,0 +1,179 @@
+import os
+import json
+from .. import tiles
+from .. import app
+
+
+def write_preds(tmpdir):
+    city_dir = os.path.join(tmpdir.strpath, 'boston')
+    os.makedirs(city_dir)
+    filename = os.path.join(city_dir, 'preds_viz_bike.geojson')
+    with open(filename, 'w') as f:
+        json.dump({'type': 'FeatureCollection', 'features': [{
+            'type': 'Feature',
+            'geometry': {
+                'type': 'LineString',
+                'coordinates': [[-71.068585, 42.35165],
+                                [-71.068768, 42.351617]]
+            },
+            'properties': {
+                'prediction': 0.12,
+                'crash': 0,
+                'segment_id': '001',
+                'osm_speed': 25,
+                'segment': {'id': '001', 'display_name': 'Park Plaza'}
+            }
+        }]}, f)
+    return filename
+
+
+def test_lonlat_to_world():
+    assert tiles.lonlat_to_world(-180, 0) == (0, 0.5)
+    x, y = tiles.lonlat_to_world(0, 85.0511)
+    assert x == 0.5
+    assert abs(y) < 1e-5
+
+
+def test_encode_geometry():
+    # Examples from the vector tile specification
+    assert tiles.encode_geometry([[(25, 17)]], 1) == [9, 50, 34]
+    assert tiles.encode_geometry([[(2, 2), (2, 10), (10, 10)]], 2) == [
+        9, 4, 4, 18, 0, 16, 16, 0]
+    assert tiles.encode_geometry(
+        [[(2, 2), (2, 10), (10, 10)], [(1, 1), (3, 5)]], 2) == [
+            9, 4, 4, 18, 0, 16, 16, 0, 9, 17, 17, 10, 4, 8]
+
+
+def test_simplify():
+    points = [(0, 0), (10, 1), (20, 0), (30, 50)]
+    assert tiles.simplify(points, 2) == [(0, 0), (20, 0), (30, 50)]
+    assert tiles.simplify(points, 0.5) == points
+
+
+def test_get_tile(tmpdir):
+    filename = write_preds(tmpdir)
+    source = tiles.TileSource(filename, tiles.tile_properties(
+        'preds_viz_bike'))
+    assert source.features[0]['properties'] == {
+        'prediction': 0.12, 'segment_id': '001', 'osm_speed': 25}
+
+    minx, miny, _, _ = source.features[0]['bounds']
+    z = 14
+    x, y = int(minx * 2 ** z), int(miny * 2 ** z)
+
+    tile = tiles.get_tile(filename, z, x, y)
+    assert tile
+    assert b'preds_viz_bike' in tile
+    assert b'segment_id' in tile
+    # The trimmed properties aren't included
+    assert b'Park Plaza' not in tile
+
+    # Nothing in a tile on the other side of the world
+    assert tiles.get_tile(filename, z, 0, 0) == b''
+
+
+def write_grid(tmpdir):
+    """
+    Short lines every 0.01 degrees, and one long line across them all
+    """
+    features = [{
+        'type': 'Feature',
+        'geometry': {'type': 'LineString', 'coordinates': [
+            [-71.1 + i * 0.01, 42.3 + j * 0.01],
+            [-71.1 + i * 0.01 + 0.002, 42.3 + j * 0.01 + 0.001]]},
+        'properties': {'prediction': i * 0.01 + j * 0.001},
+    } for i in range(10) for j in range(10)]
+    features.append({
+        'type': 'Feature',
+        'geometry': {'type': 'LineString', 'coordinates': [
+            [-71.11, 42.29], [-71.0, 42.4]]},
+        'properties': {'prediction': 1.0},
+    })
+    filename = os.path.join(tmpdir.strpath, 'preds_viz.geojson')
+    with open(filename, 'w') as f:
+        json.dump({'type': 'FeatureCollection', 'features': features}, f)
+    return filename
+
+
+def test_get_features(tmpdir):
+    source = tiles.TileSource(write_grid(tmpdir))
+    assert len(source.cells) > 20
+
+    # The grid gives the same features as checking all of them
+    for z in range(10, 18):
+        for lon, lat in [(-71.05, 42.35), (-71.1, 42.3), (-71.002, 42.391)]:
+            x, y = tiles.lonlat_to_world(lon, lat)
+            x, y = int(x * 2 ** z), int(y * 2 ** z)
+            for dx, dy in [(0, 0), (1, 0), (0, 1), (-1, -1)]:
+                size = 1.0 / 2 ** z
+                pad = size * tiles.BUFFER / tiles.EXTENT
+                minx, miny = (x + dx) * size - pad, (y + dy) * size - pad
+                maxx, maxy = minx + size + 2 * pad, miny + size + 2 * pad
+                expected = [
+                    f for f in source.features
+                    if f['bounds'][0] <= maxx and f['bounds'][2] >= minx
+                    and f['bounds'][1] <= maxy and f['bounds'][3] >= miny]
+                assert source.get_features(z, x + dx, y + dy) == expected
+
+
+def test_write_tiles(tmpdir):
+    filename = write_grid(tmpdir)
+    count = tiles.write_tiles(filename, max_zoom=12)
+    assert count > 13
+    directory = tiles.tiles_dir(filename)
+    assert not os.path.exists(directory + '.partial')
+
+    # The tiles written are the same as those cut on the fly
+    mtime = os.path.getmtime(filename)
+    x, y = tiles.lonlat_to_world(-71.05, 42.35)
+    for z in range(13):
+        tile_x, tile_y = int(x * 2 ** z), int(y * 2 ** z)
+        tile = tiles.read_tile(filename, mtime, z, tile_x, tile_y)
+        assert tile
+        assert tile == tiles.make_tile(filename, mtime, z, tile_x, tile_y)
+    assert tiles.read_tile(filename, mtime, 12, 0, 0) == b''
+    assert tiles.read_tile(filename, mtime, 13, 0, 0) is None
+
+    # Tiles written before the file changed aren't used
+    os.utime(directory, (mtime - 10, mtime - 10))
+    assert tiles.read_tile(filename, mtime, 0, 0, 0) is None
+
+
+def test_load_sources(tmpdir):
+    filename = write_preds(tmpdir)
+    city_dir = os.path.dirname(filename)
+    for name in ('preds_viz_bike.3f2a9c0d1e.geojson', 'preds_viz.geojson',
+                 'other.geojson'):
+        with open(filename) as f, open(os.path.join(city_dir, name),
+                                       'w') as out:
+            out.write(f.read())
+
+    assert tiles.load_sources(tmpdir.strpath) == [
+        os.path.join(city_dir, 'preds_viz.geojson'),
+        os.path.join(city_dir, 'preds_viz_bike.3f2a9c0d1e.geojson'),
+    ]
+
+
+def test_vector_tile_route(tmpdir, monkeypatch):
+    filename = write_preds(tmpdir)
+    monkeypatch.setattr(app, 'DATA_DIR', tmpdir.strpath)
+    source = tiles.TileSource(filename)
+    minx, miny, _, _ = source.features[0]['bounds']
+    x, y = int(minx * 2 ** 14), int(miny * 2 ** 14)
+
+    client = app.app.test_client()
+    url = '/tiles/boston/preds_viz_bike/14/{}/{}.pbf'.format(x, y)
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.headers['Content-Type'] == 'application/x-protobuf'
+    assert 'max-age' in response.headers['Cache-Control']
+
+    etag = response.headers['ETag']
+    response = client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 304
+
+    assert client.get(
+        '/tiles/boston/preds_viz_ped/14/{}/{}.pbf'.format(x, y)
+    ).status_code == 404
+    assert client.get('/tiles/boston/preds_viz_bike/1/5/0.pbf').status_code \
+        == 404
@@ -0,0 +1,486 @@
+# Serve Mapbox vector tiles made from the showcase's geojson files
+# Tiles are cut on the fly from the preds_viz and crashes_rollup
+# files and cached in memory.  Geometry is quantized to the tile grid and
+# simplified for the tile's zoom level, and only the properties the map
+# needs are kept.
+# Low zoom tiles have most of a city in them, so are slow to cut; the
+# pipeline cuts them ahead of time with write_tiles.
+# This only uses the standard library, so the showcase image doesn't need
+# any dependencies beyond flask.
+
+import glob
+import json
+import math
+import os
+import shutil
+import struct
+from functools import lru_cache
+
+EXTENT = 4096
+# Max distance, in tile units, a simplified line can be from the original
+# EXTENT / 256 is one pixel on a standard 256 pixel tile
+SIMPLIFY_TOLERANCE = 8
+# Extra tile units around each tile, so lines aren't cut off at the edges
+BUFFER = 64
+# Features are indexed by the tiles at this zoom level that they overlap,
+# so cutting a tile only looks at the features near it
+GRID_ZOOM = 14
+# Tiles up to this zoom, the map's initial zoom, are cut ahead of time
+PREGENERATED_ZOOM = 12
+
+# Properties to keep for each layer type; everything else is dropped
+# Per target versions of these, e.g. prediction_bike, are kept too
+TILE_PROPERTIES = {
+    'preds_viz': ['prediction', 'segment_id', 'osm_speed', 'SPEEDLIMIT'],
+    'crashes_rollup': ['total_crashes', 'crash_dates'],
+}
+
+GEOM_TYPES = {
+    'Point': 1,
+    'MultiPoint': 1,
+    'LineString': 2,
+    'MultiLineString': 2,
+}
+
+
+def tile_properties(layer):
+    """
+    Get the list of properties to keep for a layer, based on its name
+    e.g. preds_viz_bike -> preds_viz
+    """
+    for prefix, properties in TILE_PROPERTIES.items():
+        if layer.startswith(prefix):
+            return properties
+    return None
+
+
+def keep_property(key, properties):
+    """
+    Whether to keep a property, given the list of properties for its layer
+    """
+    return key in properties or any(
+        key.startswith(prop + '_') for prop in properties)
+
+
+def lonlat_to_world(lon, lat):
+    """
+    Convert a longitude and latitude to web mercator coordinates,
+    scaled so the whole world is the square from 0 to 1
+    """
+    lat = max(min(lat, 85.0511), -85.0511)
+    x = (lon + 180.0) / 360.0
+    sin_lat = math.sin(math.radians(lat))
+    y = 0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)
+    return x, y
+
+
+def get_parts(geometry):
+    """
+    Get the list of coordinate lists that make up a geometry
+    """
+    if geometry['type'] == 'Point':
+        return [[geometry['coordinates']]]
+    if geometry['type'] in ('MultiPoint', 'LineString'):
+        return [geometry['coordinates']]
+    if geometry['type'] == 'MultiLineString':
+        return geometry['coordinates']
+    return []
+
+
+def get_cell(x, y):
+    """
+    Grid cell of a point in world coordinates
+    """
+    scale = 2 ** GRID_ZOOM
+    return int(x * scale), int(y * scale)
+
+
+class TileSource(object):
+    """
+    A geojson file, projected once into world coordinates,
+    that tiles can be cut from
+    """
+
+    def __init__(self, filename, properties=None):
+        with open(filename) as f:
+            features = json.load(f)['features']
+
+        self.features = []
+        self.cells = {}
+        for feature in features:
+            geometry = feature['geometry']
+            if not geometry or geometry['type'] not in GEOM_TYPES:
+                continue
+            parts = [[lonlat_to_world(coord[0], coord[1]) for coord in part]
+                     for part in get_parts(geometry)]
+            xs = [x for part in parts for x, _ in part]
+            ys = [y for part in parts for _, y in part]
+
+            props = feature['properties'] or {}
+            if properties is not None:
+                props = {k: v for k, v in props.items()
+                         if keep_property(k, properties)}
+
+            bounds = (min(xs), min(ys), max(xs), max(ys))
+            min_cell_x, min_cell_y = get_cell(bounds[0], bounds[1])
+            max_cell_x, max_cell_y = get_cell(bounds[2], bounds[3])
+            for cell_x in range(min_cell_x, max_cell_x + 1):
+                for cell_y in range(min_cell_y, max_cell_y + 1):
+                    self.cells.setdefault((cell_x, cell_y), []).append(
+                        len(self.features))
+
+            self.features.append({
+                'type': GEOM_TYPES[geometry['type']],
+                'parts': parts,
+                'bounds': bounds,
+                'properties': props,
+            })
+
+    def get_features(self, z, x, y):
+        """
+        Get the features that overlap a tile, including its buffer
+        """
+        size = 1.0 / (2 ** z)
+        pad = size * BUFFER / EXTENT
+        minx, miny = x * size - pad, y * size - pad
+        maxx, maxy = (x + 1) * size + pad, (y + 1) * size + pad
+
+        min_cell_x, min_cell_y = get_cell(minx, miny)
+        max_cell_x, max_cell_y = get_cell(maxx, maxy)
+        # For low zoom tiles it's faster to check every feature
+        n_cells = (max_cell_x - min_cell_x + 1) * (max_cell_y - min_cell_y + 1)
+        if n_cells > len(self.cells):
+            candidates = self.features
+        else:
+            indexes = set()
+            for cell_x in range(min_cell_x, max_cell_x + 1):
+                for cell_y in range(min_cell_y, max_cell_y + 1):
+                    indexes.update(self.cells.get((cell_x, cell_y), []))
+            # Keep the features in the order they're in the file
+            candidates = [self.features[i] for i in sorted(indexes)]
+
+        return [f for f in candidates
+                if f['bounds'][0] <= maxx and f['bounds'][2] >= minx
+                and f['bounds'][1] <= maxy and f['bounds'][3] >= miny]
+
+
+def simplify(points, tolerance):
+    """
+    Douglas-Peucker simplification of a list of integer points
+    """
+    if len(points) < 3:
+        return points
+
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        start, end = stack.pop()
+        (x1, y1), (x2, y2) = points[start], points[end]
+        dx, dy = x2 - x1, y2 - y1
+        length = math.hypot(dx, dy)
+        max_dist, index = 0, None
+        for i in range(start + 1, end):
+            px, py = points[i]
+            if length:
+                dist = abs(dy * px - dx * py + x2 * y1 - y2 * x1) / length
+            else:
+                dist = math.hypot(px - x1, py - y1)
+            if dist > max_dist:
+                max_dist, index = dist, i
+        if index is not None and max_dist > tolerance:
+            keep[index] = True
+            stack.append((start, index))
+            stack.append((index, end))
+
+    return [p for p, k in zip(points, keep) if k]
+
+
+def to_tile_coords(part, z, x, y, geom_type):
+    """
+    Convert world coordinates to integer tile coordinates,
+    dropping repeated points and simplifying lines
+    """
+    scale = 2 ** z * EXTENT
+    offset_x, offset_y = x * EXTENT, y * EXTENT
+    points = []
+    for wx, wy in part:
+        point = (round(wx * scale - offset_x), round(wy * scale - offset_y))
+        if not points or points[-1] != point or geom_type == 1:
+            points.append(point)
+    if geom_type == 2:
+        points = simplify(points, SIMPLIFY_TOLERANCE)
+    return points
+
+
+# Protocol buffer encoding
+
+# Most numbers in a tile fit in a single byte
+SMALL_VARINTS = [bytes((i,)) for i in range(0x80)]
+
+
+def varint(value):
+    if value < 0x80:
+        return SMALL_VARINTS[value]
+    result = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            result.append(byte | 0x80)
+        else:
+            result.append(byte)
+            return bytes(result)
+
+
+def zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def field(number, wire_type):
+    return varint((number << 3) | wire_type)
+
+
+def length_delimited(number, payload):
+    return field(number, 2) + varint(len(payload)) + payload
+
+
+def packed(number, values):
+    return length_delimited(number, b''.join(varint(v) for v in values))
+
+
+def encode_value(value):
+    """
+    Encode a property value as a vector tile Value message
+    """
+    if isinstance(value, bool):
+        return field(7, 0) + varint(int(value))
+    if isinstance(value, int):
+        return field(6, 0) + varint(zigzag(value))
+    if isinstance(value, float):
+        return field(3, 1) + struct.pack('<d', value)
+    return length_delimited(1, str(value).encode('utf-8'))
+
+
+def encode_geometry(parts, geom_type):
+    """
+    Encode a list of tile coordinate lists as vector tile geometry commands
+    """
+    commands = []
+    cursor_x, cursor_y = 0, 0
+    if geom_type == 1:
+        points = [p for part in parts for p in part]
+        commands.append(1 | (len(points) << 3))
+        for px, py in points:
+            commands.extend([zigzag(px - cursor_x), zigzag(py - cursor_y)])
+            cursor_x, cursor_y = px, py
+        return commands
+
+    for part in parts:
+        commands.append(1 | (1 << 3))
+        commands.extend([zigzag(part[0][0] - cursor_x),
+                         zigzag(part[0][1] - cursor_y)])
+        cursor_x, cursor_y = part[0]
+        commands.append(2 | ((len(part) - 1) << 3))
+        for px, py in part[1:]:
+            commands.extend([zigzag(px - cursor_x), zigzag(py - cursor_y)])
+            cursor_x, cursor_y = px, py
+    return commands
+
+
+def encode_layer(name, features, z, x, y):
+    """
+    Encode the features that overlap a tile as a vector tile layer
+    Returns:
+        the layer, or None if no features have any geometry in the tile
+    """
+    keys, key_index = [], {}
+    values, value_index = [], {}
+    encoded = []
+
+    for i, feature in enumerate(features):
+        parts = [to_tile_coords(part, z, x, y, feature['type'])
+                 for part in feature['parts']]
+        if feature['type'] == 2:
+            parts = [part for part in parts if len(part) > 1]
+        if not parts:
+            continue
+
+        tags = []
+        for key, value in feature['properties'].items():
+            if value is None:
+                continue
+            if isinstance(value, (dict, list)):
+                value = json.dumps(value)
+            if key not in key_index:
+                key_index[key] = len(keys)
+                keys.append(key)
+            value_key = (type(value), value)
+            if value_key not in value_index:
+                value_index[value_key] = len(values)
+                values.append(value)
+            tags.extend([key_index[key], value_index[value_key]])
+
+        encoded.append(length_delimited(
+            2,
+            field(1, 0) + varint(i)
+            + packed(2, tags)
+            + field(3, 0) + varint(feature['type'])
+            + packed(4, encode_geometry(parts, feature['type']))))
+
+    if not encoded:
+        return None
+
+    return length_delimited(
+        3,
+        field(15, 0) + varint(2)
+        + length_delimited(1, name.encode('utf-8'))
+        + b''.join(encoded)
+        + b''.join(length_delimited(3, k.encode('utf-8')) for k in keys)
+        + b''.join(length_delimited(4, encode_value(v)) for v in values)
+        + field(5, 0) + varint(EXTENT))
+
+
+def tiles_dir(filename):
+    """
+    Directory of the tiles cut ahead of time from a geojson file,
+    e.g. preds_viz.3f2a9c0d1e.geojson.tiles
+    """
+    return filename + '.tiles'
+
+
+def write_tiles(filename, max_zoom=PREGENERATED_ZOOM):
+    """
+    Cut the tiles up to a zoom level that have features in them, and
+    write them to tiles_dir(filename) as <z>/<x>/<y>.pbf
+    The directory is only put in place once all of them are written,
+    so the app never serves a partial set
+    Args:
+        filename - geojson file
+        max_zoom - highest zoom level to cut
+    Returns:
+        number of tiles written
+    """
+    name = os.path.splitext(os.path.basename(filename))[0]
+    source = TileSource(filename, tile_properties(name))
+    directory = tiles_dir(filename)
+    partial = directory + '.partial'
+    for old in (directory, partial):
+        if os.path.exists(old):
+            shutil.rmtree(old)
+    os.makedirs(partial)
+
+    count = 0
+    if source.features:
+        bounds = [f['bounds'] for f in source.features]
+        minx, miny = min(b[0] for b in bounds), min(b[1] for b in bounds)
+        maxx, maxy = max(b[2] for b in bounds), max(b[3] for b in bounds)
+        for z in range(max_zoom + 1):
+            # Include the tiles whose buffers reach the features
+            pad = float(BUFFER) / EXTENT
+            n = 2 ** z
+            xs = range(max(int(minx * n - pad), 0),
+                       min(int(maxx * n + pad), n - 1) + 1)
+            ys = range(max(int(miny * n - pad), 0),
+                       min(int(maxy * n + pad), n - 1) + 1)
+            for x in xs:
+                for y in ys:
+                    layer = encode_layer(
+                        name, source.get_features(z, x, y), z, x, y)
+                    if not layer:
+                        continue
+                    tile_file = os.path.join(
+                        partial, str(z), str(x), '{}.pbf'.format(y))
+                    if not os.path.exists(os.path.dirname(tile_file)):
+                        os.makedirs(os.path.dirname(tile_file))
+                    with open(tile_file, 'wb') as f:
+                        f.write(layer)
+                    count += 1
+
+    os.rename(partial, directory)
+    return count
+
+
+def read_tile(filename, mtime, z, x, y):
+    """
+    Read a tile cut ahead of time by write_tiles
+    Returns:
+        the tile, empty if it has no features, or None if the tiles
+        weren't cut, or were cut from an older version of the file
+    """
+    directory = tiles_dir(filename)
+    if z > PREGENERATED_ZOOM or not os.path.isdir(directory) \
+       or os.path.getmtime(directory) < mtime:
+        return None
+    tile_file = os.path.join(directory, str(z), str(x), '{}.pbf'.format(y))
+    if not os.path.exists(tile_file):
+        return b''
+    with open(tile_file, 'rb') as f:
+        return f.read()
+
+
+@lru_cache(maxsize=16)
+def get_source(filename, mtime):
+    """
+    Load a tile source, reloading if the file has changed
+    """
+    name = os.path.splitext(os.path.basename(filename))[0]
+    return TileSource(filename, tile_properties(name))
+
+
+@lru_cache(maxsize=4096)
+def make_tile(filename, mtime, z, x, y):
+    """
+    Make a vector tile with a single layer, named after the file
+    e.g. preds_viz_bike.geojson gives the layer preds_viz_bike
+    Args:
+        filename - geojson file
+        mtime - modification time of the file, so edits aren't cached
+        z, x, y - tile coordinates
+    Returns:
+        the encoded tile (empty if there are no features in it)
+    """
+    source = get_source(filename, mtime)
+    name = os.path.splitext(os.path.basename(filename))[0]
+    layer = encode_layer(name, source.get_features(z, x, y), z, x, y)
+    return layer or b''
+
+
+def get_tile(filename, z, x, y):
+    mtime = os.path.getmtime(filename)
+    tile = read_tile(filename, mtime, z, x, y)
+    if tile is None:
+        tile = make_tile(filename, mtime, z, x, y)
+    return tile
+
+
+def load_sources(data_dir):
+    """
+    Load the tile sources for every city's files when the app starts,
+    so the first tiles the map asks for don't wait for them
+    The map asks for tiles from the content-hashed copies of files
+    where there are any, so only those are loaded
+    Args:
+        data_dir - directory with a subdirectory per city
+    Returns:
+        list of the files loaded
+    """
+    files = {}
+    for filename in sorted(glob.glob(
+            os.path.join(data_dir, '*', '*.geojson'))):
+        name = os.path.basename(filename).split('.')[0]
+        if tile_properties(name) is None:
+            continue
+        key = (os.path.dirname(filename), name)
+        if key not in files or filename.count('.') > files[key].count('.'):
+            files[key] = filename
+
+    loaded = []
+    for filename in sorted(files.values()):
+        try:
+            get_source(filename, os.path.getmtime(filename))
+            loaded.append(filename)
+        except (ValueError, KeyError) as e:
+            print("Couldn't load tiles for {}: {}".format(filename, e))
+    print("Loaded tiles for {} files".format(len(loaded)))
+    return loaded
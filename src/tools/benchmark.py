@@ -0,0 +1,563 @@
+# Benchmark the data generation, model and visualization stages
+# Generates a synthetic city (a grid of roads with crashes, waze snapshots,
+# point features and volume counts), runs each stage on it the same way
+# make_dataset.py and pipeline.py do, and appends the wall time, peak
+# memory and throughput of each stage to a json history file, so
+# performance can be compared across commits.
+# Everything is generated locally, so this runs without a network connection.
+
+import argparse
+import datetime
+import json
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import yaml
+
+BASE_DIR = os.path.dirname(
+    os.path.dirname(
+        os.path.dirname(
+            os.path.abspath(__file__))))
+SRC_DIR = os.path.join(BASE_DIR, 'src')
+HISTORY_FILE = os.path.join(BASE_DIR, 'reports', 'benchmarks.json')
+
+# Center of the synthetic city, and distance between intersections
+LATITUDE = 42.36
+LONGITUDE = -71.06
+BLOCK_METERS = 100
+METERS_PER_DEGREE = 111320.0
+
+START_DATE = datetime.datetime(2016, 1, 1)
+DAYS = 3 * 365
+
+HIGHWAYS = ['residential', 'tertiary', 'secondary', 'primary']
+ALERT_TYPES = ['JAM', 'ACCIDENT', 'WEATHERHAZARD', 'ROAD_CLOSED']
+
+# Stages in the order the pipeline runs them, with the module to run
+# and what the stage's throughput is measured in
+STAGES = [
+    ('add_jams', 'data.add_waze_data', 'waze_events'),
+    ('create_segments', 'data.create_segments', 'ways'),
+    ('find_nearest', 'data.join_segments_crash', 'crashes'),
+    ('propagate_volume', 'data.propagate_volume', 'volumes'),
+    ('make_canon_dataset', 'features.make_canon_dataset', 'ways'),
+    ('train_model', 'models.train_model', 'ways'),
+    ('make_preds_viz', 'data.make_preds_viz', 'ways'),
+]
+STAGE_NAMES = [name for name, _, _ in STAGES]
+
+
+def make_config(name):
+    """
+    Config for a synthetic city, with the osm, waze and point-based
+    features the generated data has
+    """
+    return {
+        'city': 'Synthetic City, Massachusetts, USA',
+        'name': name,
+        'city_latitude': LATITUDE,
+        'city_longitude': LONGITUDE,
+        'city_radius': 5,
+        'timezone': 'America/New_York',
+        'startdate': None,
+        'enddate': None,
+        'crashes_files': {'synthetic': {}},
+        'data_source': [{
+            'name': 'parking_tickets',
+            'feat_type': 'continuous',
+        }],
+        'openstreetmap_features': {
+            'categorical': {
+                'width': 'Width',
+                'cycleway_type': 'Bike lane',
+                'oneway': 'One Way',
+                'lanes': 'Number of lanes',
+                'signal': 'Traffic signal',
+            },
+            'continuous': {
+                'width_per_lane': 'Average width per lane',
+            },
+        },
+        'waze_features': {
+            'categorical': {
+                'jam': 'Existence of a jam',
+            },
+            'continuous': {
+                'jam_percent': 'Percent of time there was a jam',
+            },
+        },
+    }
+
+
+class City(object):
+    """
+    A size x size grid of intersections, in 4326 projection,
+    with a street along each row and an avenue along each column
+    """
+
+    def __init__(self, size, seed=0):
+        self.size = size
+        self.random = random.Random(seed)
+        self.dlat = BLOCK_METERS / METERS_PER_DEGREE
+        self.dlon = BLOCK_METERS / (
+            METERS_PER_DEGREE * math.cos(math.radians(LATITUDE)))
+
+    def coords(self, row, col):
+        return [
+            round(LONGITUDE + (col - self.size / 2.0) * self.dlon, 7),
+            round(LATITUDE + (row - self.size / 2.0) * self.dlat, 7)]
+
+    def node_id(self, row, col):
+        return str(row * self.size + col + 1)
+
+    def street(self, row):
+        return '{} Street'.format(row + 1)
+
+    def avenue(self, col):
+        return '{} Avenue'.format(col + 1)
+
+    def ways(self):
+        """
+        One way per block, with the properties osm_create_maps gives them
+        """
+        ways = []
+        for horizontal in (True, False):
+            for line in range(self.size):
+                highway = self.random.randrange(len(HIGHWAYS))
+                lanes = self.random.choice([1, 2, 2, 4])
+                width = lanes * self.random.choice([3, 4])
+                oneway = int(lanes == 1)
+                cycleway = self.random.choice([0, 0, 0, 1])
+                name = self.street(line) if horizontal else self.avenue(line)
+                osmid = str((1 if horizontal else 2) * 100000 + line)
+
+                for step in range(self.size - 1):
+                    ends = [(line, step), (line, step + 1)] if horizontal \
+                        else [(step, line), (step + 1, line)]
+                    start, end = [self.coords(*x) for x in ends]
+                    from_node, to_node = [self.node_id(*x) for x in ends]
+                    middle = [round((start[0] + end[0]) / 2, 7),
+                              round((start[1] + end[1]) / 2, 7)]
+                    ways.append({
+                        'type': 'Feature',
+                        'geometry': {
+                            'type': 'LineString',
+                            'coordinates': [start, middle, end],
+                        },
+                        'properties': {
+                            'id': str(len(ways)),
+                            'osmid': osmid,
+                            'name': name,
+                            'highway': HIGHWAYS[highway],
+                            'from': from_node,
+                            'to': to_node,
+                            'key': '0',
+                            'length': str(BLOCK_METERS),
+                            'maxspeed': None,
+                            'width': width,
+                            'lanes': lanes,
+                            'hwy_type': highway + 1,
+                            'cycleway_type': cycleway,
+                            'osm_speed': [25, 25, 30, 35][highway],
+                            'signal': 0,
+                            'oneway': oneway,
+                            'width_per_lane': int(round(width / lanes)),
+                            'segment_id': '-'.join(
+                                [osmid, from_node, to_node]),
+                        },
+                    })
+        return ways
+
+    def nodes(self):
+        """
+        An intersection at every grid point, some of them signalized
+        """
+        nodes = []
+        for row in range(self.size):
+            for col in range(self.size):
+                signal = self.random.random() < .2
+                nodes.append({
+                    'type': 'Feature',
+                    'geometry': {
+                        'type': 'Point',
+                        'coordinates': self.coords(row, col),
+                    },
+                    'properties': {
+                        'osmid': self.node_id(row, col),
+                        'highway': 'traffic_signals' if signal else None,
+                        'dead_end': False,
+                        'intersection': 1,
+                        'signal': int(signal),
+                        'streets': ', '.join(
+                            [self.street(row), self.avenue(col)]),
+                    },
+                })
+        return nodes
+
+    def location(self, jitter=.1):
+        """
+        A random point on the road network, up to jitter blocks away
+        """
+        line = self.random.randrange(self.size)
+        along = self.random.uniform(0, self.size - 1)
+        offset = self.random.uniform(-jitter, jitter)
+        row, col = (line + offset, along) \
+            if self.random.random() < .5 else (along, line + offset)
+        lon, lat = self.coords(row, col)
+        return {'latitude': lat, 'longitude': lon}
+
+    def date(self):
+        return START_DATE + datetime.timedelta(
+            seconds=self.random.randrange(DAYS * 24 * 3600))
+
+    def crashes(self, count):
+        return [{
+            'id': i + 1,
+            'dateOccurred': self.date().strftime('%Y-%m-%dT%H:%M:%S-05:00'),
+            'location': self.location(),
+            'address': '',
+            'summary': '',
+        } for i in range(count)]
+
+    def jam(self, snapshot):
+        """
+        A jam along two to four blocks of a random street or avenue
+        """
+        line = self.random.randrange(self.size)
+        blocks = self.random.randint(2, 4)
+        start = self.random.randrange(max(self.size - blocks, 1))
+        steps = range(start, min(start + blocks, self.size - 1) + 1)
+        horizontal = self.random.random() < .5
+        coords = [self.coords(line, x) if horizontal else self.coords(x, line)
+                  for x in steps]
+        return {
+            'eventType': 'jam',
+            'type': 'NONE',
+            'line': [{'x': x, 'y': y} for x, y in coords],
+            'street': self.street(line) if horizontal else self.avenue(line),
+            'level': self.random.randint(1, 5),
+            'speed': self.random.randint(0, 20),
+            'snapshotId': snapshot,
+        }
+
+    def alert(self, snapshot):
+        return {
+            'eventType': 'alert',
+            'type': self.random.choice(ALERT_TYPES),
+            'location': self.location(jitter=.05),
+            'snapshotId': snapshot,
+        }
+
+    def waze(self, snapshots, events):
+        """
+        Jams and alerts for each snapshot, events of each per snapshot
+        """
+        items = []
+        for snapshot in range(1, snapshots + 1):
+            for _ in range(events):
+                items.append(self.jam(snapshot))
+                items.append(self.alert(snapshot))
+        return items
+
+    def points(self, count):
+        return [{
+            'feature': 'parking_tickets',
+            'date': self.date().strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'location': self.location(jitter=.05),
+            'category': self.random.choice(['NO PARKING', 'METER EXPIRED']),
+        } for _ in range(count)]
+
+    def volumes(self, count):
+        volumes = []
+        for _ in range(count):
+            hourly = [self.random.randint(0, 200) for _ in range(24)]
+            total = sum(hourly)
+            heavy = total // 20
+            bikes = total // 50
+            volumes.append({
+                'startDateTime': self.date().strftime('%Y-%m-%d'),
+                'location': dict(self.location(jitter=.02), address=''),
+                'volume': {
+                    'totalVolume': total,
+                    'totalLightVehicles': total - heavy - bikes,
+                    'totalHeavyVehicles': heavy,
+                    'bikes': bikes,
+                    'hourlyVolume': hourly,
+                },
+                'speed': {'averageSpeed': self.random.randint(15, 40)},
+            })
+        return volumes
+
+
+def write_json(filename, contents):
+    with open(filename, 'w') as f:
+        json.dump(contents, f)
+
+
+def make_city(datadir, size=20, crashes=5000, snapshots=50, events=None,
+              points=1000, volumes=50, seed=0):
+    """
+    Write a synthetic city's config, map and standardized data,
+    in the layout the pipeline expects after data standardization
+    and downloading the map
+    Args:
+        datadir - directory to write the city to
+        size - number of intersections along each side of the grid
+        crashes - number of crashes
+        snapshots - number of waze snapshots
+        events - number of jams and of alerts in each snapshot,
+            defaults to half the grid size
+        points - number of point-based features
+        volumes - number of volume counts
+        seed - random seed, so runs with the same arguments
+            have the same data
+    Returns:
+        the config filename, and a dict of the number of items
+        of each type, for measuring throughput
+    """
+    city = City(size, seed)
+    if events is None:
+        events = max(size // 2, 1)
+
+    for directory in ['standardized', 'processed/maps', 'docs']:
+        os.makedirs(os.path.join(datadir, directory), exist_ok=True)
+
+    config_file = os.path.join(datadir, 'config_synthetic.yml')
+    with open(config_file, 'w') as f:
+        yaml.safe_dump(make_config(os.path.basename(datadir)), f)
+
+    ways = city.ways()
+    write_json(os.path.join(datadir, 'processed', 'maps',
+                            'osm_elements.geojson'), {
+        'type': 'FeatureCollection',
+        'features': ways + city.nodes(),
+    })
+
+    standardized = os.path.join(datadir, 'standardized')
+    write_json(os.path.join(standardized, 'crashes.json'),
+               city.crashes(crashes))
+    waze = city.waze(snapshots, events)
+    if waze:
+        write_json(os.path.join(standardized, 'waze.json'), waze)
+    write_json(os.path.join(standardized, 'points.json'),
+               city.points(points))
+    write_json(os.path.join(standardized, 'volume.json'),
+               city.volumes(volumes))
+
+    return config_file, {
+        'ways': len(ways),
+        'crashes': crashes,
+        'waze_events': len(waze),
+        'points': points,
+        'volumes': volumes,
+    }
+
+
+def run_stage(args, log_file):
+    """
+    Run a stage in its own python process, measuring its wall time
+    and the peak resident memory of the process
+    Args:
+        args - arguments to python, e.g. ['-m', 'data.create_segments', ...]
+        log_file - file to write the stage's output to
+    Returns:
+        wall time in seconds, peak rss in MB, and the return code
+    """
+    with open(log_file, 'w') as log:
+        start = time.time()
+        process = subprocess.Popen(
+            [sys.executable] + args, cwd=SRC_DIR, stdout=log,
+            stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(process.pid, 0)
+        seconds = time.time() - start
+    # Negative if the stage was killed by a signal, as with Popen
+    process.returncode = os.WEXITSTATUS(status) \
+        if os.WIFEXITED(status) else -os.WTERMSIG(status)
+
+    # ru_maxrss is in kilobytes on linux
+    return seconds, usage.ru_maxrss / 1024.0, process.returncode
+
+
+def stage_args(name, module, datadir, config_file):
+    """
+    The arguments each stage is run with in the pipeline
+    """
+    args = ['-m', module, '-d', datadir]
+    if name not in ('add_jams', 'propagate_volume'):
+        args += ['-c', config_file]
+    return args
+
+
+def run_stages(datadir, config_file, counts, stages=None):
+    """
+    Run the stages in order, stopping at the first one that fails,
+    since later stages need the earlier stages' output
+    Args:
+        datadir - the synthetic city's directory
+        config_file
+        counts - dict of item type to count, from make_city
+        stages - optional list of stage names to run, defaults to all
+    Returns:
+        list of dicts with each stage's results
+    """
+    results = []
+    for name, module, unit in STAGES:
+        if stages and name not in stages:
+            continue
+        print("Running {}...".format(name))
+        log_file = os.path.join(datadir, 'benchmark_{}.log'.format(name))
+        seconds, max_rss, returncode = run_stage(
+            stage_args(name, module, datadir, config_file), log_file)
+        result = {
+            'stage': name,
+            'seconds': round(seconds, 3),
+            'max_rss_mb': round(max_rss, 1),
+            'items': counts[unit],
+            'unit': unit,
+            'per_second': round(counts[unit] / seconds, 1)
+            if seconds else None,
+            'returncode': returncode,
+        }
+        results.append(result)
+        print("  {:.2f}s, {:.0f}MB peak, {} {} per second".format(
+            seconds, max_rss, result['per_second'], unit))
+
+        if returncode:
+            with open(log_file) as f:
+                print(''.join(f.readlines()[-20:]))
+            print("{} failed, see {}".format(name, log_file))
+            break
+    return results
+
+
+def git_commit():
+    """
+    Current commit of the repo, or None if it can't be found
+    """
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def read_history(filename):
+    if not os.path.exists(filename):
+        return []
+    with open(filename) as f:
+        return json.load(f)
+
+
+def previous_run(history, params):
+    """
+    The most recent run in the history with the same parameters
+    """
+    for run in reversed(history):
+        if run['params'] == params:
+            return run
+    return None
+
+
+def compare(run, previous):
+    """
+    Print the change in each stage's time since a previous run
+    """
+    if not previous:
+        print("No previous run with these parameters to compare to")
+        return
+    before = {x['stage']: x for x in previous['stages']}
+    print("Compared to {} ({}):".format(
+        previous['commit'], previous['timestamp']))
+    for stage in run['stages']:
+        if stage['stage'] not in before:
+            continue
+        old = before[stage['stage']]['seconds']
+        change = 100 * (stage['seconds'] - old) / old if old else 0
+        print("  {:<20} {:>8.2f}s -> {:>8.2f}s ({:+.0f}%)".format(
+            stage['stage'], old, stage['seconds'], change))
+
+
+def add_to_history(filename, run):
+    """
+    Append a run to the history file
+    """
+    history = read_history(filename)
+    history.append(run)
+    directory = os.path.dirname(filename)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(filename, 'w') as f:
+        json.dump(history, f, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=20,
+                        help="Number of intersections along each side " +
+                        "of the city's road grid")
+    parser.add_argument("--crashes", type=int, default=5000,
+                        help="Number of crashes")
+    parser.add_argument("--snapshots", type=int, default=50,
+                        help="Number of waze snapshots")
+    parser.add_argument("--events", type=int,
+                        help="Number of waze jams and alerts per " +
+                        "snapshot, defaults to half the grid size")
+    parser.add_argument("--points", type=int, default=1000,
+                        help="Number of point-based features")
+    parser.add_argument("--volumes", type=int, default=50,
+                        help="Number of volume counts")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Random seed for generating the city")
+    parser.add_argument("--stages", type=str,
+                        help="Comma-separated list of stages to run, " +
+                        "among " + ', '.join(STAGE_NAMES))
+    parser.add_argument("-d", "--datadir", type=str,
+                        help="Directory to generate the city in, " +
+                        "defaults to a temporary directory that is " +
+                        "removed afterwards")
+    parser.add_argument("--history", type=str, default=HISTORY_FILE,
+                        help="Json file to add the results to")
+
+    args = parser.parse_args()
+    stages = args.stages.split(',') if args.stages else None
+    if stages and set(stages) - set(STAGE_NAMES):
+        sys.exit("Unknown stages: {}".format(
+            ', '.join(set(stages) - set(STAGE_NAMES))))
+
+    params = {
+        'size': args.size,
+        'crashes': args.crashes,
+        'snapshots': args.snapshots,
+        'events': args.events,
+        'points': args.points,
+        'volumes': args.volumes,
+        'seed': args.seed,
+    }
+
+    datadir = args.datadir or tempfile.mkdtemp(prefix='benchmark_')
+    datadir = os.path.abspath(datadir)
+    try:
+        print("Generating synthetic city in {}".format(datadir))
+        config_file, counts = make_city(datadir, **params)
+        print(', '.join('{} {}'.format(v, k) for k, v in counts.items()))
+
+        run = {
+            'commit': git_commit(),
+            'timestamp': datetime.datetime.now().isoformat(
+                timespec='seconds'),
+            'params': params,
+            'stages': run_stages(datadir, config_file, counts, stages),
+        }
+    finally:
+        if not args.datadir:
+            shutil.rmtree(datadir)
+
+    compare(run, previous_run(read_history(args.history), params))
+    add_to_history(args.history, run)
+    print("Added results to {}".format(args.history))
@@ -0,0 +1,125 @@
+# Measure how long each pipeline stage's module takes to import
+# pipeline.py and make_dataset.py run every stage as its own
+# python -m subprocess, so each stage pays for its top level imports
+# again.  This imports each module in a fresh interpreter, a few times,
+# and prints the fastest time, less the interpreter's own startup.
+# It also checks that modules don't import the heavy dependencies that
+# they're meant to import only in the functions that need them, and
+# exits with an error if one does, so it can be run as a check.
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules run as stages by pipeline.py and make_dataset.py
+MODULES = [
+    'data_standardization.standardize_crashes',
+    'data_standardization.standardize_point_data',
+    'data_standardization.standardize_volume',
+    'data_standardization.standardize_waze_data',
+    'data.make_dataset',
+    'data.osm_create_maps',
+    'data.create_segments',
+    'data.add_map',
+    'data.join_segments_crash',
+    'data.add_waze_data',
+    'data.propagate_volume',
+    'data.extract_intersections',
+    'features.make_canon_dataset',
+    'models.train_model',
+    'data.make_preds_viz',
+]
+
+MAP_LIBRARIES = ['osmnx', 'geopandas', 'matplotlib', 'pyproj']
+# Dependencies that each module shouldn't import when it's imported
+NOT_IMPORTED = {
+    'data.util': MAP_LIBRARIES + ['fiona', 'pandas'],
+    'data.make_dataset': MAP_LIBRARIES + ['fiona', 'pandas'],
+    'data.create_segments': MAP_LIBRARIES + ['pandas'],
+    'data.add_map': MAP_LIBRARIES + ['pandas'],
+    'data.add_waze_data': MAP_LIBRARIES + ['pandas'],
+    'data.osm_create_maps': MAP_LIBRARIES,
+}
+
+
+def run_python(code):
+    """
+    Run code in a fresh interpreter from the src directory
+    Returns:
+        seconds taken, and the code's output
+    """
+    start = time.time()
+    output = subprocess.check_output(
+        [sys.executable, '-c', code], cwd=SRC_DIR,
+        stderr=subprocess.DEVNULL)
+    return time.time() - start, output.decode()
+
+
+def import_time(module, repeat=3, startup=0):
+    """
+    Fastest of several imports of a module, each in a new interpreter
+    Args:
+        module
+        repeat - number of times to import it
+        startup - seconds to subtract for starting the interpreter
+    Returns:
+        seconds
+    """
+    return min(run_python('import ' + module)[0]
+               for _ in range(repeat)) - startup
+
+
+def imported(module, dependencies):
+    """
+    Which of the given dependencies are imported by importing a module
+    """
+    code = "import sys\nimport {}\nprint(','.join(x for x in {!r} " \
+        "if x in sys.modules))".format(module, dependencies)
+    output = run_python(code)[1].strip().split('\n')[-1]
+    return [x for x in output.split(',') if x]
+
+
+def check_imports(not_imported=NOT_IMPORTED):
+    """
+    Find modules that import dependencies they shouldn't
+    Returns:
+        dict of module to the dependencies it imports
+    """
+    problems = {}
+    for module, dependencies in not_imported.items():
+        found = imported(module, dependencies)
+        if found:
+            problems[module] = found
+    return problems
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modules", type=str,
+                        help="Comma-separated modules to time, " +
+                        "defaults to all of the pipeline's stages")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Number of times to import each module")
+    args = parser.parse_args()
+
+    modules = args.modules.split(',') if args.modules else MODULES
+    startup = min(run_python('pass')[0] for _ in range(args.repeat))
+    print("Interpreter startup: {:.2f}s".format(startup))
+
+    total = 0
+    for module in modules:
+        seconds = import_time(module, args.repeat, startup)
+        total += seconds
+        print("  {:<45} {:>6.2f}s".format(module, seconds))
+    print("  {:<45} {:>6.2f}s".format('total', total))
+
+    problems = check_imports()
+    for module, dependencies in sorted(problems.items()):
+        print("{} imports {}, which should only be imported where "
+              "they're used".format(module, ', '.join(dependencies)))
+    if problems:
+        sys.exit(1)
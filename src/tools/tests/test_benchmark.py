@@ -0,0 +1,81 @@
+from .. import benchmark
+import json
+import os
+from jsonschema import validate
+
+
+def test_make_city(tmpdir):
+    config_file, counts = benchmark.make_city(
+        str(tmpdir), size=4, crashes=10, snapshots=3, events=2,
+        points=5, volumes=3)
+    assert os.path.exists(config_file)
+    assert counts == {
+        'ways': 24,
+        'crashes': 10,
+        'waze_events': 12,
+        'points': 5,
+        'volumes': 3,
+    }
+
+    with open(os.path.join(
+            str(tmpdir), 'processed', 'maps', 'osm_elements.geojson')) as f:
+        features = json.load(f)['features']
+    lines = [x for x in features if x['geometry']['type'] == 'LineString']
+    points = [x for x in features if x['geometry']['type'] == 'Point']
+    assert len(lines) == 24
+    assert len(points) == 16
+    assert len(set(x['properties']['segment_id'] for x in lines)) == 24
+
+    with open(os.path.join(str(tmpdir), 'standardized', 'waze.json')) as f:
+        waze = json.load(f)
+    assert max(x['snapshotId'] for x in waze) == 3
+
+    with open(os.path.join(str(tmpdir), 'standardized', 'volume.json')) as f:
+        volumes = json.load(f)
+    with open(os.path.join(
+            benchmark.BASE_DIR, 'standards', 'volumes-schema.json')) as f:
+        validate(volumes, json.load(f))
+
+    # The same seed gives the same city
+    other = tmpdir.mkdir('other')
+    benchmark.make_city(
+        str(other), size=4, crashes=10, snapshots=3, events=2,
+        points=5, volumes=3)
+    with open(os.path.join(str(other), 'standardized', 'crashes.json')) as f:
+        crashes = json.load(f)
+    with open(os.path.join(str(tmpdir), 'standardized', 'crashes.json')) as f:
+        assert json.load(f) == crashes
+
+
+def test_run_stage(tmpdir):
+    log_file = os.path.join(str(tmpdir), 'stage.log')
+    seconds, max_rss, returncode = benchmark.run_stage(
+        ['-c', 'x = bytearray(64 * 1024 * 1024); print(len(x))'], log_file)
+    assert returncode == 0
+    assert max_rss > 64
+    assert seconds > 0
+    with open(log_file) as f:
+        assert f.read().strip() == str(64 * 1024 * 1024)
+
+    _, _, returncode = benchmark.run_stage(
+        ['-c', 'import sys; sys.exit(3)'], log_file)
+    assert returncode == 3
+
+
+def test_history(tmpdir):
+    history_file = os.path.join(str(tmpdir), 'reports', 'benchmarks.json')
+    small = {'size': 4, 'seed': 0}
+    large = {'size': 40, 'seed': 0}
+    for commit, params in [('a', small), ('b', large), ('c', large)]:
+        benchmark.add_to_history(history_file, {
+            'commit': commit,
+            'timestamp': '',
+            'params': params,
+            'stages': [],
+        })
+
+    history = benchmark.read_history(history_file)
+    assert [x['commit'] for x in history] == ['a', 'b', 'c']
+    assert benchmark.previous_run(history, small)['commit'] == 'a'
+    assert benchmark.previous_run(history, large)['commit'] == 'c'
+    assert benchmark.previous_run(history, {'size': 8, 'seed': 0}) is None
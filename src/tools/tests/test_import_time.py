@@ -0,0 +1,9 @@
+from .. import import_time
+
+
+def test_imported():
+    assert import_time.imported('json', ['json', 'not_a_module']) == ['json']
+
+
+def test_check_imports():
+    assert import_time.check_imports() == {}